@@ -19,9 +19,12 @@
 from clip_aux_functions import *
 import os
 import sys
-import xlsxwriter
+from cohort_functions import save_clip_planes
 import argparse
 
+# point arrays used by this stage, the rest (e.g. CARTO voltage, LAT...) are only loaded to project them onto the output
+STAGE_ARRAYS = ['GTLabels']
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--meshfile', type=str, metavar='PATH', help='path to input mesh')
 parser.add_argument('--pv_dist', type=int, default=3, help='PV clipping distance (mm)')
@@ -35,7 +38,17 @@ parser.add_argument('--pvends', type=int, default=1, help='Enforce the centerlin
 parser.add_argument('--vis', type=int, default=1, help='Set to 1 to visualise clipping results overlaid with original mesh')
 parser.add_argument('--save', type=int, default=0, help='Set to 0 to remove intermediate results (centerlines, clippoints, etc.)')
 parser.add_argument('--cut_laa', type=int, default=0, help='Set to 1 for anatomies with LAA and MV clipped')
+parser.add_argument('--output_format', type=str, default=None, choices=OUTPUT_FORMATS, help='format of the output meshes: zlib or lz4 (compressed VTK XML), binary or ascii (legacy VTK). Default: LA_OUTPUT_FORMAT environment variable or zlib')
+parser.add_argument('--case_bundle', type=int, default=None, choices=[0, 1], help='Set to 1 to store the intermediate files (seeds, centerlines, contours, paths...) in a single <case>_bundle.zip per case. Default: LA_CASE_BUNDLE environment variable or 0')
+parser.add_argument('--mesh_cache', type=int, default=None, choices=[0, 1], help='Set to 1 to cache the meshes as memory-mapped .npy files (.mesh_cache folder) for fast reload in the next stages. Default: LA_MESH_CACHE environment variable or 0')
+parser.add_argument('--projection', type=str, default='closest', choices=TRANSFER_METHODS, help='how the scalar arrays of the input mesh are projected: closest (closest point value) or barycentric (interpolation in the closest cell, for continuous maps such as voltage or LAT; labels always use the closest point)')
 args = parser.parse_args()
+if args.output_format is not None:
+    set_output_format(args.output_format)
+if args.case_bundle is not None:
+    set_case_bundle(args.case_bundle)
+if args.mesh_cache is not None:
+    set_mesh_cache(args.mesh_cache)
 
 
 fileroot = os.path.dirname(args.meshfile)
@@ -43,14 +56,14 @@ filename = os.path.basename(args.meshfile)
 filenameroot = os.path.splitext(filename)[0]
 
 if os.path.isfile(args.meshfile):
-    surface = readvtk(args.meshfile)
+    surface = readvtk(args.meshfile, arrays=STAGE_ARRAYS)
 else:
     sys.exit('ERROR: input file does not exist. Please, specify a valid path.')
 
 # compute seeds (save polydata as vtp)
 seedsfile = os.path.join(fileroot, filenameroot + '_clipseeds.vtp')
 outseedsfile = os.path.join(fileroot, filenameroot + '_clipseeds.csv')
-if not os.path.exists(seedsfile):
+if not case_file_exists(seedsfile):
     if args.cut_laa == 0:
         laa_seedon = 1
     else:
@@ -80,50 +93,32 @@ inputsurface = readvtp(inputfile)
 # use special distance (dist_LAA) for the LAA (label=37). Save the info about the clipping planes
 stdmesh, clip_planes = clip_vein_endpoint_and_LAA_save_planes(inputsurface, sufixfile, args.pv_dist, 37, args.laa_dist, args.cut_laa)
 
-plane_file = os.path.join(fileroot, filenameroot + '_clip_planes.xlsx')
-workbook = xlsxwriter.Workbook(plane_file)
-worksheet = workbook.add_worksheet()
-onoff = 1
 if args.cut_laa == 1:
     i_range = 4
 else:
     i_range = 5
-for i in range(i_range):
-    point = clip_planes[2*i, 0:3]
-    normal = clip_planes[2*i+1, 0:3]
-    for j in range(3):
-        worksheet.write(2*i, j, point[j])
-        worksheet.write(2*i+1, j, normal[j])
-workbook.close()
+save_clip_planes(os.path.join(fileroot, filenameroot + '_clip_planes.csv'), clip_planes[0:2*i_range, :])   # export all cases with export_clip_planes.py
 
 # close small holes that can appear after clipping the veins & copy original scalar info in the filled holes
 # in same cases the normals flip. Have in mind...
 max_hole_size = 4  # empirical, be careful to do not close pv ostiums, check visually.
 stdmesh_closed = fillholes(stdmesh, max_hole_size)
 print('\n')
-transfer_all_scalar_arrays(surface, stdmesh_closed)
+load_remaining_arrays(surface, args.meshfile)
+transfer_all_scalar_arrays(surface, stdmesh_closed, args.projection, fileroot)
 
 if args.vis > 0:
     visualise_default(stdmesh_closed, surface, 'STD mesh', 'autolabels', 36, 79)
-writevtk(stdmesh_closed, os.path.join(fileroot, filenameroot + '_clipped.vtk'))
+writevtk(stdmesh_closed, os.path.join(fileroot, filenameroot + '_clipped.vtk'), legacy=True)   # read by external viewers (view.py)
 
 # Apply crinkle clip to the veins. It does not cut cells.
-array_labels = np.zeros(surface.GetNumberOfPoints())
-locator = vtk.vtkPointLocator()
-locator.SetDataSet(stdmesh_closed)
-locator.BuildLocator()
-for p in range(surface.GetNumberOfPoints()):
-    point = surface.GetPoint(p)
-    closestpoint_id = locator.FindClosestPoint(point)
-    dist = euclideandistance(point, stdmesh_closed.GetPoint(closestpoint_id))
-    if dist > 0.05:   # empirical distance
-        array_labels[p] = 1
+array_labels = far_points_mask(surface, stdmesh_closed, 0.05).astype(float)   # empirical distance
 newarray = numpy_to_vtk(array_labels)
 newarray.SetName("pv")
 surface.GetPointData().AddArray(newarray)
 m_ccliped = pointthreshold(surface, "pv", 0, 0)
 transfer_array(stdmesh_closed, m_ccliped, 'autolabels', 'autolabels')
-writevtk(cleanpolydata(m_ccliped), os.path.join(fileroot, filenameroot + '_crinkle_clipped.vtk'))
+writevtk(cleanpolydata(m_ccliped), os.path.join(fileroot, filenameroot + '_crinkle_clipped.vtk'), legacy=True)   # input of FillSurfaceHoles
 
 # MV clip, auto
 if args.cut_laa == 0:
@@ -132,18 +127,8 @@ if args.cut_laa == 0:
     surfaceclipped = find_mitral_cylinder_pvs(stdmesh, 'autolabels', o_file, 0.25, w, 0)
     if args.vis > 0:
         visualise_color(surfaceclipped, surface, 'Mitral Valve clip')
-    writevtk(cleanpolydata(surfaceclipped), o_file + '.vtk')
+    writevtk(cleanpolydata(surfaceclipped), o_file + '.vtk', legacy=True)   # input of stage 2
 
 if args.save == 0:  # remove intermediate results (centerlines, clippoints, etc.)
-    if sys.platform == "linux" or sys.platform == "linux2":
-        os.system("rm " + os.path.join(fileroot, filenameroot + '*clbranch*.vtp'))
-        os.system("rm " + os.path.join(fileroot, filenameroot + '*clvein*.vtp'))
-        os.system("rm " + os.path.join(fileroot, filenameroot + '*clraw*.vtp'))
-        os.system("rm " + os.path.join(fileroot, filenameroot + '*clsection*.vtp'))
-        os.system("rm " + os.path.join(fileroot, filenameroot + '*clippointid*.csv'))
-    if sys.platform == "win32":
-        os.system("del " + os.path.join(fileroot, filenameroot + '*clbranch*.vtp'))
-        os.system("del " + os.path.join(fileroot, filenameroot + '*clvein*.vtp'))
-        os.system("del " + os.path.join(fileroot, filenameroot + '*clraw*.vtp'))
-        os.system("del " + os.path.join(fileroot, filenameroot + '*clsection*.vtp'))
-        os.system("del " + os.path.join(fileroot, filenameroot + '*clippointid*.csv'))
+    for pattern in ['*clbranch*.vtp', '*clvein*.vtp', '*clraw*.vtp', '*clsection*.vtp', '*clippointid*.csv']:
+        remove_case_files(os.path.join(fileroot, filenameroot + pattern))
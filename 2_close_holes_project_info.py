@@ -28,7 +28,17 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--meshfile_open', type=str, metavar='PATH', help='path to input mesh with clipped PVs and LAA')
 parser.add_argument('--meshfile_open_no_mitral', type=str, metavar='PATH', help='path to input mesh with additional MV clip')
 parser.add_argument('--meshfile_closed', type=str, metavar='PATH', help='path to output mesh, i.e. with filled holes')
+parser.add_argument('--output_format', type=str, default=None, choices=OUTPUT_FORMATS, help='format of the output meshes: zlib or lz4 (compressed VTK XML), binary or ascii (legacy VTK). Default: LA_OUTPUT_FORMAT environment variable or zlib')
+parser.add_argument('--case_bundle', type=int, default=None, choices=[0, 1], help='Set to 1 to store the intermediate files (seeds, centerlines, contours, paths...) in a single <case>_bundle.zip per case. Default: LA_CASE_BUNDLE environment variable or 0')
+parser.add_argument('--mesh_cache', type=int, default=None, choices=[0, 1], help='Set to 1 to cache the meshes as memory-mapped .npy files (.mesh_cache folder) for fast reload in the next stages. Default: LA_MESH_CACHE environment variable or 0')
+parser.add_argument('--projection', type=str, default='closest', choices=TRANSFER_METHODS, help='how the scalar arrays of the input mesh are projected: closest (closest point value) or barycentric (interpolation in the closest cell, for continuous maps such as voltage or LAT; labels always use the closest point)')
 args = parser.parse_args()
+if args.output_format is not None:
+    set_output_format(args.output_format)
+if args.case_bundle is not None:
+    set_case_bundle(args.case_bundle)
+if args.mesh_cache is not None:
+    set_mesh_cache(args.mesh_cache)
 
 fileroot = os.path.dirname(args.meshfile_open)
 filename = os.path.basename(args.meshfile_open)
@@ -53,44 +63,26 @@ else:  # Fill holes
         sys.exit('Unknown operating system. Holes cannot be filled automatically. Fill holes manually and save file as ', args.meshfile_closed, '. Then run again this script to proyect scalar arrays from initial mesh if necessary.')
 
 m_open = readvtk(args.meshfile_open)
-m_no_mitral = readvtk(args.meshfile_open_no_mitral)
+m_no_mitral = readvtk(args.meshfile_open_no_mitral, arrays=[])   # only the geometry is needed
 m_closed = readvtk(args.meshfile_closed)
 # m_closed = m_open
 print('Projecting information... ')
-transfer_all_scalar_arrays(m_open, m_closed)
+closest_ids = transfer_all_scalar_arrays(m_open, m_closed, args.projection, os.path.dirname(args.meshfile_closed))   # closest point of m_open to each point of m_closed
 
 # Mark filled holes. Common points (close enough, not added during hole filling) will we marked with scalar array
-array_labelsA = np.zeros(m_closed.GetNumberOfPoints())
-locator = vtk.vtkPointLocator()
-locator.SetDataSet(m_open)
-locator.BuildLocator()
-for p in range(m_closed.GetNumberOfPoints()):
-    point = m_closed.GetPoint(p)
-    closestpoint_id = locator.FindClosestPoint(point)
-    dist = euclideandistance(point, m_open.GetPoint(closestpoint_id))
-    if dist > 0.05:   # empirical distance
-        array_labelsA[p] = 1
+array_labelsA = far_points_mask(m_closed, m_open, 0.05).astype(float)   # empirical distance
 newarray = numpy_to_vtk(array_labelsA)
 newarray.SetName('hole')
 m_closed.GetPointData().AddArray(newarray)
 
 # Mark MV using m_open and m_no_mitral
-array_labelsB = np.zeros(m_open.GetNumberOfPoints())
-locator = vtk.vtkPointLocator()
-locator.SetDataSet(m_no_mitral)
-locator.BuildLocator()
-for p in range(m_open.GetNumberOfPoints()):
-    point = m_open.GetPoint(p)
-    closestpoint_id = locator.FindClosestPoint(point)
-    dist = euclideandistance(point, m_no_mitral.GetPoint(closestpoint_id))
-    if dist > 0.05:   # empirical distance
-        array_labelsB[p] = 1
+array_labelsB = far_points_mask(m_open, m_no_mitral, 0.05).astype(float)   # empirical distance
 newarray = numpy_to_vtk(array_labelsB)
 newarray.SetName('mv')
 m_open.GetPointData().AddArray(newarray)
 
-transfer_array(m_open, m_closed, 'mv', 'mv')
-transfer_array(m_open, m_closed, 'autolabels', 'autolabels')
+transfer_array(m_open, m_closed, 'mv', 'mv', closest_ids)
+transfer_array(m_open, m_closed, 'autolabels', 'autolabels', closest_ids)
 m_final = pointthreshold(m_closed, 'mv', 0, 0)
 m_final.GetPointData().RemoveArray('mv')
 writevtk(m_final, args.meshfile_closed)
@@ -25,11 +25,23 @@ import os
 import numpy as np
 import argparse
 
+# point arrays used by this stage (colour for the seed selection)
+STAGE_ARRAYS = ['autolabels']
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--meshfile', type=str, metavar='PATH', help='path to input mesh')
 parser.add_argument('--cut_laa', type=int, default=0, help='Set to 1 for anatomies with LAA and MV clipped')
+parser.add_argument('--output_format', type=str, default=None, choices=OUTPUT_FORMATS, help='format of the output meshes: zlib or lz4 (compressed VTK XML), binary or ascii (legacy VTK). Default: LA_OUTPUT_FORMAT environment variable or zlib')
+parser.add_argument('--case_bundle', type=int, default=None, choices=[0, 1], help='Set to 1 to store the intermediate files (seeds, centerlines, contours, paths...) in a single <case>_bundle.zip per case. Default: LA_CASE_BUNDLE environment variable or 0')
+parser.add_argument('--mesh_cache', type=int, default=None, choices=[0, 1], help='Set to 1 to cache the meshes as memory-mapped .npy files (.mesh_cache folder) for fast reload in the next stages. Default: LA_MESH_CACHE environment variable or 0')
 args = parser.parse_args()
+if args.output_format is not None:
+    set_output_format(args.output_format)
+if args.case_bundle is not None:
+    set_case_bundle(args.case_bundle)
+if args.mesh_cache is not None:
+    set_mesh_cache(args.mesh_cache)
 
 fileroot = os.path.dirname(args.meshfile)
 filename = os.path.basename(args.meshfile)
@@ -41,7 +53,7 @@ if not os.path.exists(args.meshfile):
 outputfile = os.path.join(fileroot, filenameroot + '_seeds.vtk')   # selected by user
 outputfile2 = os.path.join(fileroot, filenameroot + '_seeds_for_flat.vtk')  # modified seeds, used for flattening
 
-surface = readvtk(args.meshfile)
+surface = readvtk(args.meshfile, arrays=STAGE_ARRAYS)
 if args.cut_laa == 0:
     nseeds = 9
     labels = [0, 1, 2, 3, 4, 5, 6, 7, 8]
@@ -49,7 +61,7 @@ else:
     nseeds = 8
     labels = [0, 1, 2, 3, 5, 6, 7, 8]
 
-if not os.path.exists(outputfile):
+if not case_file_exists(outputfile):
     if args.cut_laa == 0:
         print('Select exactly 9 seeds in this order: \n 1. RSPV\n 2. RIPV\n 3. LIPV \n 4. LSPV \n 5. LAA and, \n 6. 4 seeds close to the MV contour (starting in the point that should be in the top position in the disk)')
     else:
@@ -27,6 +27,14 @@ import matplotlib.pyplot as plt
 import sys
 import os
 import argparse
+import json
+import time
+from cohort_functions import log_flat_cost, peak_memory
+
+t_start = time.time()
+
+# point arrays used by this stage, the rest (e.g. CARTO voltage, LAT...) are only loaded to project them onto the flat mesh
+STAGE_ARRAYS = ['autolabels', 'hole', 'pv']
 
 
 parser = argparse.ArgumentParser()
@@ -36,16 +44,30 @@ parser.add_argument('--save_conts', type=bool, default=True, help='set to true t
 parser.add_argument('--save_final_paths', type=bool, default=True, help='set to true to save modified dividing paths')
 parser.add_argument('--countors', action='store_false')
 parser.add_argument('--cut_laa', type=int, default=0, help='Set to 1 for anatomies with LAA and MV clipped')
+parser.add_argument('--solver', type=str, default='lu', choices=['lu', 'cholesky', 'cg', 'amg'], help='linear solver: lu (direct, default), cholesky, cg or amg (iterative: same flat map as lu up to --tol, slower, for meshes too large for direct solvers; error if they do not converge)')
+parser.add_argument('--tol', type=float, default=1e-8, help='relative tolerance of the iterative solvers (cg, amg)')
+parser.add_argument('--sweep', type=str, metavar='PATH', default=None, help='json file with template parameters to sweep ({parameter: [values]} grid or list of settings). Writes one flat mesh per setting reusing the factorization')
+parser.add_argument('--check_constraints', type=str, default='repair', choices=['repair', 'fail'], help='repeated, conflicting or out of range boundary/constraint ids found before flattening: repair (drop them, with a warning) or fail')
+parser.add_argument('--cost_log', type=str, metavar='PATH', default=None, help='append the size, time and peak memory of this run to this file (one json record per line), to fit the cost model of scan_meshes.py')
+parser.add_argument('--output_format', type=str, default=None, choices=OUTPUT_FORMATS, help='format of the output meshes: zlib or lz4 (compressed VTK XML), binary or ascii (legacy VTK). Default: LA_OUTPUT_FORMAT environment variable or zlib')
+parser.add_argument('--case_bundle', type=int, default=None, choices=[0, 1], help='Set to 1 to store the intermediate files (seeds, centerlines, contours, paths...) in a single <case>_bundle.zip per case. Default: LA_CASE_BUNDLE environment variable or 0')
+parser.add_argument('--mesh_cache', type=int, default=None, choices=[0, 1], help='Set to 1 to cache the meshes as memory-mapped .npy files (.mesh_cache folder) for fast reload in the next stages. Default: LA_MESH_CACHE environment variable or 0')
 args = parser.parse_args()
+if args.output_format is not None:
+    set_output_format(args.output_format)
+if args.case_bundle is not None:
+    set_case_bundle(args.case_bundle)
+if args.mesh_cache is not None:
+    set_mesh_cache(args.mesh_cache)
 
 if os.path.isfile(args.meshfile)==False:
     sys.exit('ERROR: input file does not exist')
 else:
-    mesh = readvtk(args.meshfile)
-    m_open = readvtk(args.meshfile_o)
+    mesh = readvtk(args.meshfile, arrays=[])   # only the geometry is needed
+    m_open = readvtk(args.meshfile_o, arrays=STAGE_ARRAYS)
 
 seeds_filename = args.meshfile[0:len(args.meshfile)-4] + '_seeds_for_flat.vtk'
-if os.path.isfile(seeds_filename)==False:
+if case_file_exists(seeds_filename)==False:
     sys.exit('ERROR: input file containing seeds for flat does not exist. Create it using: 3_divide_LA.py')
 else:
     m_seeds = readvtk(seeds_filename)
@@ -55,70 +77,30 @@ m_out = args.meshfile[0:len(args.meshfile) - 4] + '_flat.vtk'
 countors = args.countors
 
 ##################   Template creation. Define position and radius of PV holes, and radius disk. Adapt to input mesh.    ##################
-rdisk = 0.5
-pv_centers = np.zeros([2, 4])
-r_min = 0.03
-rhole_lipv = r_min
-rhole_lspv = 1.1*r_min
-rhole_ripv = 1.1*r_min
-rhole_rspv = 1.35*r_min
-rhole_laa = 1.35*r_min
-laa_disp_x = 0.03  # displacement of LAA wrt LSPV (in x direction, to the left)
-
-px_ref = -0.25
-py_ref = -0.10
-left_carina_length = 0.175
-right_carina_length = 1.5 * left_carina_length   # real proportions, do not separate more, it induces distortion close to the holes
-pwall_width = 2.6 * left_carina_length
-sep_lspv_laa = 1.2
-t_v5 = np.pi / 8
-t_v6 = 2*np.pi - np.pi/6
-t_v7 = np.pi + np.pi / 6
-t_v8 = 3 * np.pi / 4 - np.pi/40
-
-# rspv
-pv_centers[0, 0] = px_ref + pwall_width
-pv_centers[1, 0] = py_ref + left_carina_length + (right_carina_length - left_carina_length) / 2
-# ripv
-pv_centers[0, 1] = px_ref + pwall_width
-pv_centers[1, 1] = py_ref - (right_carina_length - left_carina_length) / 2
-# lipv
-pv_centers[0, 2] = px_ref
-pv_centers[1, 2] = py_ref
-# lspv
-pv_centers[0, 3] = px_ref
-pv_centers[1, 3] = py_ref + left_carina_length
-# LAA
-laa_hole_center_x = px_ref - laa_disp_x
-laa_hole_center_y = py_ref + left_carina_length + left_carina_length * sep_lspv_laa  # si lipv esta en (-.25, -.10)
-
-xhole_center = pv_centers[0, :]
-yhole_center = pv_centers[1, :]
-
-# define the proportion of points in each of the PV segments
-alpha = np.arctan(np.divide(laa_disp_x, laa_hole_center_y - pv_centers[1, 3]))  # angle of the line connecting LSPV and LAA
-proportions = define_pv_segments_proportions(t_v5, t_v6, t_v7, alpha)
-propn_rspv_s1, propn_rspv_s2, propn_rspv_s3 = proportions[0, :]
-propn_ripv_s1, propn_ripv_s2, propn_ripv_s3 = proportions[1, :]
-propn_lipv_s1, propn_lipv_s2, propn_lipv_s3 = proportions[2, :]
-propn_lspv_s1, propn_lspv_s2, propn_lspv_s3 = proportions[3, :]
+template = define_template()   # default TEMPLATE_PARAMETERS (aux_functions.py)
+propn_rspv_s1, propn_rspv_s2, propn_rspv_s3 = template['proportions'][0, :]
+propn_ripv_s1, propn_ripv_s2, propn_ripv_s3 = template['proportions'][1, :]
+propn_lipv_s1, propn_lipv_s2, propn_lipv_s3 = template['proportions'][2, :]
+propn_lspv_s1, propn_lspv_s2, propn_lspv_s3 = template['proportions'][3, :]
 
 v5 = m_seeds.GetPoint(5)   # Seeds in the MV
 v6 = m_seeds.GetPoint(6)
 v7 = m_seeds.GetPoint(7)
 v8 = m_seeds.GetPoint(8)
 
-# define target coordinates in the disk and get them separated
-coordinates = define_disk_template(rdisk, rhole_rspv, rhole_ripv, rhole_lipv, rhole_lspv, rhole_laa, xhole_center, yhole_center,laa_hole_center_x, laa_hole_center_y, t_v5, t_v6, t_v7, t_v8)
-v1r_x, v1r_y, v1d_x, v1d_y, v1l_x, v1l_y, v2u_x, v2u_y, v2r_x, v2r_y, v2l_x, v2l_y, v3u_x, v3u_y, v3r_x, v3r_y, v3l_x, v3l_y, v4r_x, v4r_y, v4u_x, v4u_y, v4d_x, v4d_y, vlaad_x, vlaad_y, vlaau_x, vlaau_y, p5_x, p5_y, p6_x, p6_y, p7_x, p7_y, p8_x, p8_y = get_coords(coordinates)
-
 ##################    Open PVs and LAA holes (get 'to_be_flat_mesh'), identify contours and dividing paths in the to_be_flat mesh   ##################
 # m_open = cleanpolydata(pointthreshold(mesh, 'hole', 0, 0))
-m_open = DeleteNonTriangularFaces(m_open)  # Delete non-triangular faces, otherwise flat_w_constraints will not work
-
-writevtk(m_open, to_be_flat_filename)
-# contours
-
+same_file = os.path.abspath(args.meshfile_o) == os.path.abspath(to_be_flat_filename)
+if not IsTriangularMesh(m_open):
+    if same_file:   # the input file is overwritten, load now the point arrays that were not read
+        load_remaining_arrays(m_open, args.meshfile_o)
+    m_open = DeleteNonTriangularFaces(m_open)  # Delete non-triangular faces, otherwise flat_w_constraints will not work
+    writevtk(m_open, to_be_flat_filename)
+elif not same_file:   # otherwise the input file already is the to_be_flat mesh
+    writevtk(m_open, to_be_flat_filename)
+# contours (saved files if not countors) and paths (created with 3_divide_LA.py), all files read at the same time
+npaths = 7
+contours, paths = read_flat_inputs(args.meshfile, npaths, args.cut_laa, contours=not countors)
 
 if countors:
     if args.cut_laa == 0:
@@ -127,26 +109,14 @@ if countors:
         cont_rspv, cont_ripv, cont_lipv, cont_lspv, cont_mv = extract_LA_contours(m_open, args.meshfile, args.save_conts, args.cut_laa)
         cont_laa = None
 else:
-    
-    #load files
-    cont_rspv = readvtk(args.meshfile[0:len(args.meshfile)-4] + '_cont_rspv.vtk')
-    cont_ripv = readvtk(args.meshfile[0:len(args.meshfile)-4] + '_cont_ripv.vtk')
-    cont_lipv = readvtk(args.meshfile[0:len(args.meshfile)-4] + '_cont_lipv.vtk')
-    cont_lspv = readvtk(args.meshfile[0:len(args.meshfile)-4] + '_cont_lspv.vtk')
-    cont_mv = readvtk(args.meshfile[0:len(args.meshfile)-4] + '_cont_mv.vtk')
-    if args.cut_laa == 0:
-        cont_laa = readvtk(args.meshfile[0:len(args.meshfile)-4] + '_cont_laa.vtk')
-    else:
-        cont_laa = None
-    
+    cont_rspv, cont_ripv, cont_lipv, cont_lspv, cont_mv, cont_laa = contours
+
 mesh = DeleteNonTriangularFaces(mesh)  # Ensure only triangular faces are present
 
 locator, locator_open, locator_rspv, locator_ripv, locator_lipv, locator_lspv, locator_laa = build_locators(mesh, m_open, cont_rspv, cont_ripv, cont_lipv, cont_lspv, cont_laa, args.cut_laa)
 mv_cont_ids = get_mv_contour_ids(cont_mv, locator_open)
 
-# paths (created with 3_divide_LA.py)
-npaths = 7
-path1, path2, path3, path4, path5, path6, path7, path_laa1, path_laa2, path_laa3, path8 = read_paths(args.meshfile, npaths, args.cut_laa)
+path1, path2, path3, path4, path5, path6, path7, path_laa1, path_laa2, path_laa3, path8 = paths
 
 # Obtain ids corresponding to the extremes of the segments
 v1r, v1d, v1l, v2u, v2r, v2l, v3u, v3r, v3l, v4r, v4u, v4d, vlaad, vlaau, vlaar, id_v5, id_v6, id_v7, id_v8 = identify_segments_extremes(path1, path2, path3, path4, path5, path6, path7, path8, path_laa1, path_laa2, path_laa3,
@@ -220,9 +190,7 @@ try:
 except:
     # find closest point in countor to vlaad
         # locator for contour
-    locator_countor = vtk.vtkPointLocator()
-    locator_countor.SetDataSet(cont_mv)
-    locator_countor.BuildLocator()
+    locator_countor = get_locator(cont_mv)
     id_v5 = locator_open.FindClosestPoint(locator_countor.GetDataSet().GetPoint(locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(id_v5))))
     pos_mv_v5 = int(np.where(mv_cont_ids.astype(int) == id_v5)[0])
 
@@ -232,9 +200,7 @@ try:
 except:
     # find closest point in countor to vlaau
         # locator for contour
-    locator_countor = vtk.vtkPointLocator()
-    locator_countor.SetDataSet(cont_mv)
-    locator_countor.BuildLocator()
+    locator_countor = get_locator(cont_mv)
     id_v6 = locator_open.FindClosestPoint(locator_countor.GetDataSet().GetPoint(locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(id_v6))))
     pos_mv_v6 = int(np.where(mv_ids.astype(int) == id_v6)[0])
 try:
@@ -242,9 +208,7 @@ try:
 except:
     # find closest point in countor to vlaar
         # locator for contour
-    locator_countor = vtk.vtkPointLocator()
-    locator_countor.SetDataSet(cont_mv)
-    locator_countor.BuildLocator()
+    locator_countor = get_locator(cont_mv)
     id_v7 = locator_open.FindClosestPoint(locator_countor.GetDataSet().GetPoint(locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(id_v7))))
     pos_mv_v7 = int(np.where(mv_ids.astype(int) == id_v7)[0])
 try:
@@ -252,9 +216,7 @@ try:
 except:
     # find closest point in countor to vlaau
         # locator for contour
-    locator_countor = vtk.vtkPointLocator()
-    locator_countor.SetDataSet(cont_mv)
-    locator_countor.BuildLocator()
+    locator_countor = get_locator(cont_mv)
     id_v8 = locator_open.FindClosestPoint(locator_countor.GetDataSet().GetPoint(locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(id_v8))))
     pos_mv_v8 = int(np.where(mv_ids.astype(int) == id_v8)[0])
 # which one comes first?
@@ -314,14 +276,6 @@ if args.cut_laa == 0:
     seq_contour_ids = np.append(auxx2, laa_s2).astype(int)
 else:
     seq_contour_ids = auxx2.astype(int)
-# # check repeated points -> singular matrix and no solution
-# counts1 = np.bincount(seq_constraints_ids)
-# counts2 = np.bincount(seq_contour_ids)
-# counts3 = np.bincount(np.concatenate([seq_constraints_ids, seq_contour_ids]))
-# print('Number of repeated constraints', np.where(counts1 > 1)[0])
-# print('Number of repeated contour conditions', np.where(counts2 > 1)[0])
-# print('Number of repeated constraints and conditions', np.where(counts3 > 1)[0])
-
 # put together all PV and LAA segment sizes
 if args.cut_laa == 0:
     pv_laa_segment_lengths = np.zeros([5, 3])
@@ -350,12 +304,16 @@ s12size = s12.size
 ##################    Create target (x0, y0) positions  according to the lengths of each segment    ##################
 # Separately constraints and contours
 
-x0_const, y0_const = define_constraints_positions(s1, s2, s3, s4, s5, s6, s7, s8, s8a, s8b, v1l_x, v1l_y, v1d_x, v1d_y, v1r_x, v1r_y, v2l_x,
-                                 v2l_y, v2r_x, v2r_y, v2u_x, v2u_y, v3r_x, v3r_y, v3u_x, v3u_y, v3l_x, v3l_y,
-                                 v4r_x, v4r_y, v4u_x, v4u_y, v4d_x, v4d_y, vlaad_x, vlaad_y, vlaau_x, vlaau_y, p5_x,
-                                 p5_y, p6_x, p6_y, p7_x, p7_y, p8_x, p8_y, args.cut_laa)
+x0_bound, y0_bound, x0_const, y0_const = template_positions(template, s1, s2, s3, s4, s5, s6, s7, s8, s8a, s8b, s9size, s10size, s11size, s12size, pv_laa_segment_lengths.astype(int), args.cut_laa)
 
-x0_bound, y0_bound = define_boundary_positions(rdisk, rhole_rspv, rhole_ripv, rhole_lipv, rhole_lspv, rhole_laa, xhole_center, yhole_center, laa_hole_center_x, laa_hole_center_y, s9size, s10size, s11size, s12size, pv_laa_segment_lengths.astype(int), t_v5, t_v6, t_v7, t_v8, args.cut_laa)
+# check repeated points -> singular matrix and no solution. Check it before building the system
+try:
+    keep_bound, keep_const = check_flat_constraints(m_open.GetNumberOfPoints(), seq_contour_ids, seq_constraints_ids, x0_bound, y0_bound, x0_const, y0_const,
+                                                    repair=args.check_constraints == 'repair')
+except ValueError as e:
+    sys.exit('ERROR: ' + str(e))
+seq_contour_ids, x0_bound, y0_bound = seq_contour_ids[keep_bound], x0_bound[keep_bound], y0_bound[keep_bound]
+seq_constraints_ids, x0_const, y0_const = seq_constraints_ids[keep_const], x0_const[keep_const], y0_const[keep_const]
 
 plt.plot(x0_bound, y0_bound, 'ro')
 plt.plot(x0_const, y0_const, 'bx')
@@ -363,11 +321,13 @@ plt.title('2D template with boundary (red) and regional (blue) constraint points
 plt.show()
 
 
-m_flat = flat_w_constraints(m_open, seq_contour_ids.astype(int), seq_constraints_ids.astype(int), x0_bound, y0_bound, x0_const, y0_const)
+m_flat, flat_solver = flat_w_constraints(m_open, seq_contour_ids.astype(int), seq_constraints_ids.astype(int), x0_bound, y0_bound, x0_const, y0_const,
+                                         method=args.solver, tol=args.tol, return_solver=True)
 
 # writevtk(m_flat, to_be_flat_filename)
 
-m_final = flat(m_flat, seq_contour_ids.astype(int), x0_bound, y0_bound)   # Refine boundary
+m_final = flat(m_flat, seq_contour_ids.astype(int), x0_bound, y0_bound, method=args.solver, tol=args.tol,
+               x_init=ExtractVTKPoints(m_flat)[:, 0:2])   # Refine boundary, iterative solvers start from the constrained solution
 
 # # Add region (R1, R2, R3, R4, R5) label to the _to_be_flat mesh and the final flat mesh
 # # summarize and write all dividing lines in a txt file
@@ -377,10 +337,7 @@ if args.cut_laa == 0:
 else:
     nlines = 8
 
-locator = vtk.vtkPointLocator()
-locator.SetDataSet(m_open)
-locator.BuildLocator()
-f = open(line_textfile, 'w')
+f = open_case_file(line_textfile, 'w')
 
 for i in range(1, nlines+1):
     if i == 1:
@@ -404,15 +361,15 @@ for i in range(1, nlines+1):
             path = path8_clipped_prop
     elif i == 9:
         path = path_laa2_clipped_prop
-    ids = np.arange(0, path.GetNumberOfPoints())
+    ids = original_point_ids(path, m_open)   # ids of the path points in m_open
     for p in range(path.GetNumberOfPoints()):
-        id_p = locator.FindClosestPoint(path.GetPoint(ids[p]))
-        f.write(str(id_p))
+        f.write(str(ids[p]))
         f.write(' ')
     f.write('\n')
 f.close()
 
 # Read all lines and divide/cut mesh
+load_remaining_arrays(m_open, args.meshfile_o)   # point arrays not used by this stage, projected onto the flat mesh
 m_aux = set_piece_label(m_open, line_textfile, m_seeds)
 writevtk(m_aux, to_be_flat_filename)
 
@@ -424,4 +381,38 @@ m_final.GetPointData().RemoveArray('pv')
 m_final.GetPointData().RemoveArray('autolabels')
 m_final.GetPointData().RemoveArray('hole')
 print('\nRemoving ad hoc scalar arrays: autolabels, pv, and hole')
-writevtk(m_final, m_out)
+writevtk(m_final, m_out, legacy=True)   # final output, legacy VTK for external tools whatever the output format
+if args.cost_log is not None:
+    log_flat_cost(args.cost_log, args.meshfile, m_open.GetNumberOfPoints(), len(seq_contour_ids) + len(seq_constraints_ids),
+                  time.time() - t_start, peak_memory())
+
+##################    Template parameter sweep: same mesh & ids, only the target positions change    ##################
+if args.sweep is not None:
+    settings = read_template_sweep(args.sweep)
+    positions = []
+    kept = []
+    for k in range(len(settings)):
+        template_k = define_template(settings[k])
+        if not np.allclose(template_k['proportions'], template['proportions']):
+            # PV segments (and therefore the boundary / constraint ids) depend on t_v5, t_v6, t_v7
+            print('WARNING: sweep setting', k, settings[k], 'changes the PV segments proportions, run it separately')
+            continue
+        x0_b_k, y0_b_k, x0_c_k, y0_c_k = template_positions(template_k, s1, s2, s3, s4, s5, s6, s7, s8, s8a, s8b, s9size, s10size, s11size, s12size, pv_laa_segment_lengths.astype(int), args.cut_laa)
+        positions.append((x0_b_k[keep_bound], y0_b_k[keep_bound], x0_c_k[keep_const], y0_c_k[keep_const]))   # same rows as the main run
+        kept.append(k)
+    if len(positions) > 0:
+        m_flats = flat_w_constraints_sweep(m_open, seq_contour_ids.astype(int), seq_constraints_ids.astype(int), positions,
+                                           solver=flat_solver, method=args.solver, tol=args.tol)
+    sweep_textfile = m_out[0:len(m_out)-4] + '_sweep.txt'
+    f = open(sweep_textfile, 'w')
+    for i in range(len(positions)):
+        x0_bound_k, y0_bound_k = positions[i][0:2]
+        m_final_k = flat(m_flats[i], seq_contour_ids.astype(int), x0_bound_k, y0_bound_k, method=args.solver, tol=args.tol,
+                         x_init=ExtractVTKPoints(m_flats[i])[:, 0:2])   # boundary refinement, different mesh for each setting
+        m_final_k.GetPointData().ShallowCopy(m_final.GetPointData())
+        m_final_k.GetCellData().ShallowCopy(m_final.GetCellData())
+        name = m_out[0:len(m_out)-4] + '_sweep' + str(kept[i]) + '.vtk'
+        writevtk(m_final_k, name, legacy=True)
+        f.write(os.path.basename(name) + ' ' + json.dumps(settings[kept[i]]) + '\n')
+    f.close()
+    print('\nTemplate sweep:', len(positions), 'flat meshes written, see', sweep_textfile)
@@ -4,27 +4,139 @@ import numpy as np
 from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
 import os
 import sys
+import time
+import hashlib
+import json
+import itertools
+import weakref
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from scipy import sparse
 import scipy.sparse.linalg as linalg_sp
 from scipy.sparse import vstack, hstack, coo_matrix, csc_matrix
+from scipy.spatial import cKDTree
+from solver_functions import *
+from bundle_functions import *
 
 ###     Input/Output    ###
-def readvtk(filename):
-    """Read VTK file"""
-    reader = vtk.vtkPolyDataReader()
+# Format of all the meshes written by writevtk / writevtp, selected once per pipeline run (set_output_format or the
+# LA_OUTPUT_FORMAT environment variable, inherited by the stage scripts launched from a batch run)
+OUTPUT_FORMATS = ['binary', 'ascii', 'zlib', 'lz4']
+_output_format = os.environ.get('LA_OUTPUT_FORMAT', 'zlib')
+
+def set_output_format(fmt):
+    """Set the format of the output meshes: 'zlib' (default) or 'lz4' (VTK XML with appended compressed data, also for
+    .vtk files; readvtk reads both), 'binary' (legacy binary .vtk, raw appended .vtp) or 'ascii'"""
+    global _output_format
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format ' + str(fmt) + ', use one of: ' + ', '.join(OUTPUT_FORMATS))
+    _output_format = fmt
+    os.environ['LA_OUTPUT_FORMAT'] = fmt
+
+def get_output_format():
+    """Current format of the output meshes (see set_output_format)"""
+    return _output_format
+
+def is_xml_file(filename):
+    """True if filename is a VTK XML file (whatever the extension), False for legacy VTK files"""
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as f:
+        head = f.read(64).lstrip()
+    return head.startswith(b'<?xml') or head.startswith(b'<VTKFile')
+
+def readvtk(filename, arrays=None, exclude=None):
+    """Read VTK file (legacy or XML content, or sidecar mesh stored in the case bundle). Memory-mapped from the mesh
+    cache if it is enabled and up to date (see set_mesh_cache).
+    arrays: names of the point arrays to read (None: all), exclude: names of point arrays not to read. The other point
+    arrays can be added later with load_remaining_arrays"""
+    if in_bundle(filename):
+        return read_bundled_polydata(filename, arrays, exclude)
+    polydata = read_cached_polydata(filename, arrays, exclude)
+    if polydata is not None:
+        return polydata
+    if is_xml_file(filename):
+        return readvtp(filename, arrays, exclude)
+    reader = vtk.vtkPolyDataReader()   # legacy files can not skip arrays while parsing, they are removed after
     reader.SetFileName(filename)
     reader.Update()
-    return reader.GetOutput()
-
-def readvtp(filename):
-    """Read VTP file"""
+    save_mesh_cache(reader.GetOutput(), filename)
+    return select_point_arrays(reader.GetOutput(), arrays, exclude)
+
+def readvtp(filename, arrays=None, exclude=None):
+    """Read VTP file (or sidecar mesh stored in the case bundle, or memory-mapped from the mesh cache). Only the point
+    arrays selected by arrays / exclude are read (see readvtk)"""
+    if in_bundle(filename):
+        return read_bundled_polydata(filename, arrays, exclude)
+    polydata = read_cached_polydata(filename, arrays, exclude)
+    if polydata is not None:
+        return polydata
     reader = vtk.vtkXMLPolyDataReader()
     reader.SetFileName(filename)
+    if not get_mesh_cache():   # skip parsing the arrays not selected (the cache keeps all of them)
+        reader.UpdateInformation()
+        selection = reader.GetPointDataArraySelection()
+        for i in range(selection.GetNumberOfArrays()):
+            if not point_array_selected(selection.GetArrayName(i), arrays, exclude):
+                selection.DisableArray(selection.GetArrayName(i))
+    reader.Update()
+    save_mesh_cache(reader.GetOutput(), filename)
+    return select_point_arrays(reader.GetOutput(), arrays, exclude)
+
+def load_remaining_arrays(polydata, filename):
+    """Add to polydata the point arrays of mesh filename it does not have yet (e.g. skipped when reading it with
+    readvtk(filename, arrays=...)). polydata must have the same points as filename"""
+    data = polydata.GetPointData()
+    loaded = [data.GetArrayName(i) for i in range(data.GetNumberOfArrays())]
+    full = readvtk(filename, exclude=loaded)
+    if full.GetNumberOfPoints() != polydata.GetNumberOfPoints():
+        raise ValueError('Mesh ' + filename + ' does not have the same points, its arrays can not be added')
+    for i in range(full.GetPointData().GetNumberOfArrays()):
+        data.AddArray(full.GetPointData().GetArray(i))
+    return polydata
+
+def read_polydata_bytes(data):
+    """Parse the content of a VTK file (legacy or XML) already in memory"""
+    head = data[0:64].lstrip()
+    if head.startswith(b'<?xml') or head.startswith(b'<VTKFile'):
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.ReadFromInputStringOn()
+        reader.SetInputString(data)
+    else:
+        reader = vtk.vtkPolyDataReader()
+        reader.ReadFromInputStringOn()
+        reader.SetBinaryInputString(data, len(data))
     reader.Update()
     return reader.GetOutput()
 
-def writevtk(surface, filename, type='ascii'):
-    """Write binary or ascii VTK file"""
+def readvtk_concurrent(filenames, max_workers=8):
+    """Read several meshes at the same time on a thread pool, the list of polydata in the same order. The files are read
+    in Python (releases the GIL while waiting for the storage, e.g. network shares) and parsed from memory. Meshes in
+    the case bundle or the mesh cache are read with readvtk"""
+    def read(filename):
+        if in_bundle(filename) or get_mesh_cache():
+            return readvtk(filename)
+        with open(filename, 'rb') as f:
+            return read_polydata_bytes(f.read())
+    if len(filenames) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(filenames))) as pool:
+        return list(pool.map(read, filenames))
+
+def writevtk(surface, filename, type=None, legacy=False):
+    """Write binary, ascii or compressed VTK file (type None: output format of the run, see set_output_format).
+    legacy=True: always legacy VTK (binary if the run format is compressed), for files read by external tools.
+    Sidecar meshes go to the case bundle if it is enabled (see set_case_bundle)"""
+    if to_bundle(filename) and not legacy:
+        write_bundled_polydata(surface, filename)
+        return
+    if type is None:
+        type = _output_format
+    if legacy and type in ['zlib', 'lz4']:
+        type = 'binary'
+    if type in ['zlib', 'lz4']:   # the legacy format has no compression
+        writevtp(surface, filename, type)
+        return
     writer = vtk.vtkPolyDataWriter()
     writer.SetInputData(surface)
     writer.SetFileName(filename)
@@ -33,14 +145,32 @@ def writevtk(surface, filename, type='ascii'):
     elif type == 'binary':
         writer.SetFileTypeToBinary()
     writer.Write()
-
-def writevtp(surface, filename):
-    """Write VTP file"""
+    save_mesh_cache(surface, filename)
+
+def writevtp(surface, filename, type=None):
+    """Write VTP file (type None: output format of the run, see set_output_format). Sidecar meshes go to the case
+    bundle if it is enabled (see set_case_bundle)"""
+    if to_bundle(filename):
+        write_bundled_polydata(surface, filename)
+        return
+    if type is None:
+        type = _output_format
     writer = vtk.vtkXMLPolyDataWriter()
     writer.SetInputData(surface)
     writer.SetFileName(filename)
-#    writer.SetDataModeToBinary()
+    if type == 'ascii':
+        writer.SetDataModeToAscii()
+    else:
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+        if type == 'zlib':
+            writer.SetCompressorTypeToZLib()
+        elif type == 'lz4':
+            writer.SetCompressorTypeToLZ4()
+        else:
+            writer.SetCompressorTypeToNone()
     writer.Write()
+    save_mesh_cache(surface, filename)
 
 ###     Math    ###
 def euclideandistance(point1, point2):
@@ -181,7 +311,7 @@ def pointset_centreofmass(polydata):
 def seeds_to_csv(seedsfile, arrayname, labels, outfile):
     """Read seeds from VTP file, write coordinates in csv"""
     # f = open(outfile, 'wb')
-    f = open(outfile, 'w')
+    f = open_case_file(outfile, 'w')
     allseeds = readvtp(seedsfile)
     for l in labels:
         currentseeds = pointthreshold(allseeds, arrayname, l, l, 0)
@@ -249,9 +379,34 @@ def extractcells(polydata, idlist):
     geometry.Update()
     return geometry.GetOutput()
 
-def extractboundaryedge(polydata):
+ORIGINAL_IDS = 'vtkOriginalPointIds'   # point array with the id of each point in the mesh it was extracted from
+
+def with_original_ids(polydata):
+    """Shallow copy of polydata with the id of each point in the ORIGINAL_IDS point array. The filters (thresholds,
+    edges, connectivity...) carry it to their outputs, see original_point_ids"""
+    copy = vtk.vtkPolyData()
+    copy.ShallowCopy(polydata)
+    ids = numpy_to_vtk(np.arange(polydata.GetNumberOfPoints(), dtype=np.int64), deep=1, array_type=vtk.VTK_ID_TYPE)
+    ids.SetName(ORIGINAL_IDS)
+    copy.GetPointData().AddArray(ids)
+    return copy
+
+def original_point_ids(polydata, mesh):
+    """Id in mesh of each point of polydata (contour, path, threshold... extracted from mesh). Array lookup of the
+    ORIGINAL_IDS point array if it matches mesh exactly (same coordinates), closest point of mesh otherwise"""
+    points = ExtractVTKPoints(polydata)
+    array = polydata.GetPointData().GetArray(ORIGINAL_IDS)
+    if array is not None and array.GetNumberOfTuples() == points.shape[0]:
+        ids = vtk_to_numpy(array).astype(np.int64)
+        if ids.size == 0 or (ids.min() >= 0 and ids.max() < mesh.GetNumberOfPoints() and
+                             np.array_equal(ExtractVTKPoints(mesh)[ids], points)):
+            return ids
+    return closest_point_ids(mesh, polydata)
+
+def extractboundaryedge(polydata, original_ids=False):
+    """Boundary edges of polydata. With original_ids, the ORIGINAL_IDS point array has their ids in polydata"""
     edge = vtk.vtkFeatureEdges()
-    edge.SetInputData(polydata)
+    edge.SetInputData(with_original_ids(polydata) if original_ids else polydata)
     edge.FeatureEdgesOff()
     edge.NonManifoldEdgesOff()
     edge.Update()
@@ -342,7 +497,8 @@ def get_connected_edges(polydata):
     return connect
 
 def find_create_path(mesh, p1, p2):
-    """Get shortest path (using Dijkstra algorithm) between p1 and p2 on the mesh. Returns a polydata"""
+    """Get shortest path (using Dijkstra algorithm) between p1 and p2 on the mesh. Returns a polydata, with the ids of its
+    points in mesh in the ORIGINAL_IDS point array"""
     dijkstra = vtk.vtkDijkstraGraphGeodesicPath()
     # (VTK 9.1 and later...) The Dijkistra interpolator will not accept cells that aren't triangles
     if (vtk.vtkVersion.GetVTKMajorVersion() >= 9):
@@ -357,7 +513,15 @@ def find_create_path(mesh, p1, p2):
     dijkstra.SetStartVertex(p1)
     dijkstra.SetEndVertex(p2)
     dijkstra.Update()
-    return dijkstra.GetOutput()
+    path = dijkstra.GetOutput()
+    # ids of the path points in mesh (same points in the triangulated mesh)
+    idlist = dijkstra.GetIdList()
+    ids = np.array([idlist.GetId(i) for i in range(idlist.GetNumberOfIds())], dtype=np.int64)
+    if ids.size == path.GetNumberOfPoints():
+        ids_array = numpy_to_vtk(ids, deep=1, array_type=vtk.VTK_ID_TYPE)
+        ids_array.SetName(ORIGINAL_IDS)
+        path.GetPointData().AddArray(ids_array)
+    return path
 
 def compute_geodesic_distance(mesh, id_p1, id_p2):
     """Compute geodesic distance from point id_p1 to id_p2 on surface 'mesh'
@@ -372,33 +536,100 @@ def compute_geodesic_distance(mesh, id_p1, id_p2):
         total_dist = total_dist + dist
     return total_dist, path
 
-def transfer_array(ref, target, arrayname, targetarrayname):
-    """Transfer scalar array using closest point approximation"""
-    locator = vtk.vtkPointLocator()
-    locator.SetDataSet(ref)
-    locator.BuildLocator()
-
-    refarray = ref.GetPointData().GetArray(arrayname)  # get array from reference
-
-    numberofpoints = target.GetNumberOfPoints()
-    newarray = vtk.vtkDoubleArray()
+def kdtree_query(tree, points, k=1, workers=-1):
+    """Distances and ids of the k closest points of the cKDTree to each point, in a single batched query run in
+    parallel (workers threads, -1 uses all the cores)"""
+    try:
+        return tree.query(points, k=k, workers=workers)
+    except TypeError:   # scipy < 1.6
+        return tree.query(points, k=k, n_jobs=workers)
+
+def closest_point_ids(ref, target, workers=-1):
+    """Id of the closest point of ref to each point of target (as vtkPointLocator.FindClosestPoint point by point)"""
+    return kdtree_query(cKDTree(ExtractVTKPoints(ref)), ExtractVTKPoints(target), workers=workers)[1]
+
+def far_points_mask(points, ref, tol=0.05, workers=-1):
+    """Boolean mask of the points (n x 3 array or vtkPolyData) whose closest point in ref (array or vtkPolyData) is
+    farther than tol. Points with exactly the same coordinates as a point of ref are not queried (distance 0), the rest
+    are found with a single batched kd-tree query"""
+    if not isinstance(points, np.ndarray):
+        points = ExtractVTKPoints(points)
+    if not isinstance(ref, np.ndarray):
+        ref = ExtractVTKPoints(ref)
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    ref = np.ascontiguousarray(ref, dtype=np.float64)
+    mask = np.zeros(points.shape[0], dtype=bool)
+    if points.shape[0] == 0 or (points.shape == ref.shape and np.array_equal(points, ref)):
+        return mask
+    row = np.dtype((np.void, 3 * points.itemsize))   # exact match of the 3 coordinates
+    query = np.flatnonzero(~np.isin(points.view(row).ravel(), ref.view(row).ravel()))
+    if query.size > 0:
+        mask[query] = kdtree_query(cKDTree(ref), points[query], workers=workers)[0] > tol
+    return mask
+
+LABEL_ARRAYS = ['autolabels', 'GTLabels', 'pv', 'hole', 'mv', 'region']   # discrete, always transferred by closest point
+TRANSFER_METHODS = ['closest', 'barycentric']
+
+def interpolation_matrix(ref, target, cache_folder=None):
+    """Barycentric interpolation matrix from the points of ref (triangular mesh) to the points of target, see
+    barycentric_interpolation_matrix. If the mesh cache is on (set_mesh_cache) and cache_folder is given, the matrix is
+    saved in its .mesh_cache folder (keyed by the geometry of both meshes) and loaded instead of computed next time"""
+    vertex = ExtractVTKPoints(ref)
+    target_points = ExtractVTKPoints(target)
+    cache_file = None
+    if cache_folder is not None and get_mesh_cache():
+        cache_file = os.path.join(cache_folder, MESH_CACHE_DIR,
+                                  'interp_' + array_hash(vertex, ExtractVTKTriFaces(ref), target_points) + '.npz')
+        if os.path.isfile(cache_file):
+            try:
+                return sparse.load_npz(cache_file).tocsr()
+            except (IOError, OSError, ValueError):
+                pass
+    W = barycentric_interpolation_matrix(ref, target_points)
+    if cache_file is not None:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        tmp = cache_file + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            sparse.save_npz(f, W)
+        os.replace(tmp, cache_file)
+    return W
+
+def transfer_array(ref, target, arrayname, targetarrayname, mapping=None):
+    """Transfer scalar array using closest point approximation, or barycentric interpolation in the closest cell.
+    mapping: closest point of ref to each point of target (closest_point_ids) or interpolation matrix
+    (interpolation_matrix). Closest point ids are computed if not given. Compute it once to transfer several arrays
+    between the same meshes"""
+    if mapping is None:
+        mapping = closest_point_ids(ref, target)
+    refarray = vtk_to_numpy(ref.GetPointData().GetArray(arrayname))  # get array from reference
+    if sparse.issparse(mapping):
+        values = mapping.dot(refarray.astype(np.float64))
+    else:
+        values = refarray.ravel()[mapping].astype(np.float64)   # values, as GetValue
+    newarray = numpy_to_vtk(values)
     newarray.SetName(targetarrayname)
-    newarray.SetNumberOfTuples(numberofpoints)
     target.GetPointData().AddArray(newarray)
-
-    # go through each point of target surface, determine closest point on surface, copy value
-    for i in range(target.GetNumberOfPoints()):
-        point = target.GetPoint(i)
-        closestpoint_id = locator.FindClosestPoint(point)
-        value = refarray.GetValue(closestpoint_id)
-        newarray.SetValue(i, value)
     return target
 
-def transfer_all_scalar_arrays(m1, m2):
-    """ Transfer all scalar arrays from m1 to m2"""
+def transfer_all_scalar_arrays(m1, m2, method='closest', cache_folder=None):
+    """ Transfer all scalar arrays from m1 to m2 (the point mapping is computed only once).
+    method='barycentric' interpolates the continuous arrays (e.g. voltage, LAT) in the closest cell, the interpolation
+    matrix is cached in cache_folder (see interpolation_matrix). Label arrays (LABEL_ARRAYS and integer arrays) are
+    always transferred by closest point. Return the closest point ids"""
+    closest_ids = closest_point_ids(m1, m2)
+    mapping = closest_ids
+    if method == 'barycentric':
+        if IsTriangularMesh(m1):
+            mapping = interpolation_matrix(m1, m2, cache_folder)
+        else:
+            print('WARNING: non triangular mesh, transferring scalar arrays by closest point')
     for i in range(m1.GetPointData().GetNumberOfArrays()):
-        print('Transferring scalar array: {}'.format(m1.GetPointData().GetArray(i).GetName()))
-        transfer_array(m1, m2, m1.GetPointData().GetArray(i).GetName(), m1.GetPointData().GetArray(i).GetName())
+        name = m1.GetPointData().GetArray(i).GetName()
+        print('Transferring scalar array: {}'.format(name))
+        label = name in LABEL_ARRAYS or vtk_to_numpy(m1.GetPointData().GetArray(i)).dtype.kind in 'biu'
+        transfer_array(m1, m2, name, name, closest_ids if label else mapping)
+    return closest_ids
 
 def transfer_all_scalar_arrays_by_point_id(m1, m2):
     """ Transfer all scalar arrays from m1 to m2 by point id"""
@@ -492,6 +723,93 @@ def get_ordered_cont_ids_based_on_distance(mesh):
     list_ = np.argsort(dists).astype(int)
     return list_[0:len(list_)-1]    # skip last one, duplicated
 
+TEMPLATE_PARAMETERS = {'rdisk': 0.5, 'r_min': 0.03, 'laa_disp_x': 0.03, 'left_carina_length': 0.175,
+                       't_v5': np.pi / 8, 't_v6': 2 * np.pi - np.pi / 6, 't_v7': np.pi + np.pi / 6,
+                       't_v8': 3 * np.pi / 4 - np.pi / 40}
+
+def define_template(params=None):
+    """Position and radius of PV & LAA holes and disk of the 2D template. params: dict with values replacing the
+    defaults in TEMPLATE_PARAMETERS. Return a dict with the template geometry, the PV segments proportions and the
+    coordinates of the segments extremes (define_disk_template)"""
+    p = dict(TEMPLATE_PARAMETERS)
+    if params is not None:
+        unknown = set(params) - set(TEMPLATE_PARAMETERS)
+        if len(unknown) > 0:
+            raise ValueError('Unknown template parameters: ' + ', '.join(sorted(unknown)))
+        p.update(params)
+    t = {'rdisk': p['rdisk'], 't_v5': p['t_v5'], 't_v6': p['t_v6'], 't_v7': p['t_v7'], 't_v8': p['t_v8']}
+    r_min = p['r_min']
+    t['rhole_lipv'] = r_min
+    t['rhole_lspv'] = 1.1*r_min
+    t['rhole_ripv'] = 1.1*r_min
+    t['rhole_rspv'] = 1.35*r_min
+    t['rhole_laa'] = 1.35*r_min
+    laa_disp_x = p['laa_disp_x']  # displacement of LAA wrt LSPV (in x direction, to the left)
+
+    px_ref = -0.25
+    py_ref = -0.10
+    left_carina_length = p['left_carina_length']
+    right_carina_length = 1.5 * left_carina_length   # real proportions, do not separate more, it induces distortion close to the holes
+    pwall_width = 2.6 * left_carina_length
+    sep_lspv_laa = 1.2
+
+    pv_centers = np.zeros([2, 4])
+    # rspv
+    pv_centers[0, 0] = px_ref + pwall_width
+    pv_centers[1, 0] = py_ref + left_carina_length + (right_carina_length - left_carina_length) / 2
+    # ripv
+    pv_centers[0, 1] = px_ref + pwall_width
+    pv_centers[1, 1] = py_ref - (right_carina_length - left_carina_length) / 2
+    # lipv
+    pv_centers[0, 2] = px_ref
+    pv_centers[1, 2] = py_ref
+    # lspv
+    pv_centers[0, 3] = px_ref
+    pv_centers[1, 3] = py_ref + left_carina_length
+    # LAA
+    t['laa_hole_center_x'] = px_ref - laa_disp_x
+    t['laa_hole_center_y'] = py_ref + left_carina_length + left_carina_length * sep_lspv_laa  # si lipv esta en (-.25, -.10)
+    t['xhole_center'] = pv_centers[0, :]
+    t['yhole_center'] = pv_centers[1, :]
+
+    # define the proportion of points in each of the PV segments
+    alpha = np.arctan(np.divide(laa_disp_x, t['laa_hole_center_y'] - pv_centers[1, 3]))  # angle of the line connecting LSPV and LAA
+    t['proportions'] = define_pv_segments_proportions(p['t_v5'], p['t_v6'], p['t_v7'], alpha)
+    # define target coordinates in the disk
+    t['coordinates'] = define_disk_template(t['rdisk'], t['rhole_rspv'], t['rhole_ripv'], t['rhole_lipv'], t['rhole_lspv'],
+                                            t['rhole_laa'], t['xhole_center'], t['yhole_center'], t['laa_hole_center_x'],
+                                            t['laa_hole_center_y'], p['t_v5'], p['t_v6'], p['t_v7'], p['t_v8'])
+    return t
+
+def template_positions(t, s1, s2, s3, s4, s5, s6, s7, s8, s8a, s8b, s9size, s10size, s11size, s12size,
+                       pv_laa_segment_lengths, cut_laa=0):
+    """Target (x0, y0) positions of the boundary and of the constraint (division lines) points for template t
+    (define_template) according to the lengths of each segment. Return x0_bound, y0_bound, x0_const, y0_const"""
+    v1r_x, v1r_y, v1d_x, v1d_y, v1l_x, v1l_y, v2u_x, v2u_y, v2r_x, v2r_y, v2l_x, v2l_y, v3u_x, v3u_y, v3r_x, v3r_y, v3l_x, v3l_y, v4r_x, v4r_y, v4u_x, v4u_y, v4d_x, v4d_y, vlaad_x, vlaad_y, vlaau_x, vlaau_y, p5_x, p5_y, p6_x, p6_y, p7_x, p7_y, p8_x, p8_y = get_coords(t['coordinates'])
+    x0_const, y0_const = define_constraints_positions(s1, s2, s3, s4, s5, s6, s7, s8, s8a, s8b, v1l_x, v1l_y, v1d_x, v1d_y, v1r_x, v1r_y, v2l_x,
+                                     v2l_y, v2r_x, v2r_y, v2u_x, v2u_y, v3r_x, v3r_y, v3u_x, v3u_y, v3l_x, v3l_y,
+                                     v4r_x, v4r_y, v4u_x, v4u_y, v4d_x, v4d_y, vlaad_x, vlaad_y, vlaau_x, vlaau_y, p5_x,
+                                     p5_y, p6_x, p6_y, p7_x, p7_y, p8_x, p8_y, cut_laa)
+    x0_bound, y0_bound = define_boundary_positions(t['rdisk'], t['rhole_rspv'], t['rhole_ripv'], t['rhole_lipv'], t['rhole_lspv'], t['rhole_laa'],
+                                                   t['xhole_center'], t['yhole_center'], t['laa_hole_center_x'], t['laa_hole_center_y'],
+                                                   s9size, s10size, s11size, s12size, pv_laa_segment_lengths, t['t_v5'],
+                                                   t['t_v6'], t['t_v7'], t['t_v8'], cut_laa)
+    return x0_bound, y0_bound, x0_const, y0_const
+
+def read_template_sweep(filename):
+    """Read a template parameter sweep from a json file: either a list of settings (dicts of TEMPLATE_PARAMETERS) or a
+    dict {parameter: list of values} defining a grid (all combinations). Return the list of settings"""
+    with open(filename) as f:
+        sweep = json.load(f)
+    if isinstance(sweep, dict):
+        names = sorted(sweep)
+        sweep = [dict(zip(names, values)) for values in itertools.product(*[np.atleast_1d(sweep[k]).tolist() for k in names])]
+    for setting in sweep:
+        unknown = set(setting) - set(TEMPLATE_PARAMETERS)
+        if len(unknown) > 0:
+            raise ValueError('Unknown template parameters in ' + filename + ': ' + ', '.join(sorted(unknown)))
+    return sweep
+
 def define_pv_segments_proportions(t_v5, t_v6, t_v7, alpha):
     """define number of points of each pv hole segment to ensure appropriate distribution"""
     props = np.zeros([4, 3])
@@ -584,7 +902,7 @@ def get_coords(c):
 def extract_LA_contours(m_open, filename, save=False, cut_laa=0):
     """Given LA with clipped PVs, LAA and MV identify and classify all 5 contours using 'autolabels' array.
     Save contours if save=True"""
-    edges = extractboundaryedge(m_open)
+    edges = extractboundaryedge(m_open, original_ids=True)   # contour ids in m_open, see original_point_ids
     conn = get_connected_edges(edges)
     poly_edges = conn.GetOutput()
     if save==True:
@@ -611,7 +929,7 @@ def extract_LA_contours(m_open, filename, save=False, cut_laa=0):
             if save == True:
                 #check if file exists BEFORE WRITING
                 
-                if not os.path.isfile(filename[0:len(filename) - 4] + '_cont_mv.vtk'):
+                if not case_file_exists(filename[0:len(filename) - 4] + '_cont_mv.vtk'):
                 
                     writevtk(c, filename[0:len(filename) - 4] + '_cont_mv.vtk')
                 else:
@@ -621,7 +939,7 @@ def extract_LA_contours(m_open, filename, save=False, cut_laa=0):
             print('Detected LAA')
             if save == True:
                 #check if file exists BEFORE WRITING
-                if not os.path.isfile(filename[0:len(filename) - 4] + '_cont_laa.vtk'):
+                if not case_file_exists(filename[0:len(filename) - 4] + '_cont_laa.vtk'):
                     writevtk(c, filename[0:len(filename) - 4] + '_cont_laa.vtk')
                 else:
                     writevtk(c, filename[0:len(filename) - 4] + str(i) + '_cont_laa.vtk')
@@ -630,7 +948,7 @@ def extract_LA_contours(m_open, filename, save=False, cut_laa=0):
             print('Detected RSPV')
             if save == True:
                 #check if file exists BEFORE WRITING
-                if not os.path.isfile(filename[0:len(filename) - 4] + '_cont_rspv.vtk'):
+                if not case_file_exists(filename[0:len(filename) - 4] + '_cont_rspv.vtk'):
                     writevtk(c, filename[0:len(filename) - 4] + '_cont_rspv.vtk')
                 else:
                     writevtk(c, filename[0:len(filename) - 4] + str(i) + '_cont_rspv.vtk')
@@ -639,7 +957,7 @@ def extract_LA_contours(m_open, filename, save=False, cut_laa=0):
             print('Detected RIPV')
             if save == True:
                 #check if file exists BEFORE WRITING
-                if not os.path.isfile(filename[0:len(filename) - 4] + '_cont_ripv.vtk'):
+                if not case_file_exists(filename[0:len(filename) - 4] + '_cont_ripv.vtk'):
                     writevtk(c, filename[0:len(filename) - 4] + '_cont_ripv.vtk')
                 else:
                     writevtk(c, filename[0:len(filename) - 4] + str(i) + '_cont_ripv.vtk')
@@ -648,7 +966,7 @@ def extract_LA_contours(m_open, filename, save=False, cut_laa=0):
             print('Detected LSPV')
             if save == True:
                 #check if file exists BEFORE WRITING
-                if not os.path.isfile(filename[0:len(filename) - 4] + '_cont_lspv.vtk'):
+                if not case_file_exists(filename[0:len(filename) - 4] + '_cont_lspv.vtk'):
                     writevtk(c, filename[0:len(filename) - 4] + '_cont_lspv.vtk')
                 else:
                     writevtk(c, filename[0:len(filename) - 4] + str(i) + '_cont_lspv.vtk')
@@ -657,7 +975,7 @@ def extract_LA_contours(m_open, filename, save=False, cut_laa=0):
             print('Detected LIPV')
             if save == True:
                 #check if file exists BEFORE WRITING
-                if not os.path.isfile(filename[0:len(filename) - 4] + '_cont_lipv.vtk'):
+                if not case_file_exists(filename[0:len(filename) - 4] + '_cont_lipv.vtk'):
                     writevtk(c, filename[0:len(filename) - 4] + '_cont_lipv.vtk')
                 else:
                     writevtk(c, filename[0:len(filename) - 4] + str(i) + '_cont_lipv.vtk')
@@ -670,92 +988,111 @@ def extract_LA_contours(m_open, filename, save=False, cut_laa=0):
     else:
         return cont_rspv, cont_ripv, cont_lipv, cont_lspv, cont_mv
 
-def build_locators(mesh, m_open, cont_rspv, cont_ripv, cont_lipv, cont_lspv, cont_laa, cut_laa=0):
-    """Build different locators to find corresponding points between different meshes (open/closed, open/contours, etc)"""
+_locators = {}   # id(dataset) -> (weak reference to dataset, vtkPointLocator), see get_locator
+
+def get_locator(dataset):
+    """vtkPointLocator of dataset, built the first time it is requested and shared afterwards (registry keyed by dataset
+    identity). Rebuilt if the dataset was modified since. The registry only keeps weak references: a locator is
+    released with its dataset. clear_locators() releases them all"""
+    key = id(dataset)
+    entry = _locators.get(key)
+    if entry is not None and entry[0]() is dataset:
+        entry[1].Update()   # no-op unless the dataset changed
+        return entry[1]
     locator = vtk.vtkPointLocator()
-    locator.SetDataSet(mesh)  # clipped + CLOSED - where the seeds are marked
+    locator.SetDataSet(dataset)
     locator.BuildLocator()
 
-    locator_open = vtk.vtkPointLocator()
-    locator_open.SetDataSet(m_open)
-    locator_open.BuildLocator()
+    def forget(ref):   # dataset deleted, before its id can be reused
+        if _locators.get(key, (None,))[0] is ref:
+            del _locators[key]
+    _locators[key] = (weakref.ref(dataset, forget), locator)
+    return locator
+
+def clear_locators():
+    """Remove all the locators of the get_locator registry"""
+    _locators.clear()
 
-    locator_rspv = vtk.vtkPointLocator()
-    locator_rspv.SetDataSet(cont_rspv)
-    locator_rspv.BuildLocator()
+class LazyLocator(object):
+    """Stand-in for the vtkPointLocator of dataset, taken from the get_locator registry on first use"""
+    __slots__ = ['dataset']
 
-    locator_ripv = vtk.vtkPointLocator()
-    locator_ripv.SetDataSet(cont_ripv)
-    locator_ripv.BuildLocator()
+    def __init__(self, dataset):
+        self.dataset = dataset
 
-    locator_lipv = vtk.vtkPointLocator()
-    locator_lipv.SetDataSet(cont_lipv)
-    locator_lipv.BuildLocator()
+    def GetDataSet(self):
+        return self.dataset   # without building the locator
 
-    locator_lspv = vtk.vtkPointLocator()
-    locator_lspv.SetDataSet(cont_lspv)
-    locator_lspv.BuildLocator()
+    def __getattr__(self, name):
+        return getattr(get_locator(self.dataset), name)
+
+
+def build_locators(mesh, m_open, cont_rspv, cont_ripv, cont_lipv, cont_lspv, cont_laa, cut_laa=0):
+    """Locators to find corresponding points between different meshes (open/closed, open/contours, etc). Each one is
+    built when first used and shared with the other functions using get_locator on the same mesh"""
+    locator = LazyLocator(mesh)  # clipped + CLOSED - where the seeds are marked
+    locator_open = LazyLocator(m_open)
+    locator_rspv = LazyLocator(cont_rspv)
+    locator_ripv = LazyLocator(cont_ripv)
+    locator_lipv = LazyLocator(cont_lipv)
+    locator_lspv = LazyLocator(cont_lspv)
     if cut_laa == 0:
-        locator_laa = vtk.vtkPointLocator()
-        locator_laa.SetDataSet(cont_laa)
-        locator_laa.BuildLocator()
+        locator_laa = LazyLocator(cont_laa)
     else:
         locator_laa = None
-        
+
     return locator, locator_open, locator_rspv, locator_ripv, locator_lipv, locator_lspv, locator_laa
 
 
-def read_paths(filename, npaths, cut_laa=0):
-    """read the paths (lines) defined in the 3D mesh using 3_divide_LA.py"""
-    for i in range(npaths):
-        if os.path.isfile(filename[0:len(filename)-4]+'path'+ str(i+1) +'.vtk')==False:
-            sys.exit('ERROR: dividing line path' + str(i+1) + ' not found. Run 3_divide_LA.py')
-        else:
-            if i == 0:
-                path1 = readvtk(filename[0:len(filename) - 4] + 'path' + str(i + 1) + '.vtk')
-            elif i == 1:
-                path2 = readvtk(filename[0:len(filename) - 4] + 'path' + str(i + 1) + '.vtk')
-            elif i == 2:
-                path3 = readvtk(filename[0:len(filename) - 4] + 'path' + str(i + 1) + '.vtk')
-            elif i == 3:
-                path4 = readvtk(filename[0:len(filename) - 4] + 'path' + str(i + 1) + '.vtk')
-            elif i == 4:
-                path5 = readvtk(filename[0:len(filename) - 4] + 'path' + str(i + 1) + '.vtk')
-            elif i == 5:
-                path6 = readvtk(filename[0:len(filename) - 4] + 'path' + str(i + 1) + '.vtk')
-            elif i == 6:
-                path7 = readvtk(filename[0:len(filename) - 4] + 'path' + str(i + 1) + '.vtk')
-    # read laa related paths: line from lspv to laa and from laa to mv
-    if cut_laa == 0:
-        if os.path.isfile(filename[0:len(filename)-4] + 'path_laa1.vtk')==False:
-            sys.exit('ERROR: dividing line path_laa1 not found. Run 3_divide_LA.py')
-        else:
-            path_laa1 = readvtk(filename[0:len(filename)-4] + 'path_laa1.vtk')
+LAContours = namedtuple('LAContours', ['rspv', 'ripv', 'lipv', 'lspv', 'mv', 'laa'])
+LAPaths = namedtuple('LAPaths', ['path1', 'path2', 'path3', 'path4', 'path5', 'path6', 'path7', 'path_laa1', 'path_laa2',
+                                 'path_laa3', 'path8'])
 
-        if os.path.isfile(filename[0:len(filename)-4] + 'path_laa2.vtk')==False:
-            sys.exit('ERROR: dividing line path_laa2 not found. Run 3_divide_LA.py')
-        else:
-            path_laa2 = readvtk(filename[0:len(filename)-4] + 'path_laa2.vtk')
+def contour_filenames(filename, cut_laa=0):
+    """Files with the contours saved by extract_LA_contours (LAContours fields, None if not used)"""
+    names = [filename[0:len(filename) - 4] + '_cont_' + c + '.vtk' for c in LAContours._fields]
+    if cut_laa == 1:
+        names[-1] = None
+    return LAContours(*names)
 
-        if os.path.isfile(filename[0:len(filename)-4] + 'path_laa3.vtk')==False:
-            sys.exit('ERROR: dividing line path_laa3 not found. Run 3_divide_LA.py')
-        else:
-            path_laa3 = readvtk(filename[0:len(filename)-4] + 'path_laa3.vtk')
-        path8 = None
+def path_filenames(filename, npaths, cut_laa=0):
+    """Files with the paths (lines) created by 3_divide_LA.py (LAPaths fields, None if not used)"""
+    names = [filename[0:len(filename) - 4] + 'path' + str(i + 1) + '.vtk' if i < npaths else None for i in range(7)]
+    if cut_laa == 0:
+        names += [filename[0:len(filename) - 4] + 'path_laa' + str(i) + '.vtk' for i in [1, 2, 3]] + [None]
     else:
-        path_laa1 = None
-        path_laa2 = None
-        path_laa3 = None
-        path8 = readvtk(filename[0:len(filename)-4] + 'path8.vtk')
-    return path1, path2, path3, path4, path5, path6, path7, path_laa1, path_laa2, path_laa3, path8
+        names += [None, None, None, filename[0:len(filename) - 4] + 'path8.vtk']
+    return LAPaths(*names)
+
+def read_contours(filename, cut_laa=0):
+    """read the contours saved by extract_LA_contours (LAContours, laa is None if cut_laa=1)"""
+    return read_flat_inputs(filename, 0, cut_laa)[0]
+
+def read_paths(filename, npaths, cut_laa=0):
+    """read the paths (lines) defined in the 3D mesh using 3_divide_LA.py (LAPaths, unused paths are None)"""
+    return read_flat_inputs(filename, npaths, cut_laa, contours=False)[1]
+
+def read_flat_inputs(filename, npaths, cut_laa=0, contours=True):
+    """read the contours (if contours=True) and paths of the case of mesh filename, all files at the same time
+    (readvtk_concurrent). Return LAContours (None if contours=False) and LAPaths (None if npaths=0)"""
+    conts = contour_filenames(filename, cut_laa) if contours else LAContours(*[None] * 6)
+    paths = path_filenames(filename, npaths, cut_laa) if npaths > 0 else LAPaths(*[None] * 11)
+    for field, f in zip(conts._fields, conts):
+        if f is not None and not case_file_exists(f):
+            sys.exit('ERROR: ' + field.upper() + ' contour not found. Run without --countors to extract it')
+    for field, f in zip(paths._fields, paths):
+        if f is not None and not case_file_exists(f):
+            sys.exit('ERROR: dividing line ' + field + ' not found. Run 3_divide_LA.py')
+    files = [f for f in conts + paths if f is not None]
+    meshes = dict(zip(files, readvtk_concurrent(files)))
+    conts = LAContours(*[meshes.get(f) for f in conts]) if contours else None
+    paths = LAPaths(*[meshes.get(f) for f in paths]) if npaths > 0 else None
+    return conts, paths
 
 def get_mv_contour_ids(cont_mv, locator_open):
     """Obtain ids of the MV contour"""
     edge_cont_ids = get_ordered_cont_ids_based_on_distance(cont_mv)
-    mv_cont_ids = np.zeros(edge_cont_ids.size)
-    for i in range(mv_cont_ids.shape[0]):
-        p = cont_mv.GetPoint(edge_cont_ids[i])
-        mv_cont_ids[i] = locator_open.FindClosestPoint(p)
+    mv_cont_ids = original_point_ids(cont_mv, locator_open.GetDataSet())[edge_cont_ids.astype(int)].astype(float)
     return mv_cont_ids
 
 def identify_segments_extremes(path1, path2, path3, path4, path5, path6, path7, path8, path_laa1, path_laa2, path_laa3,
@@ -890,18 +1227,13 @@ def get_rspv_segments_ids(cont_rspv, locator_open, v1l, v1d, v1r, propn_rspv_s1,
     """ Return 3 arrays with ids of each of the 3 segments in rspv contour.
         Return also the modified (to have proportional number of points in the segments) extreme ids"""
     edge_cont_rspv = get_ordered_cont_ids_based_on_distance(cont_rspv)
-    rspv_cont_ids = np.zeros(edge_cont_rspv.size)
-    for i in range(rspv_cont_ids.shape[0]):
-        p = cont_rspv.GetPoint(edge_cont_rspv[i])
-        rspv_cont_ids[i] = locator_open.FindClosestPoint(p)
+    rspv_cont_ids = original_point_ids(cont_rspv, locator_open.GetDataSet())[edge_cont_rspv.astype(int)].astype(float)
     try:
         pos_v1l = int(np.where(rspv_cont_ids == v1l)[0])
     except:        
         # find closest point in countor to v1l
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_rspv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_rspv)
         pos_v1l = locator_countor.FindClosestPoint(m_open.GetPoint(v1l))
         # p_v1l = m_open.GetPoint(locator_open.FindClosestPoint(v1l))
         # pos_v1l = np.argmin(np.abs(rspv_cont_ids - locator_open.FindClosestPoint(p_v1l)))
@@ -913,9 +1245,7 @@ def get_rspv_segments_ids(cont_rspv, locator_open, v1l, v1d, v1r, propn_rspv_s1,
         pos_v1r = int(np.where(rspv_ids == v1r)[0])
         
     except:
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_rspv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_rspv)
         pos_v1r = locator_countor.FindClosestPoint(m_open.GetPoint(v1r))
         
     if pos_v1r < pos_v1d:   # flip
@@ -931,9 +1261,7 @@ def get_rspv_segments_ids(cont_rspv, locator_open, v1l, v1d, v1r, propn_rspv_s1,
     except:
         # find closest point in countor to v1r
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_rspv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_rspv)
         pos_v1r = locator_countor.FindClosestPoint(m_open.GetPoint(v1r))
         rspv_s2 = rspv_ids[int(np.where(rspv_ids == v1d)[0]): pos_v1r]
     # rspv_s3 = rspv_ids[int(np.where(rspv_ids == v1r)[0]): rspv_ids.size]
@@ -970,18 +1298,13 @@ def get_ripv_segments_ids(cont_ripv, locator_open, v2l, v2r, v2u, propn_ripv_s1,
     """ Return 3 arrays with ids of each of the 3 segments in ripv contour.
         Return also the modified (to have proportional number of points in the segments) extreme ids"""
     edge_cont_ripv = get_ordered_cont_ids_based_on_distance(cont_ripv)
-    ripv_cont_ids = np.zeros(edge_cont_ripv.size)
-    for i in range(ripv_cont_ids.shape[0]):
-        p = cont_ripv.GetPoint(edge_cont_ripv[i])
-        ripv_cont_ids[i] = locator_open.FindClosestPoint(p)
+    ripv_cont_ids = original_point_ids(cont_ripv, locator_open.GetDataSet())[edge_cont_ripv.astype(int)].astype(float)
     try:
         pos_v2l = int(np.where(ripv_cont_ids == v2l)[0])
     except:
         # find closest point in countor to v2l
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_ripv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_ripv)
         pos_v2l = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v2l))
         # p_v2l = m_open.GetPoint(locator_open.FindClosestPoint(v2l))
         # pos_v2l = np.argmin(np.abs(ripv_cont_ids - locator_open.FindClosestPoint(p_v2l)))
@@ -992,9 +1315,7 @@ def get_ripv_segments_ids(cont_ripv, locator_open, v2l, v2r, v2u, propn_ripv_s1,
         
         # find closest point in countor to v2r
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_ripv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_ripv)
         pos_v2r = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v2r))
         # p_v2r = m_open.GetPoint(locator_open.FindClosestPoint(v2r))
         # pos_v2r = np.argmin(np.abs(ripv_ids - locator_open.FindClosestPoint(p_v2r)))
@@ -1010,9 +1331,7 @@ def get_ripv_segments_ids(cont_ripv, locator_open, v2l, v2r, v2u, propn_ripv_s1,
     except:
         # find closest point in countor to v2r
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_ripv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_ripv)
         pos_v2r = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v2r))
         ripv_s1 = ripv_ids[0:int(pos_v2r)]
     try:
@@ -1020,17 +1339,13 @@ def get_ripv_segments_ids(cont_ripv, locator_open, v2l, v2r, v2u, propn_ripv_s1,
     except:
         # find closest point in countor to v2u
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_ripv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_ripv)
         pos_v2u = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v2u))
         try:
             ripv_s2 = ripv_ids[int(np.where(ripv_ids == v2r)[0]): pos_v2u]
         except:
             # find closest point in countor to v2r
-            locator_countor = vtk.vtkPointLocator()
-            locator_countor.SetDataSet(cont_ripv)
-            locator_countor.BuildLocator()
+            locator_countor = get_locator(cont_ripv)
             pos_v2r = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v2r))
             ripv_s2 = ripv_ids[int(pos_v2r): int(pos_v2u)]
     # ripv_s3 = ripv_ids[int(np.where(ripv_ids == v2u)[0]): ripv_ids.size]
@@ -1067,18 +1382,13 @@ def get_lipv_segments_ids(cont_lipv, locator_open, v3r, v3u, v3l, propn_lipv_s1,
     """ Return 3 arrays with ids of each of the 3 segments in lipv contour.
         Return also the modified (to have proportional number of points in the segments) extreme ids"""
     edge_cont_lipv = get_ordered_cont_ids_based_on_distance(cont_lipv)
-    lipv_cont_ids = np.zeros(edge_cont_lipv.size)
-    for i in range(lipv_cont_ids.shape[0]):
-        p = cont_lipv.GetPoint(edge_cont_lipv[i])
-        lipv_cont_ids[i] = locator_open.FindClosestPoint(p)
+    lipv_cont_ids = original_point_ids(cont_lipv, locator_open.GetDataSet())[edge_cont_lipv.astype(int)].astype(float)
     try:
         pos_v3r = int(np.where(lipv_cont_ids == v3r)[0])
     except:
         # find closest point in countor to v3r
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_lipv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_lipv)
         pos_v3r = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v3r))
         # p_v3r = m_open.GetPoint(locator_open.FindClosestPoint(v3r))
         # pos_v3r = np.argmin(np.abs(lipv_cont_ids - locator_open.FindClosestPoint(p_v3r)))
@@ -1088,9 +1398,7 @@ def get_lipv_segments_ids(cont_lipv, locator_open, v3r, v3u, v3l, propn_lipv_s1,
     except:
         # find closest point in countor to v3u
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_lipv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_lipv)
         pos_v3u = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v3u))
         # p_v3u = m_open.GetPoint(locator_open.FindClosestPoint(v3u))
         # pos_v3u = np.argmin(np.abs(lipv_ids - locator_open.FindClosestPoint(p_v3u)))
@@ -1099,9 +1407,7 @@ def get_lipv_segments_ids(cont_lipv, locator_open, v3r, v3u, v3l, propn_lipv_s1,
     except:
         # find closest point in countor to v3l
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_lipv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_lipv)
         pos_v3l = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v3l))
         # p_v3l = m_open.GetPoint(locator_open.FindClosestPoint(v3l))
         # pos_v3l = np.argmin(np.abs(lipv_ids - locator_open.FindClosestPoint(p_v3l)))
@@ -1116,9 +1422,7 @@ def get_lipv_segments_ids(cont_lipv, locator_open, v3r, v3u, v3l, propn_lipv_s1,
     except:
         # find closest point in countor to v3u
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_lipv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_lipv)
         pos_v3u = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v3u))
         lipv_s1 = lipv_ids[0:int(pos_v3u)]
     try:
@@ -1126,17 +1430,13 @@ def get_lipv_segments_ids(cont_lipv, locator_open, v3r, v3u, v3l, propn_lipv_s1,
     except:
         # find closest point in countor to v3l
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_lipv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_lipv)
         pos_v3l = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v3l))
         try:
             lipv_s2 = lipv_ids[int(np.where(lipv_ids == v3u)[0]): pos_v3l]
         except:
             # find closest point in countor to v3u
-            locator_countor = vtk.vtkPointLocator()
-            locator_countor.SetDataSet(cont_lipv)
-            locator_countor.BuildLocator()
+            locator_countor = get_locator(cont_lipv)
             pos_v3u = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v3u))
             lipv_s2 = lipv_ids[int(pos_v3u): int(pos_v3l)]
     # lipv_s3 = lipv_ids[int(np.where(lipv_ids == v3l)[0]): lipv_ids.size]
@@ -1173,18 +1473,13 @@ def get_lspv_segments_ids(cont_lspv, locator_open, v4r, v4u, v4d, propn_lspv_s1,
     """ Return 3 arrays with ids of each of the 3 segments in lspv contour.
         Return also the modified (to have proportional number of points in the segments) extreme ids"""
     edge_cont_lspv = get_ordered_cont_ids_based_on_distance(cont_lspv)
-    lspv_cont_ids = np.zeros(edge_cont_lspv.size)
-    for i in range(lspv_cont_ids.shape[0]):
-        p = cont_lspv.GetPoint(edge_cont_lspv[i])
-        lspv_cont_ids[i] = locator_open.FindClosestPoint(p)
+    lspv_cont_ids = original_point_ids(cont_lspv, locator_open.GetDataSet())[edge_cont_lspv.astype(int)].astype(float)
     try:
         pos_v4r = int(np.where(lspv_cont_ids == v4r)[0])
     except:
         # find closest point in countor to v4r
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_lspv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_lspv)
         pos_v4r = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v4r))
         # p_v4r = m_open.GetPoint(locator_open.FindClosestPoint(v4r))
         # pos_v4r = np.argmin(np.abs(lspv_cont_ids - locator_open.FindClosestPoint(p_v4r)))
@@ -1194,9 +1489,7 @@ def get_lspv_segments_ids(cont_lspv, locator_open, v4r, v4u, v4d, propn_lspv_s1,
     except:
         # find closest point in countor to v4u
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_lspv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_lspv)
         pos_v4u = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v4u))
         # p_v4u = m_open.GetPoint(locator_open.FindClosestPoint(v4u))
         # pos_v4u = np.argmin(np.abs(lspv_ids - locator_open.FindClosestPoint(p_v4u)))
@@ -1205,9 +1498,7 @@ def get_lspv_segments_ids(cont_lspv, locator_open, v4r, v4u, v4d, propn_lspv_s1,
     except:
         # find closest point in countor to v4d
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_lspv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_lspv)
         pos_v4d = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v4d))
         # p_v4d = m_open.GetPoint(locator_open.FindClosestPoint(v4d))
         # pos_v4d = np.argmin(np.abs(lspv_ids - locator_open.FindClosestPoint(p_v4d)))
@@ -1222,9 +1513,7 @@ def get_lspv_segments_ids(cont_lspv, locator_open, v4r, v4u, v4d, propn_lspv_s1,
     except:
         # find closest point in countor to v4u
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_lspv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_lspv)
         pos_v4u = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v4u))
         lspv_s1 = lspv_ids[0:int(pos_v4u)]
     try:
@@ -1232,17 +1521,13 @@ def get_lspv_segments_ids(cont_lspv, locator_open, v4r, v4u, v4d, propn_lspv_s1,
     except:
         # find closest point in countor to v4d
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_lspv)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_lspv)
         pos_v4d = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v4d))
         try:
             lspv_s2 = lspv_ids[int(np.where(lspv_ids == v4u)[0]): pos_v4d]
         except:
             # find closest point in countor to v4u
-            locator_countor = vtk.vtkPointLocator()
-            locator_countor.SetDataSet(cont_lspv)
-            locator_countor.BuildLocator()
+            locator_countor = get_locator(cont_lspv)
             pos_v4u = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(v4u))
             lspv_s2 = lspv_ids[int(pos_v4u): int(pos_v4d)]
     # lspv_s3 = lspv_ids[int(np.where(lspv_ids == v4d)[0]): lspv_ids.size]
@@ -1284,18 +1569,13 @@ def get_lspv_segments_ids(cont_lspv, locator_open, v4r, v4u, v4d, propn_lspv_s1,
 def get_laa_segments_ids(cont_laa, locator_open, vlaau, vlaad, vlaar):
     """ Return 2 arrays with ids of each of the 2 segments in LAA contour."""
     edge_cont_laa = get_ordered_cont_ids_based_on_distance(cont_laa)
-    laa_cont_ids = np.zeros(edge_cont_laa.size)
-    for i in range(laa_cont_ids.shape[0]):
-        p = cont_laa.GetPoint(edge_cont_laa[i])
-        laa_cont_ids[i] = locator_open.FindClosestPoint(p)
+    laa_cont_ids = original_point_ids(cont_laa, locator_open.GetDataSet())[edge_cont_laa.astype(int)].astype(float)
     try:
         pos_vlaad = int(np.where(laa_cont_ids == vlaad)[0])  # intersection of laa contour and path 8a (from lspv to laa)
     except:
         # find closest point in countor to vlaad
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_laa)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_laa)
         pos_vlaad = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(vlaad))
         # p_vlaad = m_open.GetPoint(locator_open.FindClosestPoint(vlaad))
         # pos_vlaad = np.argmin(np.abs(laa_cont_ids - locator_open.FindClosestPoint(p_vlaad)))
@@ -1305,9 +1585,7 @@ def get_laa_segments_ids(cont_laa, locator_open, vlaau, vlaad, vlaar):
     except:
         # find closest point in countor to vlaar
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_laa)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_laa)
         pos_vlaar = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(vlaar))
         # p_vlaar = m_open.GetPoint(locator_open.FindClosestPoint(vlaar))
         # pos_vlaar = np.argmin(np.abs(laa_ids - locator_open.FindClosestPoint(p_vlaar)))
@@ -1316,9 +1594,7 @@ def get_laa_segments_ids(cont_laa, locator_open, vlaau, vlaad, vlaar):
     except:
         # find closest point in countor to vlaau
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_laa)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_laa)
         pos_vlaau = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(vlaau))
         # p_vlaau = m_open.GetPoint(locator_open.FindClosestPoint(vlaau))
         # pos_vlaau = np.argmin(np.abs(laa_ids - locator_open.FindClosestPoint(p_vlaau)))
@@ -1333,9 +1609,7 @@ def get_laa_segments_ids(cont_laa, locator_open, vlaau, vlaad, vlaar):
     except:
         # find closest point in countor to vlaau
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_laa)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_laa)
         pos_vlaau = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(vlaau))
         laa_s1 = laa_ids[0:int(pos_vlaau)]
     try:
@@ -1343,18 +1617,13 @@ def get_laa_segments_ids(cont_laa, locator_open, vlaau, vlaad, vlaar):
     except:
         # find closest point in countor to vlaau
         # locator for contour
-        locator_countor = vtk.vtkPointLocator()
-        locator_countor.SetDataSet(cont_laa)
-        locator_countor.BuildLocator()
+        locator_countor = get_locator(cont_laa)
         pos_vlaau = locator_countor.FindClosestPoint(locator_open.GetDataSet().GetPoint(vlaau))
         laa_s2 = laa_ids[int(pos_vlaau):]
     return laa_ids, laa_s1, laa_s2
 
 def get_segment_ids_in_to_be_flat_mesh(path, locator, intersect_end, intersect_beginning):
-    s = np.zeros(path.GetNumberOfPoints())
-    for i in range(path.GetNumberOfPoints()):
-        p = path.GetPoint(i)
-        s[i] = int(locator.FindClosestPoint(p))
+    s = original_point_ids(path, locator.GetDataSet()).astype(float)
     intersect_wlast = np.intersect1d(s, intersect_end)   # find repeated values (s1 merges with rspv contour)
     nlasts_to_delete = len(intersect_wlast)
     index1 = np.arange(len(s) - nlasts_to_delete, len(s))
@@ -1659,30 +1928,56 @@ def define_constraints_positions(s1, s2, s3, s4, s5, s6, s7, s8, s8a, s8b, v1l_x
 
 
 def ExtractVTKPoints(mesh):
-    """Extract points from vtk structures. Return the Nx3 numpy.array of the vertices."""
-    n = mesh.GetNumberOfPoints()
-    vertex = np.zeros((n, 3))
-    for i in range(n):
-        mesh.GetPoint(i, vertex[i, :])
+    """Extract points from vtk structures. Return the Nx3 numpy.array of the vertices.
+    Zero-copy read-only view of the points buffer if the points are double (a float64 copy otherwise)"""
+    if mesh.GetPoints() is None:
+        return np.zeros((0, 3))
+    vertex = vtk_to_numpy(mesh.GetPoints().GetData())
+    if vertex.dtype != np.float64:
+        return vertex.astype(np.float64)
+    vertex.flags.writeable = False
     return vertex
 
 
+def _polys_connectivity(polys):
+    """Offsets and connectivity arrays (numpy views) of a vtkCellArray, also for the legacy (VTK < 9) layout"""
+    if hasattr(polys, 'GetConnectivityArray'):
+        return vtk_to_numpy(polys.GetOffsetsArray()), vtk_to_numpy(polys.GetConnectivityArray())
+    legacy = vtk_to_numpy(polys.GetData())   # [npts, id_0, ..., id_npts-1, npts, ...]
+    if legacy.size > 0 and np.all(legacy[0::4] == 3) and legacy.size == 4 * polys.GetNumberOfCells():
+        return np.arange(0, 3 * polys.GetNumberOfCells() + 1, 3), legacy.reshape(-1, 4)[:, 1:].ravel()
+    offsets = np.zeros(polys.GetNumberOfCells() + 1, dtype=np.int64)
+    pos = 0
+    for i in range(polys.GetNumberOfCells()):
+        offsets[i + 1] = offsets[i] + legacy[pos]
+        pos = pos + legacy[pos] + 1
+    return offsets, np.delete(legacy, offsets[:-1] + np.arange(offsets.size - 1))
+
+
+def IsTriangularMesh(mesh):
+    """True if all cells of the vtkPolyData are triangles (no vertices, lines or strips), without a per cell loop"""
+    polys = mesh.GetPolys()
+    if polys is None or mesh.GetNumberOfCells() != polys.GetNumberOfCells():
+        return False
+    offsets, _ = _polys_connectivity(polys)
+    return bool(np.all(np.diff(offsets) == 3))
+
+
 def ExtractVTKTriFaces(mesh):
-    """Extract triangular faces from vtkPolyData. Return the Nx3 numpy.array of the faces (make sure there are only triangles)."""
-    m = mesh.GetNumberOfCells()
-    faces = np.zeros((m, 3), dtype=int)
-    for i in range(m):
-        ptIDs = vtk.vtkIdList()
-        mesh.GetCellPoints(i, ptIDs)
-        if ptIDs.GetNumberOfIds() != 3:
-            raise Exception("Nontriangular cell!")
-        faces[i, 0] = ptIDs.GetId(0)
-        faces[i, 1] = ptIDs.GetId(1)
-        faces[i, 2] = ptIDs.GetId(2)
+    """Extract triangular faces from vtkPolyData. Return the Nx3 numpy.array of the faces (make sure there are only triangles).
+    Zero-copy read-only view of the connectivity buffer"""
+    if mesh.GetNumberOfCells() == 0:
+        return np.zeros((0, 3), dtype=int)
+    if not IsTriangularMesh(mesh):
+        raise Exception("Nontriangular cell!")
+    faces = _polys_connectivity(mesh.GetPolys())[1].reshape(-1, 3)
+    faces.flags.writeable = False
     return faces
 
 def DeleteNonTriangularFaces(mesh):
     """Delete non-triangular faces from vtkPolyData."""
+    if IsTriangularMesh(mesh):
+        return mesh
     m = mesh.GetNumberOfCells()
     to_delete = []
     # Initialize list to mark cells for deletion
@@ -1703,155 +1998,409 @@ def DeleteNonTriangularFaces(mesh):
         mesh.RemoveDeletedCells()
     return mesh
 
+###     Array-backed triangle mesh    ###
+
+class LAMesh(object):
+    """Triangle mesh stored as numpy arrays: points (n x 3, float32 or float64), triangles (m x 3, int32) and point /
+    cell attributes (dictionaries name -> array with n or m rows).
+    Point and cell selections work on masks, without VTK filters, and also return the original ids of the kept points
+    and cells. The vtkPolyData is built only when needed (to_polydata) and then kept, so do not modify the arrays in
+    place after converting"""
+    __slots__ = ['points', 'triangles', 'point_data', 'cell_data', '_polydata']
+
+    def __init__(self, points, triangles, point_data=None, cell_data=None):
+        self.points = np.asarray(points)
+        if self.points.dtype not in (np.float32, np.float64):
+            self.points = self.points.astype(np.float64)
+        self.triangles = np.asarray(triangles, dtype=np.int32).reshape(-1, 3)
+        self.point_data = {} if point_data is None else dict(point_data)
+        self.cell_data = {} if cell_data is None else dict(cell_data)
+        self._polydata = None
+
+    @classmethod
+    def from_polydata(cls, polydata, arrays=None, exclude=None):
+        """LAMesh of a triangular vtkPolyData (see ExtractVTKTriFaces), with its numeric cell arrays and the point arrays
+        selected by arrays / exclude (see select_point_arrays). Points and attributes are views, not copies"""
+        points = vtk_to_numpy(polydata.GetPoints().GetData()) if polydata.GetPoints() is not None else np.zeros((0, 3))
+        point_data = {}
+        cell_data = {}
+        for store, data in [(point_data, polydata.GetPointData()), (cell_data, polydata.GetCellData())]:
+            for i in range(data.GetNumberOfArrays()):
+                array = data.GetArray(i)   # None for string arrays
+                if array is None or array.GetName() is None:
+                    continue
+                if store is point_data and not point_array_selected(array.GetName(), arrays, exclude):
+                    continue
+                store[array.GetName()] = vtk_to_numpy(array)
+        mesh = cls(points, ExtractVTKTriFaces(polydata), point_data, cell_data)
+        if arrays is None and exclude is None:
+            mesh._polydata = polydata   # same content, no need to convert back
+        return mesh
+
+    @property
+    def n_points(self):
+        return self.points.shape[0]
+
+    @property
+    def n_cells(self):
+        return self.triangles.shape[0]
+
+    def to_polydata(self):
+        """vtkPolyData with the same points, triangles and attributes (built the first time, sharing the point and
+        attribute memory)"""
+        if self._polydata is None:
+            arrays = {'points': self.points,
+                      'polys_offsets': np.arange(0, 3 * self.n_cells + 1, 3),
+                      'polys_connectivity': self.triangles.ravel()}
+            for name in self.point_data:
+                arrays['pointdata/' + name] = self.point_data[name]
+            for name in self.cell_data:
+                arrays['celldata/' + name] = self.cell_data[name]
+            self._polydata = arrays_to_polydata(arrays, deep=False)
+        return self._polydata
+
+    def select_cells(self, mask):
+        """Submesh with the cells in mask (boolean array or cell ids) and the points they use.
+        Return the submesh, the original ids of its points and the original ids of its cells"""
+        mask = np.asarray(mask)
+        cell_ids = np.flatnonzero(mask) if mask.dtype == bool else mask.astype(np.int64)
+        point_ids, triangles = np.unique(self.triangles[cell_ids], return_inverse=True)
+        sub = LAMesh(self.points[point_ids], triangles.reshape(-1, 3),
+                     dict((name, array[point_ids]) for name, array in self.point_data.items()),
+                     dict((name, array[cell_ids]) for name, array in self.cell_data.items()))
+        return sub, point_ids, cell_ids
+
+    def select_points(self, mask, all_points=True):
+        """Submesh with the cells that have all their points in mask (boolean array or point ids), or at least one
+        point if all_points=False. Same cells as pointthreshold (alloff=0 / 1). Return as select_cells"""
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            ids = mask
+            mask = np.zeros(self.n_points, dtype=bool)
+            mask[ids] = True
+        inside = mask[self.triangles]
+        return self.select_cells(inside.all(axis=1) if all_points else inside.any(axis=1))
+
+    def threshold_points(self, arrayname, start=0, end=1, all_points=True):
+        """select_points with the points whose value (first component) of arrayname is in [start, end]"""
+        values = self.point_data[arrayname]
+        if values.ndim > 1:
+            values = values[:, 0]
+        return self.select_points((values >= start) & (values <= end), all_points)
+
+    def threshold_cells(self, arrayname, start=0, end=1):
+        """select_cells with the cells whose value (first component) of arrayname is in [start, end]"""
+        values = self.cell_data[arrayname]
+        if values.ndim > 1:
+            values = values[:, 0]
+        return self.select_cells((values >= start) & (values <= end))
+
+    def cell_regions(self):
+        """Connected region of each cell (cells sharing a point are connected, as in vtkPolyDataConnectivityFilter),
+        numbered 0, 1, ... by first cell. Return the region ids and the number of regions"""
+        from scipy.sparse.csgraph import connected_components
+        edges = np.concatenate([self.triangles[:, [0, 1]], self.triangles[:, [1, 2]], self.triangles[:, [2, 0]]])
+        graph = coo_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])), shape=(self.n_points, self.n_points))
+        _, point_region = connected_components(graph, directed=False)
+        first, regions = np.unique(point_region[self.triangles[:, 0]], return_index=True, return_inverse=True)[1:]
+        order = np.argsort(np.argsort(first))   # renumber regions by their first cell
+        return order[regions], first.size
+
+    def largest_region(self):
+        """Submesh with the connected region with more cells (as extractlargestregion). Return as select_cells"""
+        regions, nregions = self.cell_regions()
+        return self.select_cells(regions == np.argmax(np.bincount(regions, minlength=nregions)))
+
+
+def barycentric_interpolation_matrix(source, target_points, k=8):
+    """Sparse (n_target x n_source) matrix W with the barycentric weights of the closest triangle of 'source' for each
+    of the target_points (n_target x 3): W.dot(v) interpolates point values v of source in target_points.
+    The closest triangle is searched among the k triangles with closest centroid"""
+    vertex = ExtractVTKPoints(source)
+    faces = ExtractVTKTriFaces(source)
+    p = np.asarray(target_points, dtype=float)
+    k = min(k, faces.shape[0])
+    cand = cKDTree(vertex[faces].mean(axis=1)).query(p, k=k)[1].reshape(p.shape[0], k)
+    a = vertex[faces[cand, 0]]   # n_target x k x 3
+    e0 = vertex[faces[cand, 1]] - a
+    e1 = vertex[faces[cand, 2]] - a
+    d = p[:, np.newaxis, :] - a
+    d00 = np.sum(e0 * e0, axis=2)
+    d01 = np.sum(e0 * e1, axis=2)
+    d11 = np.sum(e1 * e1, axis=2)
+    d20 = np.sum(d * e0, axis=2)
+    d21 = np.sum(d * e1, axis=2)
+    denom = d00 * d11 - d01 * d01
+    denom[denom == 0] = 1e-20   # degenerate triangles
+    wb = (d11 * d20 - d01 * d21) / denom
+    wc = (d00 * d21 - d01 * d20) / denom
+    # projection outside the triangle: clip negative weights (at least one is positive)
+    w = np.clip(np.stack([1 - wb - wc, wb, wc], axis=2), 0, None)
+    w = w / np.sum(w, axis=2, keepdims=True)
+    dist = np.sum((a + w[:, :, 1, np.newaxis] * e0 + w[:, :, 2, np.newaxis] * e1 - p[:, np.newaxis, :]) ** 2, axis=2)
+    best = np.argmin(dist, axis=1)
+    rows = np.arange(p.shape[0])
+    return coo_matrix((w[rows, best].ravel(), (np.repeat(rows, 3), faces[cand[rows, best]].ravel())),
+                      shape=(p.shape[0], vertex.shape[0])).tocsr()
+
+def array_hash(*arrays):
+    """sha1 hex digest of the contents of the numpy arrays"""
+    h = hashlib.sha1()
+    for a in arrays:
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
 def ComputeLaplacian(vertex, faces):
-    """Calculates the Laplacian of a mesh
+    """Calculates the Laplacian of a mesh (cotangent weights), assembled as CSR in a single pass
     vertex 3xN numpy.array: vertices
     faces 3xM numpy.array: faces"""
+    vertex = np.asarray(vertex, dtype=float)
+    faces = np.asarray(faces, dtype=np.int64)
     n = vertex.shape[1]
-    m = faces.shape[1]
-
-    # compute mesh weight matrix
-    W = sparse.coo_matrix((n, n))
-    for i in np.arange(1, 4, 1):
-        i1 = np.mod(i - 1, 3)
-        i2 = np.mod(i, 3)
-        i3 = np.mod(i + 1, 3)
-        pp = vertex[:, faces[i2, :]] - vertex[:, faces[i1, :]]
-        qq = vertex[:, faces[i3, :]] - vertex[:, faces[i1, :]]
-        # replace zero vectors with small value to avoid division by zero
-        pp[:,np.where(np.sum(pp ** 2, axis=0) == 0)] = 1e-10
-        qq[:,np.where(np.sum(qq ** 2, axis=0) == 0)] = 1e-10
-        
-        # normalize the vectors
-        pp = pp / np.sqrt(np.sum(pp ** 2, axis=0))
-        qq = qq / np.sqrt(np.sum(qq ** 2, axis=0))
-
-        # compute angles
-        sumy = np.sum(pp * qq, axis=0)
-        # ensure angles are in the range [0, pi]
-        sumy = np.clip(sumy, -1.0, 1.0)
-        
-        ang = np.arccos(sumy)
-        # replace zero angles with small value to avoid division by zero
-        ang[np.where(ang == 0)] = 1e-10
-        W = W + sparse.coo_matrix((1 / np.tan(ang), (faces[i2, :], faces[i3, :])), shape=(n, n))
-        W = W + sparse.coo_matrix((1 / np.tan(ang), (faces[i3, :], faces[i2, :])), shape=(n, n))
-
-    # compute Laplacian
-    d = W.sum(axis=0)
-    D = sparse.dia_matrix((d, 0), shape=(n, n))
-    L = D - W
+
+    # angle at corner i1 of each face, weights the opposite edge (i2, i3). All 3 corners at once (3 x M arrays)
+    i1 = faces
+    i2 = np.roll(faces, -1, axis=0)
+    i3 = np.roll(faces, -2, axis=0)
+    pp = vertex[:, i2] - vertex[:, i1]   # 3 (coordinates) x 3 (corners) x M
+    qq = vertex[:, i3] - vertex[:, i1]
+    # replace zero vectors with small value to avoid division by zero
+    pp[:, np.sum(pp ** 2, axis=0) == 0] = 1e-10
+    qq[:, np.sum(qq ** 2, axis=0) == 0] = 1e-10
+    # normalize the vectors
+    pp = pp / np.sqrt(np.sum(pp ** 2, axis=0))
+    qq = qq / np.sqrt(np.sum(qq ** 2, axis=0))
+    # compute angles, ensure they are in the range [0, pi]
+    ang = np.arccos(np.clip(np.sum(pp * qq, axis=0), -1.0, 1.0))
+    # replace zero angles with small value to avoid division by zero
+    ang[ang == 0] = 1e-10
+    w = 1 / np.tan(ang)
+
+    # L = D - W, W symmetric (both edge directions) and D = diag(column sums of W)
+    rows = np.concatenate([i2.ravel(), i3.ravel(), np.arange(n)])
+    cols = np.concatenate([i3.ravel(), i2.ravel(), np.arange(n)])
+    d = np.bincount(i3.ravel(), weights=w.ravel(), minlength=n) + np.bincount(i2.ravel(), weights=w.ravel(), minlength=n)
+    L = sparse.csr_matrix((np.concatenate([-w.ravel(), -w.ravel(), d]), (rows, cols)), shape=(n, n))   # duplicates summed
     return L
 
 
-def flat(m, boundary_ids, x0, y0):
-    """Conformal flattening fitting boundary to (x0,y0) coordinate positions"""
+def flat(m, boundary_ids, x0, y0, solver=None, return_solver=False, boundary='eliminate', method='lu', tol=1e-8,
+         maxiter=None, x_init=None):
+    """Conformal flattening fitting boundary to (x0,y0) coordinate positions.
+    The system matrix is factorized once and both x and y are solved in a single pass. Set return_solver=True to also
+    get the solver and pass it back (solver=) to flatten again the same mesh & boundary ids with other (x0,y0) targets.
+    boundary='eliminate': the known boundary values are moved to the right hand side and only the (smaller, symmetric)
+    interior system is solved, method='cholesky' can be used then. boundary='rows': boundary rows of the Laplacian are
+    replaced by identity rows (slower).
+    method: 'lu', 'cholesky', 'cg' or 'amg' (see SparseSolver). Iterative methods
+    ('cg', 'amg') always eliminate the boundary, stop at relative residual tol and start from x_init (n x 2, e.g. a
+    previous flattening of the same mesh)"""
     
     # m = DeleteNonTriangularFaces(m) # Ensure only triangular faces are present
-    vertex = ExtractVTKPoints(m).T
-    faces = ExtractVTKTriFaces(m).T
-    n = vertex.shape[1]
-    L = ComputeLaplacian(vertex, faces)
-
-    L = L.tolil()
-    bond_ids = boundary_ids[np.where(boundary_ids < L.shape[0])]
-    L[bond_ids, :] = 0
-    for i in range(bond_ids.shape[0]):
-        L[bond_ids[i], bond_ids[i]] = 1
-
-    Rx = np.zeros(n)
-    Rx[bond_ids] = x0[np.where(boundary_ids < L.shape[0])]
-    Ry = np.zeros(n)
-    Ry[bond_ids] = y0[np.where(boundary_ids < L.shape[0])]
-    L = L.tocsr()
-
-    result = np.zeros((Rx.size, 2))
-    result[:, 0] = linalg_sp.spsolve(L, Rx)  # x
-    result[:, 1] = linalg_sp.spsolve(L, Ry)  # y
-
-    pd = vtk.vtkPolyData()
-    pts = vtk.vtkPoints()
-
-    pts.SetNumberOfPoints(n)
-    for i in range(n):
-        pts.SetPoint(i, result[i, 0], result[i, 1], 0)
-
-    pd.SetPoints(pts)
-    pd.SetPolys(m.GetPolys())
-    pd.Modified()
+    n = m.GetNumberOfPoints()
+    inside = np.where(boundary_ids < n)
+    bond_ids = boundary_ids[inside]
+    if solver is None:
+        t0 = time.time()
+        vertex = ExtractVTKPoints(m).T
+        faces = ExtractVTKTriFaces(m).T
+        L = ComputeLaplacian(vertex, faces)
+
+        if boundary == 'eliminate' or method in ITERATIVE_METHODS:
+            L = L.tocsr()
+            interior = np.setdiff1d(np.arange(n), bond_ids)
+            L_int = L[interior, :]
+            # L_II x_I = - L_IB x_B
+            solver = SparseSolver(L_int[:, interior], -L_int.dot(scatter_matrix(bond_ids, n)), E=scatter_matrix(interior, n),
+                                  F=scatter_matrix(bond_ids, n), method=method, tol=tol, maxiter=maxiter)
+        else:
+            L = L.tolil()
+            L[bond_ids, :] = 0
+            for i in range(bond_ids.shape[0]):
+                L[bond_ids[i], bond_ids[i]] = 1
+            L = L.tocsr()
+            solver = SparseSolver(L, scatter_matrix(bond_ids, n), method=method)   # right hand side: x0 (y0) in the boundary rows
+        print('Flattening, system assembly: {:.2f} s'.format(time.time() - t0))
+
+    t0 = time.time()
+    result = solver.solve_targets(np.column_stack([x0[inside], y0[inside]]), x_init)   # x and y
+    print('Flattening, solve ({}): {:.2f} s'.format(solver.method, time.time() - t0))
+
+    pd = flat_polydata(m, result)
+    if return_solver:
+        return pd, solver
     return pd
 
 
-def flat_w_constraints(m, boundary_ids, constraints_ids, x0_b, y0_b, x0_c, y0_c):
-    """ Conformal flattening fitting boundary points to (x0_b,y0_b) coordinate positions
-    and additional contraint points to (x0_c,y0_c).
-    Solve minimization problem using quadratic programming: https://en.wikipedia.org/wiki/Quadratic_programming"""
+def check_flat_constraints(n, boundary_ids, constraints_ids, x0_b, y0_b, x0_c, y0_c, repair=True):
+    """Preflight check of boundary and constraint points before building the flattening system (n points).
+    Finds out of range ids, ids repeated with different targets and constraint ids that are also boundary ids with a
+    different target (all make the system singular or silently wrong). Repeated ids with the same target are always
+    dropped. repair=True: out of range rows are dropped, repeated ids keep the last target (same result as without the
+    check, see scatter_matrix) and constraint points in the boundary are dropped (boundary wins), with a warning.
+    repair=False: raise ValueError.
+    Return the rows to keep in boundary_ids (and x0_b, y0_b) and in constraints_ids (and x0_c, y0_c)"""
+    boundary_ids = np.asarray(boundary_ids)
+    constraints_ids = np.asarray(constraints_ids)
+    if boundary_ids.size != np.size(x0_b) or boundary_ids.size != np.size(y0_b) or \
+            constraints_ids.size != np.size(x0_c) or constraints_ids.size != np.size(y0_c):
+        raise ValueError('Number of boundary / constraint ids and target positions do not match')
+    problems = []
+
+    def check_set(ids, x0, y0, name):
+        valid = (ids >= 0) & (ids < n)
+        if np.any(~valid):
+            problems.append('{} {} ids out of range [0, {}): {}'.format(np.sum(~valid), name, n, np.unique(ids[~valid])))
+        rows = np.where(valid)[0]
+        # last occurrence of each id, as the scatter r[ids] = t of the solvers (see scatter_matrix)
+        _, last, inverse = np.unique(ids[rows][::-1], return_index=True, return_inverse=True)
+        last = rows.size - 1 - last
+        inverse = inverse.ravel()[::-1]
+        repeated = np.ones(rows.size, dtype=bool)
+        repeated[last] = False
+        conflict = repeated & ((x0[rows] != x0[rows][last][inverse]) | (y0[rows] != y0[rows][last][inverse]))
+        if np.any(conflict):
+            problems.append('{} {} ids repeated with different targets: {}'.format(np.sum(conflict), name, np.unique(ids[rows][conflict])))
+        elif np.any(repeated):
+            print('WARNING: removing', np.sum(repeated), name, 'ids repeated with the same target')
+        return np.sort(rows[last])
+
+    keep_b = check_set(boundary_ids, np.asarray(x0_b), np.asarray(y0_b), 'boundary')
+    keep_c = check_set(constraints_ids, np.asarray(x0_c), np.asarray(y0_c), 'constraint')
+
+    # constraint points that are also boundary points
+    b_sorted = np.argsort(boundary_ids[keep_b])
+    ub = boundary_ids[keep_b][b_sorted]
+    in_boundary = np.isin(constraints_ids[keep_c], ub)
+    if np.any(in_boundary):
+        cb = keep_c[in_boundary]
+        ib = keep_b[b_sorted[np.searchsorted(ub, constraints_ids[cb])]]
+        conflict = (np.asarray(x0_c)[cb] != np.asarray(x0_b)[ib]) | (np.asarray(y0_c)[cb] != np.asarray(y0_b)[ib])
+        if np.any(conflict):
+            problems.append('{} ids are boundary and constraint points with different targets: {}'.format(np.sum(conflict), constraints_ids[cb][conflict]))
+        else:
+            print('WARNING: removing', cb.size, 'constraint ids that are also boundary ids (same target)')
+        keep_c = keep_c[~in_boundary]
+
+    if len(problems) > 0:
+        if not repair:
+            raise ValueError('Invalid flattening constraints. ' + '. '.join(problems))
+        for problem in problems:
+            print('WARNING: ' + problem + '. Repairing')
+    return keep_b, keep_c
+
+def constrained_flattening_solver(m, boundary_ids, constraints_ids, method='lu', tol=1e-8, maxiter=None):
+    """SparseSolver of the constrained flattening of m (see flat_w_constraints). Its targets are the boundary positions
+    followed by the constraint positions (only ids < number of points), one column per coordinate / target set"""
     penalization = 1000
+    if method == 'cholesky':   # KKT system is not positive definite
+        method = 'lu'
+    n = m.GetNumberOfPoints()
+    b_ids = boundary_ids[np.where(boundary_ids < n)]
+    const_ids = constraints_ids[np.where(constraints_ids < n)]
+    t0 = time.time()
     vertex = ExtractVTKPoints(m).T    # 3 x n_vertices
     faces = ExtractVTKTriFaces(m).T
-    n = vertex.shape[1]
     L = ComputeLaplacian(vertex, faces)
     L = L.tolil()
-    L[boundary_ids[np.where(boundary_ids<L.shape[0])], :] = 0.0     # Not conformal there
-    b_ids = boundary_ids[np.where(boundary_ids<L.shape[0])]
+    L[b_ids, :] = 0.0     # Not conformal there
     for i in range(b_ids.shape[0]):
          L[b_ids[i], b_ids[i]] = 1
 
     L = L*penalization
-
-    Rx = np.zeros(n)
-    Ry = np.zeros(n)
-    Rx[b_ids] = x0_b[np.where(boundary_ids<L.shape[0])] * penalization
-    Ry[b_ids] = y0_b[np.where(boundary_ids<L.shape[0])] * penalization
-
     L = L.tocsr()
-    # result = np.zeros((Rx.size, 2))
 
-    const_ids = constraints_ids[np.where(constraints_ids<L.shape[0])]
     nconstraints = const_ids.shape[0]
-    M = np.zeros([nconstraints, n])   # M, zero rows except 1 in constraint point
-    for i in range(nconstraints):
-        M[i, const_ids[i]] = 1
-    dx = x0_c[np.where(constraints_ids<L.shape[0])]
-    dy = y0_c[np.where(constraints_ids<L.shape[0])]
-
-    block1 = hstack([L.T.dot(L), M.T])
-
-    zeros_m = coo_matrix(np.eye(len(dx))*10**(-6))
-    block2 = hstack([M, zeros_m])
-
-    C = vstack([block1, block2])
-
-    prodx = coo_matrix([L.T.dot(Rx)])
-    dxx = coo_matrix([dx])
-    cx = hstack([prodx, dxx])
-
-    prody = coo_matrix([L.T.dot(Ry)])
-    dyy = coo_matrix([dy])
-    cy = hstack([prody, dyy])
-
-    # convert cx to linear array
-    cx = cx.tocsc()
-    cy = cy.tocsc()
-    
-    
-    
-    solx = linalg_sp.spsolve(C, cx.T)
-    soly = linalg_sp.spsolve(C, cy.T)
+    regularization = 10**(-6)
+    M = selection_matrix(const_ids, n)   # M, zero rows except 1 in constraint point (sparse, nconstraints x n)
+    if method in ITERATIVE_METHODS:
+        # same KKT system as 'lu' with the multipliers eliminated, lambda = (t_c - M x) / regularization:
+        # (L'L - M'M / regularization) x = L' R - M' t_c / regularization. Symmetric indefinite (MINRES), preconditioned
+        # with the positive definite L'L + M'M / regularization
+        K = L.T.dot(L)
+        MM = M.T.dot(M) / regularization
+        R = sparse.hstack([L.T.dot(scatter_matrix(b_ids, n)) * penalization, -M.T / regularization], format='csr')
+        solver = SparseSolver(K - MM, R, method=method, tol=tol, maxiter=maxiter, P=K + MM)
+    else:
+        zeros_m = sparse.identity(nconstraints, format='csr')*regularization
+        C = sparse.bmat([[L.T.dot(L), M.T], [M, zeros_m]], format='csc')
+
+        # right hand side: [L' * R ; d] where R has the boundary positions (x penalization) in the boundary rows
+        Rb = L.T.dot(scatter_matrix(b_ids, n)) * penalization
+        Rc = sparse.identity(nconstraints, format='csr')
+        solver = SparseSolver(C, sparse.block_diag([Rb, Rc], format='csr'), n, method=method, tol=tol, maxiter=maxiter)
+    print('Constrained flattening, system assembly: {:.2f} s'.format(time.time() - t0))
+    return solver
+
+def solve_constrained_targets(solver, targets, x_init=None):
+    """Solve the constrained flattening for the targets (one column per coordinate / target set). Return NaNs and
+    print a warning if the system is singular"""
+    t0 = time.time()
+    try:
+        sol = solver.solve_targets(targets, x_init)
+    except RuntimeError:   # exactly singular matrix
+        sol = np.full([solver.E.shape[0] if solver.E is not None else solver.n, targets.shape[1]], np.nan)
+    print('Constrained flattening, solve ({}): {:.2f} s'.format(solver.method, time.time() - t0))
 
-    # print('There are: ', len(np.argwhere(np.isnan(solx))), ' nans')
-    # print('There are: ', len(np.argwhere(np.isnan(soly))), ' nans')
-    if len(np.argwhere(np.isnan(solx))) > 0:
+    if len(np.argwhere(np.isnan(sol))) > 0:
         print('WARNING!!! matrix is singular. It is probably due to the convergence of 2 different division lines in the same point.')
         print('Trying to assign different 2D possition to same 3D point. Try to create new division lines or increase resolution of mesh.')
+    return sol
 
-    pd = vtk.vtkPolyData()
-    pts = vtk.vtkPoints()
+def flat_w_constraints(m, boundary_ids, constraints_ids, x0_b, y0_b, x0_c, y0_c, solver=None, return_solver=False,
+                       method='lu', tol=1e-8, maxiter=None, x_init=None):
+    """ Conformal flattening fitting boundary points to (x0_b,y0_b) coordinate positions
+    and additional contraint points to (x0_c,y0_c).
+    Solve minimization problem using quadratic programming: https://en.wikipedia.org/wiki/Quadratic_programming
+    The system matrix is factorized once for x and y. Set return_solver=True to also get the solver and pass it back
+    (solver=) to flatten again the same mesh, boundary & constraint ids with other target positions.
+    method 'lu': direct solve of the KKT system (default). 'cg' / 'amg': the same system with the Lagrange multipliers
+    eliminated, solved with preconditioned MINRES (no factorization, for meshes too large for a direct solver): same
+    result as 'lu' up to tol (relative residual, ConvergenceError if it is not reached), starting from x_init (n x 2,
+    e.g. a previous flattening)"""
+    n = m.GetNumberOfPoints()
+    b_inside = np.where(boundary_ids < n)
+    c_inside = np.where(constraints_ids < n)
+    if solver is None:
+        solver = constrained_flattening_solver(m, boundary_ids, constraints_ids, method=method, tol=tol, maxiter=maxiter)
+
+    targets = np.zeros([b_inside[0].size + c_inside[0].size, 2])
+    targets[:, 0] = np.append(x0_b[b_inside], x0_c[c_inside])
+    targets[:, 1] = np.append(y0_b[b_inside], y0_c[c_inside])
+    sol = solve_constrained_targets(solver, targets, x_init)
+
+    pd = flat_polydata(m, sol)
+    if return_solver:
+        return pd, solver
+    return pd
 
-    pts.SetNumberOfPoints(n)
-    for i in range(n):
-        pts.SetPoint(i, solx[i], soly[i], 0)
+def flat_w_constraints_sweep(m, boundary_ids, constraints_ids, positions, solver=None, method='lu', tol=1e-8,
+                             maxiter=None):
+    """flat_w_constraints for several target sets on the same mesh and ids (e.g. a template parameter sweep).
+    positions: list of (x0_b, y0_b, x0_c, y0_c) tuples. The system is factorized once (or the given solver is reused)
+    and all target sets are solved as a single multi right hand side batch. Return the list of flat meshes"""
+    n = m.GetNumberOfPoints()
+    b_inside = np.where(boundary_ids < n)
+    c_inside = np.where(constraints_ids < n)
+    if solver is None:
+        solver = constrained_flattening_solver(m, boundary_ids, constraints_ids, method=method, tol=tol, maxiter=maxiter)
+    targets = np.zeros([b_inside[0].size + c_inside[0].size, 2 * len(positions)])
+    for k, (x0_b, y0_b, x0_c, y0_c) in enumerate(positions):
+        targets[:, 2 * k] = np.append(x0_b[b_inside], x0_c[c_inside])
+        targets[:, 2 * k + 1] = np.append(y0_b[b_inside], y0_c[c_inside])
+    sol = solve_constrained_targets(solver, targets)
+    return [flat_polydata(m, sol[:, 2 * k:2 * k + 2]) for k in range(len(positions))]
+
+def flat_polydata(m, xy):
+    """Flat (z = 0) mesh sharing the topology (polys) of m with the n x 2 array xy as point coordinates.
+    The points are a zero-copy vtk wrapper of an n x 3 float32 numpy buffer (the precision of vtkPoints), kept alive
+    by the vtk array"""
+    xyz = np.zeros((m.GetNumberOfPoints(), 3), dtype=np.float32)
+    xyz[:, 0:2] = xy
+    pts = vtk.vtkPoints()
+    pts.SetData(numpy_to_vtk(xyz, deep=False))
 
+    pd = vtk.vtkPolyData()
     pd.SetPoints(pts)
     pd.SetPolys(m.GetPolys())
     pd.Modified()
@@ -1904,18 +2453,13 @@ def set_piece_label(m, line_textfile, m_seeds):
 
     lines = []
 
-    with open(line_textfile, 'r') as f:
+    with open_case_file(line_textfile, 'r') as f:
         for line in f:
             l = line.replace('\n', '').strip()
             lines.append(np.array([int(x) for x in l.split(' ')]))
 
     # extract connectivity
-    tri = np.zeros([m.GetNumberOfCells(), 3], dtype=np.int64)
-
-    for i in range(tri.shape[0]):
-        ids = m.GetCell(i).GetPointIds()
-        for j in range(3):
-            tri[i, j] = ids.GetId(j)
+    tri = ExtractVTKTriFaces(m).astype(np.int64)
 
     trilabel = np.zeros(m.GetNumberOfCells(), dtype=np.int64)
     region_id = 0
@@ -1954,34 +2498,14 @@ def set_piece_label(m, line_textfile, m_seeds):
     p_v8 = m_seeds.GetPoint(8)
     p_v9 = m_seeds.GetPoint(9)
 
-    dists = np.zeros(9)
+    seeds = np.array([p_v1, p_v2, p_v3, p_v4, p_v5, p_v6, p_v7, p_v8, p_v9])   # in order of acquisition
+    mesh = LAMesh(ExtractVTKPoints(m), tri)
 
     for i in range(1, 6):
-        piece = cellthreshold(m, 'region', i, i)
+        piece = mesh.select_cells(trilabel == i)[0]
 
         # find closest point IN piece to the reference points (seeds, Vi)
-        locator = vtk.vtkPointLocator()
-        locator.SetDataSet(piece)
-        locator.BuildLocator()
-        id_v1 = locator.FindClosestPoint(p_v1)
-        id_v2 = locator.FindClosestPoint(p_v2)
-        id_v3 = locator.FindClosestPoint(p_v3)
-        id_v4 = locator.FindClosestPoint(p_v4)
-        id_v5 = locator.FindClosestPoint(p_v5)  # in order of acquisition
-        id_v6 = locator.FindClosestPoint(p_v6)
-        id_v7 = locator.FindClosestPoint(p_v7)
-        id_v8 = locator.FindClosestPoint(p_v8)
-        id_v9 = locator.FindClosestPoint(p_v9)
-
-        dists[0] = euclideandistance(piece.GetPoint(id_v1), p_v1)
-        dists[1] = euclideandistance(piece.GetPoint(id_v2), p_v2)
-        dists[2] = euclideandistance(piece.GetPoint(id_v3), p_v3)
-        dists[3] = euclideandistance(piece.GetPoint(id_v4), p_v4)
-        dists[4] = euclideandistance(piece.GetPoint(id_v5), p_v5)
-        dists[5] = euclideandistance(piece.GetPoint(id_v6), p_v6)
-        dists[6] = euclideandistance(piece.GetPoint(id_v7), p_v7)
-        dists[7] = euclideandistance(piece.GetPoint(id_v8), p_v8)
-        dists[8] = euclideandistance(piece.GetPoint(id_v9), p_v9)
+        dists = cKDTree(piece.points).query(seeds)[0]
 
         # compute distance to seeds, depending on their position I can find which piece is
         closest_seeds = np.sort(np.argpartition(dists, 4)[0:4])
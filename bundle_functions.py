@@ -0,0 +1,405 @@
+import vtk
+import numpy as np
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+import os
+import io
+import glob
+import fnmatch
+import hashlib
+import re
+import zipfile
+import json
+import atexit
+
+###     Case bundle    ###
+# All the intermediate (sidecar) files of a case (seeds, centerlines, contours, paths, division lines...) can be stored
+# in a single <case>_bundle.zip file next to them, with one group of .npy arrays per mesh and one member per text file,
+# instead of dozens of small files. One bundle per case: cases of the same folder can run at the same time. Selected
+# once per pipeline run (set_case_bundle or the LA_CASE_BUNDLE environment variable). The main meshes (_clipped,
+# _clipped_c, _to_be_flat, _flat...) are always written as regular files.
+# Each process reads a bundle once and keeps its members in memory; reads, writes and removals work on that copy and
+# the bundles that changed are written once, when the process exits (or by flush_bundles).
+BUNDLE_SUFFIX = '_bundle.zip'
+CASE_NAME_END = re.compile('_(clipped|clipseeds|clip_planes|clippointid|clraw|clbranch|clvein|clsection|autolabels|axes)')
+SIDECAR_PATTERNS = ['*_clipseeds.vtp', '*_clipseeds.csv', '*_clraw2[0-9].vtp', '*_clbranch[0-9].vtp', '*_clvein[0-9].vtp',
+                    '*_clsection[0-9].vtp', '*_clippointid[0-9].csv', '*_autolabels.vtp', '*_axes.vtp', '*_seeds.vtk',
+                    '*_seeds_for_flat.vtk', '*path[0-9].vtk', '*path_laa[0-9].vtk', '*path[0-9]_prop.vtk',
+                    '*path_laa[0-9]_prop.vtk', '*_cont_*.vtk', '*_detected_edges.vtk', '*_div_lines.txt',
+                    '*_clip_planes.csv']
+_case_bundle = os.environ.get('LA_CASE_BUNDLE', '0') == '1'
+
+def set_case_bundle(on):
+    """Store the sidecar files of the cases in the bundle of their folder (True) or as regular files (False, default)"""
+    global _case_bundle
+    _case_bundle = bool(on)
+    os.environ['LA_CASE_BUNDLE'] = '1' if _case_bundle else '0'
+
+def get_case_bundle():
+    """True if the sidecar files are written to the case bundle (see set_case_bundle)"""
+    return _case_bundle
+
+def case_name(filename):
+    """Name of the case of a sidecar file: the file name before the first stage suffix (_clipped, _clipseeds,
+    _autolabels...), e.g. 'LA' for LA_clipped_c_cont_mv.vtk"""
+    name = os.path.basename(filename)
+    match = CASE_NAME_END.search(name)
+    return name[0:match.start()] if match is not None else os.path.splitext(name)[0]
+
+def bundle_path(filename):
+    """Bundle file storing the sidecar filename (<case>_bundle.zip in its folder, see case_name)"""
+    return os.path.join(os.path.dirname(filename), case_name(filename) + BUNDLE_SUFFIX)
+
+def is_sidecar(filename):
+    """True if filename is an intermediate file that can be stored in the case bundle"""
+    name = os.path.basename(filename)
+    return any(fnmatch.fnmatch(name, p) for p in SIDECAR_PATTERNS)
+
+_bundles = {}   # absolute bundle path -> {'stamp': size & mtime of the file read, 'members': {member: bytes}, 'dirty'}
+
+def _bundle_state(bundle):
+    """In-memory copy of bundle, read the first time it is used (again if another process rewrote it and there are no
+    pending changes)"""
+    bundle = os.path.abspath(bundle)
+    stamp = _file_stamp(bundle) if os.path.isfile(bundle) else None
+    state = _bundles.get(bundle)
+    if state is None or (not state['dirty'] and state['stamp'] != stamp):
+        members = {}
+        if stamp is not None:
+            with zipfile.ZipFile(bundle) as z:
+                for n in z.namelist():
+                    members[n] = z.read(n)
+        state = {'stamp': stamp, 'members': members, 'dirty': False}
+        _bundles[bundle] = state
+    return state
+
+def flush_bundles():
+    """Write the bundles changed by this process (each one once, through a temporary file). Called at exit"""
+    for bundle, state in _bundles.items():
+        if not state['dirty']:
+            continue
+        if len(state['members']) == 0:
+            if os.path.isfile(bundle):
+                os.remove(bundle)
+        else:
+            tmp = bundle + '.' + str(os.getpid()) + '.tmp'
+            with zipfile.ZipFile(tmp, 'w') as z:
+                for n, data in state['members'].items():
+                    z.writestr(n, data)
+            os.replace(tmp, bundle)
+        state['stamp'] = _file_stamp(bundle) if os.path.isfile(bundle) else None
+        state['dirty'] = False
+
+atexit.register(flush_bundles)
+
+def folder_bundles(folder):
+    """Case bundles of folder: the bundle files and the bundles created by this process not written yet"""
+    bundles = set(os.path.abspath(b) for b in glob.glob(os.path.join(glob.escape(folder), '*' + BUNDLE_SUFFIX)))
+    folder = os.path.abspath(folder)
+    bundles.update(b for b, state in _bundles.items() if os.path.dirname(b) == folder and state['dirty'])
+    return sorted(bundles)
+
+def bundle_groups(bundle):
+    """Names of the meshes / files stored in bundle (empty if it does not exist)"""
+    return set(n.split('/')[0] for n in _bundle_state(bundle)['members'])
+
+def bundle_remove(bundle, pattern):
+    """Remove from bundle the meshes / files whose name matches pattern (fnmatch)"""
+    state = _bundle_state(bundle)
+    removed = [n for n in state['members'] if fnmatch.fnmatch(n.split('/')[0], pattern)]
+    for n in removed:
+        del state['members'][n]
+    state['dirty'] = state['dirty'] or len(removed) > 0
+
+def bundle_write(bundle, name, data):
+    """Store data in bundle under name, replacing the previous version. data is bytes (one member) or a dict of numpy
+    arrays (one .npy member per array, in group name/)"""
+    bundle_remove(bundle, name)
+    state = _bundle_state(bundle)
+    if isinstance(data, dict):
+        for key, a in data.items():
+            buf = io.BytesIO()
+            np.save(buf, np.asarray(a), allow_pickle=False)
+            state['members'][name + '/' + key.replace('/', '%2F') + '.npy'] = buf.getvalue()
+    else:
+        state['members'][name] = data
+    state['dirty'] = True
+
+def bundle_read_bytes(bundle, name):
+    """Content of the file stored in bundle under name"""
+    return _bundle_state(bundle)['members'][name]
+
+def bundle_read_arrays(bundle, name):
+    """Dictionary with the numpy arrays of group name in bundle"""
+    arrays = {}
+    for n, data in _bundle_state(bundle)['members'].items():
+        if n.startswith(name + '/'):
+            key = n[len(name) + 1:-4].replace('%2F', '/')
+            arrays[key] = np.load(io.BytesIO(data), allow_pickle=False)
+    return arrays
+
+def in_bundle(filename):
+    """True if filename has to be read from the case bundle: it is stored there and the bundle is enabled (or there is
+    no regular file with that name)"""
+    if not (_case_bundle or not os.path.isfile(filename)):
+        return False
+    return os.path.basename(filename) in bundle_groups(bundle_path(filename))
+
+def to_bundle(filename):
+    """True if filename has to be written to the case bundle"""
+    return _case_bundle and is_sidecar(filename)
+
+###     Polydata <-> arrays    ###
+CELL_TYPES = ['verts', 'lines', 'polys', 'strips']
+
+def point_array_selected(name, arrays=None, exclude=None):
+    """True if point array name is in arrays (None: all the arrays) and not in exclude"""
+    return (arrays is None or name in arrays) and (exclude is None or name not in exclude)
+
+def select_point_arrays(polydata, arrays=None, exclude=None):
+    """Remove from polydata the point arrays that are not in arrays (None: keep all) or are in exclude"""
+    data = polydata.GetPointData()
+    for name in [data.GetArrayName(i) for i in range(data.GetNumberOfArrays())]:
+        if not point_array_selected(name, arrays, exclude):
+            data.RemoveArray(name)
+    return polydata
+
+def polydata_to_arrays(polydata):
+    """Dictionary of numpy arrays with the points, cells (offsets and connectivity) and numeric point / cell data of
+    polydata. Arrays without name and string arrays are not kept"""
+    arrays = {}
+    if polydata.GetPoints() is not None:
+        arrays['points'] = vtk_to_numpy(polydata.GetPoints().GetData())
+    for cell_type in CELL_TYPES:
+        cells = getattr(polydata, 'Get' + cell_type.capitalize())()
+        if cells.GetNumberOfCells() == 0:
+            continue
+        if hasattr(cells, 'GetOffsetsArray'):
+            arrays[cell_type + '_offsets'] = vtk_to_numpy(cells.GetOffsetsArray())
+            arrays[cell_type + '_connectivity'] = vtk_to_numpy(cells.GetConnectivityArray())
+        else:   # VTK < 9, [npts, id0, id1, ...] legacy layout
+            legacy = vtk_to_numpy(cells.GetData())
+            npts = np.zeros(cells.GetNumberOfCells(), dtype=legacy.dtype)
+            pos = 0
+            for k in range(npts.size):
+                npts[k] = legacy[pos]
+                pos += npts[k] + 1
+            mask = np.ones(legacy.size, dtype=bool)
+            mask[np.concatenate([[0], np.cumsum(npts[:-1] + 1)])] = False
+            arrays[cell_type + '_offsets'] = np.concatenate([[0], np.cumsum(npts)])
+            arrays[cell_type + '_connectivity'] = legacy[mask]
+    for prefix, data in [('pointdata', polydata.GetPointData()), ('celldata', polydata.GetCellData())]:
+        for i in range(data.GetNumberOfArrays()):
+            array = data.GetArray(i)   # None for string arrays
+            if array is None or array.GetName() is None:
+                continue
+            arrays[prefix + '/' + array.GetName()] = vtk_to_numpy(array)
+    return arrays
+
+def arrays_to_polydata(arrays, deep=True):
+    """vtkPolyData built from a dictionary of arrays written by polydata_to_arrays.
+    deep=False: the VTK arrays use the memory of the numpy arrays (e.g. memory-mapped files), no copy"""
+    polydata = vtk.vtkPolyData()
+    if 'points' in arrays:
+        points = vtk.vtkPoints()
+        points.SetData(numpy_to_vtk(np.ascontiguousarray(arrays['points']), deep=deep))
+        polydata.SetPoints(points)
+    for cell_type in CELL_TYPES:
+        if cell_type + '_offsets' not in arrays:
+            continue
+        offsets = np.asarray(arrays[cell_type + '_offsets'], dtype=np.int64)
+        connectivity = np.asarray(arrays[cell_type + '_connectivity'], dtype=np.int64)
+        cells = vtk.vtkCellArray()
+        if hasattr(cells, 'SetData'):
+            cells.SetData(numpy_to_vtk(offsets, deep=deep, array_type=vtk.VTK_ID_TYPE),
+                          numpy_to_vtk(connectivity, deep=deep, array_type=vtk.VTK_ID_TYPE))
+        else:
+            for k in range(offsets.size - 1):
+                cells.InsertNextCell(int(offsets[k + 1] - offsets[k]))
+                for pid in connectivity[offsets[k]:offsets[k + 1]]:
+                    cells.InsertCellPoint(int(pid))
+        getattr(polydata, 'Set' + cell_type.capitalize())(cells)
+    for prefix, data in [('pointdata', polydata.GetPointData()), ('celldata', polydata.GetCellData())]:
+        for key in arrays:
+            if key.startswith(prefix + '/'):
+                array = numpy_to_vtk(np.ascontiguousarray(arrays[key]), deep=deep)
+                array.SetName(key[len(prefix) + 1:])
+                data.AddArray(array)
+    return polydata
+
+###     Sidecar files    ###
+
+def write_bundled_polydata(polydata, filename):
+    """Store polydata in the case bundle under the name of filename"""
+    bundle_write(bundle_path(filename), os.path.basename(filename), polydata_to_arrays(polydata))
+
+def read_bundled_polydata(filename, arrays=None, exclude=None):
+    """Read the polydata stored in the case bundle under the name of filename (only the point arrays selected by
+    arrays / exclude, see select_point_arrays)"""
+    return select_point_arrays(arrays_to_polydata(bundle_read_arrays(bundle_path(filename), os.path.basename(filename))),
+                               arrays, exclude)
+
+def case_file_exists(filename):
+    """True if filename exists as a regular file or in the case bundle"""
+    return os.path.isfile(filename) or os.path.basename(filename) in bundle_groups(bundle_path(filename))
+
+class _BundleWriter(object):
+    """File object that stores its content in the case bundle when it is closed"""
+    def __init__(self, filename, binary):
+        self.filename = filename
+        self.buffer = io.BytesIO() if binary else io.StringIO()
+
+    def write(self, s):
+        return self.buffer.write(s)
+
+    def __getattr__(self, name):   # seek, tell, flush... of the buffer
+        return getattr(self.buffer, name)
+
+    def close(self):
+        if self.buffer is None:
+            return
+        data = self.buffer.getvalue()
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        bundle_write(bundle_path(self.filename), os.path.basename(self.filename), data)
+        self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_case_file(filename, mode='r'):
+    """open() for the sidecar text / binary files: reads and writes go to the case bundle when it is used for filename
+    (see in_bundle and to_bundle), to a regular file otherwise"""
+    binary = 'b' in mode
+    if 'r' in mode:
+        if in_bundle(filename):
+            data = bundle_read_bytes(bundle_path(filename), os.path.basename(filename))
+            return io.BytesIO(data) if binary else io.StringIO(data.decode('utf-8'))
+        return open(filename, mode)
+    if to_bundle(filename):
+        return _BundleWriter(filename, binary)
+    return open(filename, mode)
+
+def remove_case_files(pattern):
+    """Delete the regular files matching pattern (glob) and the files with matching name in the case bundles of its
+    folder"""
+    for f in glob.glob(pattern):
+        os.remove(f)
+    for bundle in folder_bundles(os.path.dirname(pattern)):
+        bundle_remove(bundle, os.path.basename(pattern))
+
+###     Mesh cache    ###
+# Meshes read (or written) by the stage scripts can be cached as .npy files (points, cells, point/cell data) in a
+# .mesh_cache folder next to them, and reopened memory-mapped by the next stage or run: no parsing, and the pages are
+# shared by all the processes reading the same case. A cache entry is used only while the size and modification time
+# of the mesh file match. The .npy files are named after the hash of their content and never overwritten (they may be
+# memory-mapped by this or other processes), index.json points to the current ones. Selected once per pipeline run
+# (set_mesh_cache or the LA_MESH_CACHE environment variable).
+MESH_CACHE_DIR = '.mesh_cache'
+_mesh_cache = os.environ.get('LA_MESH_CACHE', '0') == '1'
+
+def set_mesh_cache(on):
+    """Cache the meshes read / written by readvtk, readvtp, writevtk and writevtp as memory-mapped .npy files (True)"""
+    global _mesh_cache
+    _mesh_cache = bool(on)
+    os.environ['LA_MESH_CACHE'] = '1' if _mesh_cache else '0'
+
+def get_mesh_cache():
+    """True if the mesh cache is used (see set_mesh_cache)"""
+    return _mesh_cache
+
+def mesh_cache_dir(filename):
+    """Folder with the cached arrays of mesh filename"""
+    return os.path.join(os.path.dirname(filename), MESH_CACHE_DIR, os.path.basename(filename))
+
+def _file_stamp(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+def _array_hash(a):
+    """Short hash of the dtype, shape and content of the contiguous array a (name of its cache file)"""
+    h = hashlib.sha1((a.dtype.str + str(a.shape)).encode('utf-8'))
+    h.update(a.view(np.uint8).reshape(-1) if a.size > 0 else b'')
+    return h.hexdigest()[0:16]
+
+def save_mesh_cache(polydata, filename):
+    """Cache the arrays of polydata (just read from / written to filename). Meshes with field data, string or unnamed
+    arrays are not cached (they could not be rebuilt). Return True if the cache was written"""
+    if not _mesh_cache or is_sidecar(filename) or not os.path.isfile(filename):
+        return False
+    if polydata.GetFieldData().GetNumberOfArrays() > 0:
+        return False
+    active = {}
+    for prefix, data in [('pointdata', polydata.GetPointData()), ('celldata', polydata.GetCellData())]:
+        for i in range(data.GetNumberOfArrays()):
+            if data.GetArray(i) is None or data.GetArrayName(i) is None:
+                return False
+        for a in range(vtk.vtkDataSetAttributes.NUM_ATTRIBUTES):
+            array = data.GetAbstractAttribute(a)
+            if array is not None:
+                active[prefix + '/' + array.GetName()] = active.get(prefix + '/' + array.GetName(), []) + [a]
+    folder = mesh_cache_dir(filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    arrays = polydata_to_arrays(polydata)
+    files = {}
+    for key, a in arrays.items():
+        a = np.ascontiguousarray(a)
+        files[key] = key.replace('/', '%2F') + '.' + _array_hash(a) + '.npy'
+        if os.path.isfile(os.path.join(folder, files[key])):   # same content (e.g. the mesh was read from the cache)
+            continue
+        tmp = os.path.join(folder, files[key] + '.' + str(os.getpid()) + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, a, allow_pickle=False)
+        os.replace(tmp, os.path.join(folder, files[key]))
+    index = {'stamp': _file_stamp(filename), 'files': files, 'active': active}
+    tmp = os.path.join(folder, 'index.json.' + str(os.getpid()) + '.tmp')
+    with open(tmp, 'w') as f:   # written last, a partial cache is never used
+        json.dump(index, f)
+    os.replace(tmp, os.path.join(folder, 'index.json'))
+    current = set(files.values())
+    for f in glob.glob(os.path.join(glob.escape(folder), '*.npy')):
+        if os.path.basename(f) not in current:
+            try:   # old versions: mapped pages stay valid, readers of the old index fall back to the mesh file
+                os.remove(f)
+            except OSError:   # still open (Windows)
+                pass
+    return True
+
+def load_mesh_cache(filename, arrays=None, exclude=None):
+    """Memory-mapped (copy on write) arrays of the cached mesh filename, None if the cache is disabled, missing or
+    older than the file. Point arrays not selected by arrays / exclude (see select_point_arrays) are not opened"""
+    if not _mesh_cache or not os.path.isfile(filename):
+        return None
+    index_file = os.path.join(mesh_cache_dir(filename), 'index.json')
+    if not os.path.isfile(index_file):
+        return None
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+        if index['stamp'] != _file_stamp(filename):
+            return None
+        files = {key: f for key, f in index['files'].items()
+                 if not key.startswith('pointdata/') or point_array_selected(key[10:], arrays, exclude)}
+        cached = {key: np.load(os.path.join(mesh_cache_dir(filename), f), mmap_mode='c', allow_pickle=False)
+                  for key, f in files.items()}
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    cached['active'] = {key: a for key, a in index['active'].items() if key in files}
+    return cached
+
+def read_cached_polydata(filename, arrays=None, exclude=None):
+    """vtkPolyData using the memory-mapped cached arrays of filename (no copy), None if there is no valid cache"""
+    arrays = load_mesh_cache(filename, arrays, exclude)
+    if arrays is None:
+        return None
+    active = arrays.pop('active')
+    polydata = arrays_to_polydata(arrays, deep=False)
+    for key, attributes in active.items():
+        prefix, name = key.split('/', 1)
+        data = polydata.GetPointData() if prefix == 'pointdata' else polydata.GetCellData()
+        for a in attributes:
+            data.SetActiveAttribute(name, a)
+    return polydata
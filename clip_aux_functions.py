@@ -248,8 +248,9 @@ def pv_LAA_centerlines(inputfile, seedsfile, outfile, pvends=1, cut_laa=0):
     (other side) PVs"""
 
     # surface = vmtksurfacereader(inputfile)
-    surface = readvtk(inputfile)
-    points = np.loadtxt(seedsfile, delimiter=',').tolist()
+    surface = readvtk(inputfile, arrays=[])   # only the geometry is needed
+    with open_case_file(seedsfile) as f:
+        points = np.loadtxt(f, delimiter=',').tolist()
 
     print('Processing RSPV seed:')
     cl1 = vmtkcenterlines(surface, points[0], points[2] + points[3], pvends)
@@ -364,8 +365,8 @@ def clip_veins_sections_and_LAA(inputfile, sufixfile, clspacing, maxslope, skipp
     defined as the centerline point corresponding to the last section of
     the vein before entering the body. """
 
-    surface = vmtksurfacereader(inputfile)  # atrium surface mesh
-    # surface = readvtk(inputfile)  # atrium surface mesh
+    # surface = vmtksurfacereader(inputfile)  # atrium surface mesh
+    surface = readvtk(inputfile, arrays=[])  # atrium surface mesh, the input arrays are projected later (transfer_all_scalar_arrays)
 
     # creating array to hold new autolabels
     branchlabel= [0, 77, 76, 78, 79, 37]    # it must be 37 for the LAA
@@ -429,7 +430,7 @@ def clip_veins_sections_and_LAA(inputfile, sufixfile, clspacing, maxslope, skipp
         # print "pre sections"
         sections = vmtkcenterlinesections(surface, cl)
         # print "post sections"
-        vmtksurfacewriter(sections, sufixfile + 'clsection' + str(k) + '.vtp')
+        writevtp(sections, sufixfile + 'clsection' + str(k) + '.vtp')
 
         closedarray = sections.GetCellData().GetArray('CenterlineSectionClosed')
         maxsizearray = (sections.GetCellData().GetArray('CenterlineSectionMaxSize'))
@@ -471,7 +472,8 @@ def clip_veins_sections_and_LAA(inputfile, sufixfile, clspacing, maxslope, skipp
             clippointid = i - (highcount)
 
         # print clippointid
-        np.savetxt(sufixfile + 'clippointid' + str(k) + '.csv', np.array([clippointid])+int(nskippoints), fmt='%i')
+        with open_case_file(sufixfile + 'clippointid' + str(k) + '.csv', 'w') as f:
+            np.savetxt(f, np.array([clippointid])+int(nskippoints), fmt='%i')
 
         #-----------------------------------------------------------------------
         # Prepare output
@@ -520,7 +522,8 @@ def clip_vein_endpoint_and_LAA_save_planes(surface, ifile_sufix, targetdistance,
 
         # load the centreline and the clipoint
         cl = readvtp(ifile_sufix + 'clvein' + str(k) + '.vtp')
-        clippointid = int(np.loadtxt(ifile_sufix + 'clippointid' + str(k) + '.csv'))
+        with open_case_file(ifile_sufix + 'clippointid' + str(k) + '.csv') as f:
+            clippointid = int(np.loadtxt(f))
 
         clippoint0 = cl.GetPoint(clippointid)
         clipnormal = (np.array(cl.GetPoint(clippointid + 1)) - np.array(cl.GetPoint(clippointid )))
@@ -0,0 +1,345 @@
+import numpy as np
+import os
+import sys
+import re
+import fnmatch
+import zipfile
+import json
+import math
+import base64
+from scipy.optimize import nnls
+from bundle_functions import open_case_file, bundle_groups, flush_bundles, BUNDLE_SUFFIX
+try:   # peak memory of the process, not available on Windows
+    import resource
+except ImportError:
+    resource = None
+
+###     Mesh inspection    ###
+# Number of points / cells, cell types and array names of a VTK (legacy) or VTP (XML) mesh without building the mesh:
+# only the headers are read, binary data blocks are skipped (ASCII data is counted, not converted)
+LEGACY_TYPE_SIZES = {'bit': None, 'unsigned_char': 1, 'char': 1, 'unsigned_short': 2, 'short': 2, 'unsigned_int': 4,
+                     'int': 4, 'unsigned_long': 8, 'long': 8, 'float': 4, 'double': 8, 'vtkidtype': 4,
+                     'vtktypeint64': 8, 'vtktypeuint64': 8, 'vtktypeint32': 4, 'vtktypeuint32': 4}
+XML_TYPE_SIZES = {'Int8': 1, 'UInt8': 1, 'Int16': 2, 'UInt16': 2, 'Int32': 4, 'UInt32': 4, 'Int64': 8, 'UInt64': 8,
+                  'Float32': 4, 'Float64': 8}
+LEGACY_CELL_KEYWORDS = {'VERTICES': 'verts', 'LINES': 'lines', 'POLYGONS': 'polys', 'TRIANGLE_STRIPS': 'strips'}
+XML_CELL_SECTIONS = {'Verts': 'verts', 'Lines': 'lines', 'Polys': 'polys', 'Strips': 'strips'}
+
+def _empty_scan(filename, fmt):
+    return {'file': filename, 'format': fmt, 'points': 0, 'cells': {'verts': 0, 'lines': 0, 'polys': 0, 'strips': 0},
+            'connectivity': {}, 'point_arrays': [], 'cell_arrays': [], 'triangular': None, 'complete': True}
+
+def _skip_values(f, n, size, binary):
+    """Skip n values of size bytes (binary) or n ASCII tokens"""
+    if binary:
+        f.seek(n * size, 1)
+        return
+    count = 0
+    while count < n:
+        line = f.readline()
+        if not line:
+            raise ValueError('Unexpected end of file')
+        count += len(line.split())
+
+def scan_legacy_vtk(filename):
+    """Header information of a legacy VTK polydata file (see scan_mesh)"""
+    info = _empty_scan(filename, 'legacy')
+    with open(filename, 'rb') as f:
+        version = f.readline().decode('ascii', 'replace').split()[-1]
+        f.readline()   # title
+        binary = f.readline().strip().upper() == b'BINARY'
+        info['format'] = 'legacy ' + ('binary' if binary else 'ascii')
+        if f.readline().split()[-1].upper() != b'POLYDATA':
+            raise ValueError(filename + ' is not a polydata file')
+        new_cells = float(version) >= 5.0   # OFFSETS / CONNECTIVITY blocks
+        arrays = None
+        ntuples = 0
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            words = line.decode('ascii', 'replace').split()
+            if len(words) == 0:
+                continue
+            key = words[0].upper()
+            try:
+                if key == 'POINTS':
+                    info['points'] = int(words[1])
+                    _skip_values(f, 3 * int(words[1]), LEGACY_TYPE_SIZES[words[2].lower()], binary)
+                elif key in LEGACY_CELL_KEYWORDS:
+                    cell_type = LEGACY_CELL_KEYWORDS[key]
+                    if new_cells:
+                        info['cells'][cell_type] = max(int(words[1]) - 1, 0)
+                        info['connectivity'][cell_type] = int(words[2])
+                        for block in range(2):   # OFFSETS n+1 values, CONNECTIVITY values
+                            header = f.readline().split()
+                            while len(header) == 0:
+                                header = f.readline().split()
+                            _skip_values(f, int(words[1 + block]), LEGACY_TYPE_SIZES[header[1].decode().lower()], binary)
+                    else:   # [npts, id0, id1, ...] for each cell
+                        info['cells'][cell_type] = int(words[1])
+                        info['connectivity'][cell_type] = int(words[2]) - int(words[1])
+                        _skip_values(f, int(words[2]), 4, binary)
+                elif key in ['POINT_DATA', 'CELL_DATA']:
+                    arrays = info['point_arrays'] if key == 'POINT_DATA' else info['cell_arrays']
+                    ntuples = int(words[1])
+                elif key == 'METADATA':   # until the next empty line
+                    while len(f.readline().strip()) > 0:
+                        pass
+                elif key == 'SCALARS':
+                    arrays.append(words[1])
+                    ncomp = int(words[3]) if len(words) > 3 else 1
+                    f.readline()   # LOOKUP_TABLE
+                    _skip_values(f, ntuples * ncomp, LEGACY_TYPE_SIZES[words[2].lower()], binary)
+                elif key in ['VECTORS', 'NORMALS', 'TENSORS', 'TENSORS6', 'GLOBAL_IDS', 'PEDIGREE_IDS']:
+                    arrays.append(words[1])
+                    ncomp = {'VECTORS': 3, 'NORMALS': 3, 'TENSORS': 9, 'TENSORS6': 6}.get(key, 1)
+                    _skip_values(f, ntuples * ncomp, LEGACY_TYPE_SIZES[words[2].lower()], binary)
+                elif key == 'TEXTURE_COORDINATES':
+                    arrays.append(words[1])
+                    _skip_values(f, ntuples * int(words[2]), LEGACY_TYPE_SIZES[words[3].lower()], binary)
+                elif key == 'COLOR_SCALARS':
+                    arrays.append(words[1])
+                    _skip_values(f, ntuples * int(words[2]), 1, binary)
+                elif key == 'LOOKUP_TABLE':
+                    _skip_values(f, 4 * int(words[2]), 1, binary)
+                elif key == 'FIELD':
+                    for k in range(int(words[2])):
+                        header = f.readline().decode('ascii', 'replace').split()
+                        while len(header) == 0:
+                            header = f.readline().decode('ascii', 'replace').split()
+                        if header[0].upper() == 'METADATA':
+                            while len(f.readline().strip()) > 0:
+                                pass
+                            header = f.readline().decode('ascii', 'replace').split()
+                        if arrays is not None:
+                            arrays.append(header[0])
+                        _skip_values(f, int(header[1]) * int(header[2]), LEGACY_TYPE_SIZES[header[3].lower()], binary)
+                else:
+                    info['complete'] = False
+                    break
+            except (KeyError, IndexError, ValueError, TypeError):   # string / bit arrays, unknown types...
+                info['complete'] = False
+                break
+    return info
+
+def _xml_block_size(f, data_start, offset, header_type, compressed, encoded):
+    """Uncompressed size (bytes) of the appended data block at offset (encoded: base64 appended data)"""
+    hsize = 8 if header_type == 'UInt64' else 4
+    dtype = '<u8' if hsize == 8 else '<u4'
+    nbytes = 3 * hsize if compressed else hsize
+    f.seek(data_start + offset)
+    if encoded:
+        header = base64.b64decode(f.read(4 * ((nbytes + 2) // 3)))[0:nbytes]
+    else:
+        header = f.read(nbytes)
+    if not compressed:
+        return int(np.frombuffer(header, dtype)[0])
+    nblocks, blocksize, lastsize = np.frombuffer(header, dtype)
+    if nblocks == 0:
+        return 0
+    return int((nblocks - 1) * blocksize + (lastsize if lastsize > 0 else blocksize))
+
+def scan_xml_vtp(filename):
+    """Header information of a VTK XML polydata file (see scan_mesh). The XML header is read up to the appended data,
+    only the size of the connectivity blocks is read from the data"""
+    info = _empty_scan(filename, 'xml')
+    chunks = []
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 16)
+            chunks.append(chunk)
+            if not chunk or b'<AppendedData' in b''.join(chunks[-2:]):
+                break
+        head = b''.join(chunks)
+        appended = head.find(b'<AppendedData')
+        data_start = None
+        encoded = False
+        if appended >= 0:
+            encoded = b'base64' in head[appended:head.find(b'>', appended)]
+            data_start = head.find(b'_', head.find(b'>', appended)) + 1
+            head = head[0:appended]
+        head = head.decode('utf-8', 'replace')
+        vtkfile = dict(re.findall(r'(\w+)="([^"]*)"', re.search(r'<VTKFile[^>]*>', head).group(0)))
+        header_type = vtkfile.get('header_type', 'UInt32')
+        compressed = 'compressor' in vtkfile
+        info['format'] = 'xml' + (' compressed' if compressed else '')
+        piece = dict(re.findall(r'(\w+)="([^"]*)"', re.search(r'<Piece[^>]*>', head).group(0)))
+        info['points'] = int(piece.get('NumberOfPoints', 0))
+        for section, cell_type in XML_CELL_SECTIONS.items():
+            info['cells'][cell_type] = int(piece.get('NumberOf' + section, 0))
+        for section, key in [('PointData', 'point_arrays'), ('CellData', 'cell_arrays')]:
+            block = re.search(r'<' + section + r'[^>]*>(.*?)</' + section + '>', head, re.S)
+            if block is not None:
+                info[key] = re.findall(r'<DataArray[^>]*?Name="([^"]*)"', block.group(1))
+        for section, cell_type in XML_CELL_SECTIONS.items():
+            block = re.search(r'<' + section + r'>(.*?)</' + section + '>', head, re.S)
+            if block is None or info['cells'][cell_type] == 0:
+                continue
+            array = re.search(r'<DataArray([^>]*?Name="connectivity"[^>]*)>(.*?)</DataArray>|'
+                              r'<DataArray([^>]*?Name="connectivity"[^>]*)/>', block.group(1), re.S)
+            attributes = dict(re.findall(r'(\w+)="([^"]*)"', array.group(1) or array.group(3)))
+            size = XML_TYPE_SIZES.get(attributes.get('type'))
+            if attributes.get('format') == 'appended' and data_start is not None and size is not None:
+                nbytes = _xml_block_size(f, data_start, int(attributes['offset']), header_type, compressed, encoded)
+                info['connectivity'][cell_type] = nbytes // size
+            elif attributes.get('format') == 'ascii':
+                info['connectivity'][cell_type] = len(array.group(2).split())
+            elif attributes.get('format') == 'binary' and not compressed and size is not None:
+                hsize = 8 if header_type == 'UInt64' else 4
+                header = base64.b64decode(array.group(2).strip()[0:4 * ((hsize + 2) // 3)])
+                info['connectivity'][cell_type] = int(np.frombuffer(header[0:hsize], '<u8' if hsize == 8 else '<u4')[0]) // size
+            else:
+                info['complete'] = False
+    return info
+
+def scan_mesh(filename):
+    """Read only the headers of the VTK / VTP mesh filename. Return a dictionary with the format, number of points,
+    number of cells per type (verts, lines, polys, strips), connectivity sizes, point and cell array names and
+    'triangular' (all cells are triangles as required by the flattening, None if unknown). 'complete' is False if part
+    of the file could not be interpreted (e.g. string arrays), the information found before is returned"""
+    with open(filename, 'rb') as f:
+        head = f.read(64).lstrip()
+    if head.startswith(b'<?xml') or head.startswith(b'<VTKFile'):
+        info = scan_xml_vtp(filename)
+    else:
+        info = scan_legacy_vtk(filename)
+    other_cells = info['cells']['verts'] + info['cells']['lines'] + info['cells']['strips']
+    if other_cells > 0 or info['cells']['polys'] == 0:   # same as IsTriangularMesh: only triangles
+        info['triangular'] = False
+    elif 'polys' in info['connectivity']:
+        info['triangular'] = info['connectivity']['polys'] == 3 * info['cells']['polys']
+    info['bytes'] = os.path.getsize(filename)
+    return info
+
+###     Stage 4 cost model    ###
+# Time (s) and peak memory (bytes) of 4_flat_atria.py as a function of the number of vertices n and of boundary +
+# constraint points m. Solve and assembly grow as (n+m) log(n+m), the region labelling (set_piece_label) as n^2.
+# Default coefficients rescaled to a run of the current 4_flat_atria.py on data/output_example (13116 vertices, 761
+# boundary + constraint points, 55.6 s, 390 MB, set_piece_label is still 95% of the time). A single case does not fix
+# the ratio of the terms: refit with fit_flat_cost on the records written by 4_flat_atria.py --cost_log, and again
+# whenever stage 4 changes
+FLAT_COST_MODEL = {'time': [1.92, 3.75e-6, 3.08e-7],   # s: constant, (n+m) log2(n+m), n^2
+                   'memory': [266e6, 652.0]}          # bytes: constant, (n+m) log2(n+m)
+
+def _cost_features(npoints, nconstraints):
+    nm = npoints + nconstraints
+    return np.array([1.0, nm * math.log(max(nm, 2), 2), float(npoints) ** 2])
+
+def estimate_constraints(npoints):
+    """Typical number of boundary + constraint points of a mesh with npoints vertices (they lie on lines)"""
+    return int(7 * math.sqrt(npoints))
+
+def estimate_flat_cost(npoints, nconstraints=None, model=None):
+    """Predicted time (s) and peak memory (bytes) of 4_flat_atria.py for a mesh with npoints vertices"""
+    if model is None:
+        model = FLAT_COST_MODEL
+    if nconstraints is None:
+        nconstraints = estimate_constraints(npoints)
+    x = _cost_features(npoints, nconstraints)
+    return float(np.dot(model['time'], x)), float(np.dot(model['memory'], x[0:2]))
+
+def peak_memory():
+    """Peak resident memory of this process (bytes), None if unknown"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024   # bytes on macOS, KB on Linux
+
+def log_flat_cost(filename, meshfile, npoints, nconstraints, seconds, memory):
+    """Append the measured cost of a 4_flat_atria.py run to filename (one json record per line)"""
+    with open(filename, 'a') as f:
+        f.write(json.dumps({'mesh': meshfile, 'points': npoints, 'constraints': nconstraints, 'seconds': seconds,
+                            'memory': memory}) + '\n')
+
+def fit_flat_cost(filename):
+    """Fit the coefficients of the cost model (non negative least squares) to the records of filename (log_flat_cost).
+    Return a model dictionary for estimate_flat_cost"""
+    with open(filename) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if len(records) == 0:
+        raise ValueError('No records in ' + filename)
+    X = np.array([_cost_features(r['points'], r['constraints']) for r in records])
+    model = {}
+    for key, measured, ncoef in [('time', 'seconds', 3), ('memory', 'memory', 2)]:
+        rows = [k for k, r in enumerate(records) if r.get(measured) is not None]
+        y = np.array([records[k][measured] for k in rows])
+        default = np.array(FLAT_COST_MODEL[key])
+        if len(rows) >= 2 * ncoef:
+            model[key] = list(nnls(X[rows, 0:ncoef], y)[0])
+        elif len(rows) > 0:   # too few records to fit all the coefficients, scale the default ones
+            model[key] = list(default * np.mean(y / X[rows, 0:ncoef].dot(default)))
+        else:
+            model[key] = list(default)
+    return model
+
+def pack_jobs(times, nnodes):
+    """Distribute jobs with predicted times over nnodes nodes, longest first to the least loaded node. Return the list
+    of job indices of each node and the predicted load (s) of each node"""
+    nodes = [[] for _ in range(nnodes)]
+    load = np.zeros(nnodes)
+    for k in np.argsort(-np.asarray(times), kind='stable'):
+        node = int(np.argmin(load))
+        nodes[node].append(int(k))
+        load[node] += times[k]
+    return nodes, load
+
+###     Clip planes    ###
+# Clip planes of the veins computed by 1_mesh_standardisation.py: point and normal of pv1, pv2, pv3, pv4 and laa (if
+# not cut), one row per point / normal
+CLIP_PLANE_NAMES = ['pv1', 'pv2', 'pv3', 'pv4', 'laa']
+
+def save_clip_planes(filename, clip_planes):
+    """Save the clip planes (rows: point, normal, point, normal...) as csv (or in the case bundle)"""
+    with open_case_file(filename, 'w') as f:
+        np.savetxt(f, clip_planes, delimiter=',', fmt='%.9g')
+
+def read_clip_planes(filename):
+    """Clip planes saved with save_clip_planes, (5, 2, 3) array (plane, point / normal, xyz). NaN if the LAA was cut"""
+    with open_case_file(filename) as f:
+        planes = np.loadtxt(f, delimiter=',', ndmin=2)
+    out = np.full((len(CLIP_PLANE_NAMES), 2, 3), np.nan)
+    out[0:planes.shape[0] // 2] = planes[0:2 * (planes.shape[0] // 2)].reshape(-1, 2, 3)
+    return out
+
+def find_case_files(path, pattern):
+    """Files matching pattern in path (recursively), as regular files or stored in the case bundles"""
+    flush_bundles()   # bundles written by this process
+    files = []
+    for root, dirnames, filenames in os.walk(path):
+        names = set(fnmatch.filter(filenames, pattern))
+        for bundle in fnmatch.filter(filenames, '*' + BUNDLE_SUFFIX):
+            names.update(fnmatch.filter(bundle_groups(os.path.join(root, bundle)), pattern))
+        files += [os.path.join(root, name) for name in sorted(names)]
+    return files
+
+def read_cohort_clip_planes(files):
+    """Clip planes of several cases, (ncases, 5, 2, 3) array (see read_clip_planes)"""
+    return np.array([read_clip_planes(f) for f in files]).reshape(-1, len(CLIP_PLANE_NAMES), 2, 3)
+
+def export_clip_planes(files, filename):
+    """Write the clip planes of all the cases (files saved with save_clip_planes) in one table, one row per case:
+    .xlsx (needs xlsxwriter), .csv or .npz (case names and (ncases, 5, 2, 3) planes array, for a single np.load)"""
+    planes = read_cohort_clip_planes(files)
+    if filename.endswith('.npz'):
+        np.savez(filename, cases=np.array(files), planes=planes)
+        return
+    header = ['case'] + [p + '_' + c for p in CLIP_PLANE_NAMES for c in ['x', 'y', 'z', 'nx', 'ny', 'nz']]
+    rows = planes.reshape(len(files), -1)
+    if filename.endswith('.xlsx'):
+        try:
+            import xlsxwriter   # only needed for this export
+        except ImportError:
+            raise ImportError('xlsxwriter is not installed, export the clip planes as .csv or .npz instead')
+        workbook = xlsxwriter.Workbook(filename, {'nan_inf_to_errors': True})
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, header)
+        for i in range(len(files)):
+            worksheet.write(i + 1, 0, files[i])
+            worksheet.write_row(i + 1, 1, ['' if np.isnan(v) else v for v in rows[i]])
+        workbook.close()
+    else:
+        with open(filename, 'w') as f:
+            f.write(','.join(header) + '\n')
+            for i in range(len(files)):
+                f.write(files[i] + ',' + ','.join(['' if np.isnan(v) else '{:.9g}'.format(v) for v in rows[i]]) + '\n')
@@ -0,0 +1,35 @@
+"""
+    Copyright (c) - Marta Nunez Garcia
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version. This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+    Public License for more details. You should have received a copy of the GNU General Public License along with this
+    program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+    Collect the clip planes of all the cases of a cohort (saved by 1_mesh_standardisation.py) in a single table.
+
+    Input: folder with the cases (searched recursively, also inside the case bundles).
+    Output: one row per case with point and normal of each clip plane. xlsx (needs xlsxwriter), csv or npz.
+    Usage: python export_clip_planes.py --path data --output clip_planes.xlsx
+"""
+
+from cohort_functions import *
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--path', type=str, metavar='PATH', help='folder with the cases', required=True)
+parser.add_argument('--output', type=str, metavar='PATH', help='output table: .xlsx, .csv or .npz', required=True)
+parser.add_argument('--pattern', type=str, default='*_clip_planes.csv', help='file name pattern of the clip planes files')
+args = parser.parse_args()
+
+files = find_case_files(args.path, args.pattern)
+if len(files) == 0:
+    sys.exit('ERROR: no files matching ' + args.pattern + ' in ' + args.path)
+try:
+    export_clip_planes(files, args.output)
+except ImportError as e:
+    sys.exit('ERROR: ' + str(e))
+print('Clip planes of', len(files), 'cases written in', args.output)
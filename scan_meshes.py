@@ -0,0 +1,75 @@
+"""
+    Copyright (c) - Marta Nunez Garcia
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version. This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+    Public License for more details. You should have received a copy of the GNU General Public License along with this
+    program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+    Inspect all the meshes of a cohort before running the pipeline, reading only the file headers: number of points and
+    cells, cell types (non-triangular cells are reported) and point arrays. Predict the time and peak memory of
+    4_flat_atria.py for each mesh and distribute the cases over several nodes (longest first).
+
+    Input: folder with the meshes (searched recursively).
+    Output: table printed and saved as csv (optional), cases assigned to each node.
+    Usage: python scan_meshes.py --path data --pattern "*_clipped_c.vtk" --nodes 2
+"""
+
+from cohort_functions import *
+import fnmatch
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--path', type=str, metavar='PATH', help='folder with the meshes', required=True)
+parser.add_argument('--pattern', type=str, default='*_clipped_c.vtk', help='file name pattern of the meshes (closed mesh used by 4_flat_atria.py)')
+parser.add_argument('--output', type=str, metavar='PATH', default=None, help='csv file to save the table')
+parser.add_argument('--nodes', type=int, default=1, help='number of nodes to distribute the cases')
+parser.add_argument('--cost_log', type=str, metavar='PATH', default=None, help='records written by 4_flat_atria.py --cost_log, used to fit the cost model (default coefficients otherwise)')
+args = parser.parse_args()
+
+files = []
+for root, dirnames, filenames in os.walk(args.path):
+    for filename in sorted(fnmatch.filter(filenames, args.pattern)):
+        files.append(os.path.join(root, filename))
+if len(files) == 0:
+    sys.exit('ERROR: no files matching ' + args.pattern + ' in ' + args.path)
+
+model = FLAT_COST_MODEL
+if args.cost_log is not None:
+    model = fit_flat_cost(args.cost_log)
+    print('Cost model fitted to', args.cost_log, model)
+
+rows = []
+for f in files:
+    try:
+        info = scan_mesh(f)
+    except (IOError, OSError, ValueError) as e:
+        print('WARNING: could not read', f, '(' + str(e) + ')')
+        continue
+    seconds, memory = estimate_flat_cost(info['points'], model=model)
+    rows.append([f, info['format'], info['points'], info['cells']['polys'], info['triangular'],
+                 ' '.join(info['point_arrays']), seconds, memory / 1e6])
+    if info['triangular'] is False:
+        print('WARNING: non-triangular cells in', f, info['cells'])
+    if not info['complete']:
+        print('WARNING: header of', f, 'only partially read')
+
+header = ['file', 'format', 'points', 'polys', 'triangular', 'point_arrays', 'time_s', 'memory_mb']
+print(','.join(header))
+for r in rows:
+    print('{},{},{},{},{},{},{:.1f},{:.0f}'.format(*r))
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        f.write(','.join(header) + '\n')
+        for r in rows:
+            f.write('{},{},{},{},{},{},{:.1f},{:.0f}\n'.format(*r))
+
+nodes, load = pack_jobs([r[6] for r in rows], args.nodes)
+for k in range(args.nodes):
+    print('\nNode', k, '- predicted time {:.0f} s, peak memory per case up to {:.0f} MB'.format(
+        load[k], max([rows[j][7] for j in nodes[k]] + [0])))
+    for j in nodes[k]:
+        print('   ', rows[j][0])
@@ -0,0 +1,162 @@
+import numpy as np
+from scipy import sparse
+import scipy.sparse.linalg as linalg_sp
+from scipy.sparse import csc_matrix, coo_matrix
+try:   # optional, sparse Cholesky factorization (scikit-sparse)
+    from sksparse.cholmod import cholesky as cholmod_cholesky
+except ImportError:
+    cholmod_cholesky = None
+try:   # optional, algebraic multigrid preconditioner
+    import pyamg
+except ImportError:
+    pyamg = None
+
+ITERATIVE_METHODS = ['cg', 'amg']
+RESIDUAL_MARGIN = 10   # iterative solutions with a true relative residual above RESIDUAL_MARGIN * tol raise ConvergenceError
+MAX_RESTARTS = 4   # restarts with a tighter stop criterion while the true residual is above tol
+
+###     Linear solvers    ###
+
+class ConvergenceError(Exception):
+    """The iterative solver did not reach its tolerance"""
+
+def scatter_matrix(ids, n):
+    """Sparse (n x len(ids)) matrix S such that S.dot(t) is a length n vector with t[k] placed in position ids[k].
+    Same result as r = np.zeros(n); r[ids] = t, i.e. if an id is repeated the last value is kept"""
+    ids = np.asarray(ids).astype(int)
+    # keep only the last occurrence of each repeated id
+    _, last = np.unique(ids[::-1], return_index=True)
+    keep = ids.size - 1 - last
+    return coo_matrix((np.ones(keep.size), (ids[keep], keep)), shape=(n, ids.size)).tocsr()
+
+def selection_matrix(ids, n):
+    """Sparse (len(ids) x n) matrix M with a single 1 per row, in column ids[k]. M.dot(x) = x[ids]"""
+    ids = np.asarray(ids).astype(int)
+    return coo_matrix((np.ones(ids.size), (np.arange(ids.size), ids)), shape=(ids.size, n)).tocsr()
+
+def krylov(solver, A, b, x0=None, tol=1e-8, maxiter=None, M=None):
+    """scipy cg / minres, compatible with old (tol) and new (rtol) scipy versions"""
+    try:
+        return solver(A, b, x0=x0, rtol=tol, maxiter=maxiter, M=M)
+    except TypeError:
+        return solver(A, b, x0=x0, tol=tol, maxiter=maxiter, M=M)
+
+def relative_residual(A, x, b):
+    """|A x - b| / |b| of each column of x and b (absolute residual if b is zero)"""
+    norm_b = np.linalg.norm(b, axis=0)
+    return np.linalg.norm(A.dot(x) - b, axis=0) / np.where(norm_b > 0, norm_b, 1.0)
+
+def jacobi_preconditioner(A):
+    """Inverse of the (absolute value of the) diagonal of A"""
+    d = np.abs(A.diagonal())
+    d[d == 0] = 1.0
+    return sparse.diags(1.0 / d)
+
+class SparseSolver(object):
+    """Solve the sparse linear system A x = R t factorizing A only once.
+    R maps the target vector(s) t (e.g. (x0, y0) positions) to the right hand side. If R is None, t is directly the
+    right hand side. Several right hand sides can be given as columns of t and are solved in a single pass.
+    Keep the solver to solve again the same system (same mesh, same boundary/constraint ids) with new targets.
+    n is the number of unknowns to return (the rest, if any, are Lagrange multipliers).
+    If some unknowns were eliminated (known values moved to the right hand side), E and F rebuild the complete
+    solution as E x + F t.
+    method: 'lu' (scipy splu), 'cholesky' (symmetric positive definite A, needs scikit-sparse, LU otherwise),
+    'cg' (Jacobi preconditioned conjugate gradient) or 'amg' (algebraic multigrid preconditioner, needs pyamg, Jacobi
+    otherwise). Iterative methods need a symmetric A and stop when the relative residual is below tol (or after maxiter
+    iterations). If P is given, A is only symmetric (indefinite): MINRES is used instead of conjugate gradient and the
+    preconditioner is built from the symmetric positive definite P instead of A. The true residual is checked
+    afterwards, the solve is restarted from the last solution with a tighter stop criterion while it is above tol and
+    ConvergenceError is raised if it stays well above tol (RESIDUAL_MARGIN). There is no fallback to a direct solver"""
+    def __init__(self, A, R=None, n=None, E=None, F=None, method='lu', tol=1e-8, maxiter=None, P=None):
+        self.A = csc_matrix(A)
+        self.P = P
+        self.R = R
+        self.n = self.A.shape[1] if n is None else n
+        self.E = E
+        self.F = F
+        self.method = method
+        self.tol = tol
+        self.krylov_tol = tol   # stop criterion handed to the iterative solver, tightened by iterate()
+        self.maxiter = maxiter
+        self.factor = None
+
+    def factorize(self):
+        """Compute the factorization, or the preconditioner for iterative methods (only the first time)"""
+        if self.factor is None:
+            if self.method in ITERATIVE_METHODS:
+                P = (self.A if self.P is None else self.P).tocsr()
+                if self.method == 'amg' and pyamg is None:
+                    print('WARNING: pyamg is not installed, using Jacobi preconditioner instead of algebraic multigrid')
+                    self.method = 'cg'
+                if self.method == 'amg':
+                    self.factor = pyamg.smoothed_aggregation_solver(P, symmetry='symmetric').aspreconditioner()
+                else:
+                    self.factor = jacobi_preconditioner(P)
+                return self.factor
+            if self.method == 'cholesky' and cholmod_cholesky is not None:
+                try:
+                    self.factor = cholmod_cholesky(self.A)
+                    return self.factor
+                except Exception:
+                    print('WARNING: Cholesky factorization failed (matrix not positive definite), using LU instead')
+            elif self.method == 'cholesky':
+                print('WARNING: scikit-sparse is not installed, using LU instead of Cholesky factorization')
+            self.method = 'lu'
+            self.factor = linalg_sp.splu(self.A)
+        return self.factor
+
+    def solve(self, b, x0=None):
+        """Solve A x = b. b can be a vector or a (n, k) array with one right hand side per column.
+        x0 (one column per right hand side) is the initial guess of the iterative methods, ignored by direct methods"""
+        b = np.asarray(b, dtype=float)
+        factor = self.factorize()
+        if self.method in ITERATIVE_METHODS:
+            b2 = b.reshape(b.shape[0], -1)
+            x = np.zeros((self.A.shape[1], b2.shape[1]))
+            if x0 is not None:
+                x0 = np.asarray(x0, dtype=float).reshape(x.shape)
+            iterative = linalg_sp.cg if self.P is None else linalg_sp.minres
+            for k in range(b2.shape[1]):
+                x[:, k] = self.iterate(iterative, b2[:, k], None if x0 is None else x0[:, k])
+            return x.reshape((self.A.shape[1],) + b.shape[1:])
+        if self.method == 'cholesky':
+            return factor(b)
+        return factor.solve(b)
+
+    def iterate(self, iterative, b, x0=None):
+        """Iterative solve of A x = b (one right hand side) until the true relative residual is below tol. The stop
+        criterion of the solvers (preconditioned residual for MINRES, recurrence for cg) can be far from it: restart
+        from the last solution with a tighter one, kept for the next right hand sides. Raise ConvergenceError if the
+        residual stays above RESIDUAL_MARGIN * tol"""
+        tol = self.krylov_tol
+        x = x0
+        for restart in range(MAX_RESTARTS + 1):
+            x, info = krylov(iterative, self.A, b, x, tol, self.maxiter, self.factor)
+            residual = relative_residual(self.A, x, b)
+            if residual <= self.tol:
+                return x
+            tol = tol * min(0.1, self.tol / residual)
+            self.krylov_tol = tol
+        if residual > RESIDUAL_MARGIN * self.tol:
+            raise ConvergenceError('{} relative residual {:.2e} above tolerance {} after {} restarts, use a larger tol or '
+                                   'maxiter, or a direct solver (lu)'.format(self.method, residual, self.tol, MAX_RESTARTS))
+        return x
+
+    def solve_targets(self, t, x_init=None):
+        """Solve A x = R t and return the first n unknowns (or the complete solution E x + F t).
+        x_init: initial guess for iterative methods given as complete solution (e.g. a previous embedding)"""
+        t = np.asarray(t, dtype=float)
+        if self.R is None:
+            b = t
+        else:
+            b = self.R.dot(t)
+        if x_init is not None:
+            x_init = np.asarray(x_init, dtype=float)
+            if self.E is not None:
+                x_init = self.E.T.dot(x_init)   # keep only the unknowns that were not eliminated
+            elif x_init.shape[0] < self.A.shape[1]:   # no initial guess for the Lagrange multipliers
+                x_init = np.concatenate([x_init, np.zeros((self.A.shape[1] - x_init.shape[0],) + x_init.shape[1:])])
+        x = self.solve(b, x_init)[0:self.n]
+        if self.E is not None:
+            x = self.E.dot(x) + self.F.dot(t)
+        return x
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import vtk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def bump_mesh(resolution=16):
+    """Triangulated unit square with a bump (z = x^2 + y^2), same topology as a clipped atrium (a disk)"""
+    plane = vtk.vtkPlaneSource()
+    plane.SetOrigin(-1, -1, 0)
+    plane.SetPoint1(1, -1, 0)
+    plane.SetPoint2(-1, 1, 0)
+    plane.SetResolution(resolution, resolution)
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(plane.GetOutputPort())
+    triangles.Update()
+    m = triangles.GetOutput()
+    points = m.GetPoints()
+    for i in range(m.GetNumberOfPoints()):
+        x, y, _ = points.GetPoint(i)
+        points.SetPoint(i, x, y, 0.5 * (x ** 2 + y ** 2))
+    return m
+
+
+@pytest.fixture
+def disk_case():
+    """Mesh, boundary ids and targets (circle of radius 0.5) and a few interior constraint points"""
+    from aux_functions import ExtractVTKPoints
+    m = bump_mesh()
+    xyz = ExtractVTKPoints(m)
+    boundary = np.where(np.max(np.abs(xyz[:, 0:2]), axis=1) > 0.999)[0]
+    angle = np.arctan2(xyz[boundary, 1], xyz[boundary, 0])
+    constraints = np.where((np.abs(xyz[:, 0]) < 0.01) & (np.abs(xyz[:, 1]) < 0.6))[0]
+    return (m, boundary, constraints, 0.5 * np.cos(angle), 0.5 * np.sin(angle),
+            0.2 * xyz[constraints, 0], 0.25 * xyz[constraints, 1])
@@ -0,0 +1,67 @@
+import os
+import zipfile
+
+import numpy as np
+import pytest
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+from aux_functions import ExtractVTKPoints, readvtk, writevtk
+from bundle_functions import (bundle_groups, case_file_exists, case_name, flush_bundles, get_case_bundle, open_case_file,
+                              remove_case_files, set_case_bundle)
+from cohort_functions import find_case_files
+from conftest import bump_mesh
+
+
+@pytest.fixture
+def case_bundle(monkeypatch):
+    previous = get_case_bundle()
+    monkeypatch.setenv('LA_CASE_BUNDLE', '1' if previous else '0')
+    set_case_bundle(True)
+    yield
+    set_case_bundle(previous)
+
+
+def test_case_name():
+    assert case_name('/data/LA_clipped_c_cont_mv.vtk') == 'LA'
+    assert case_name('P_01_clipped_cpath1_prop.vtk') == 'P_01'
+    assert case_name('P_01_clipseeds.vtp') == 'P_01'
+
+
+def test_bundle_round_trip(tmp_path, case_bundle):
+    m = bump_mesh(4)
+    labels = numpy_to_vtk(np.arange(m.GetNumberOfPoints(), dtype=np.int32))
+    labels.SetName('autolabels')
+    m.GetPointData().AddArray(labels)
+    for case in ['LA', 'RA']:
+        writevtk(m, str(tmp_path / (case + '_clipped_c_cont_mv.vtk')))
+        with open_case_file(str(tmp_path / (case + '_clipped_c_div_lines.txt')), 'w') as f:
+            f.write(case + '\n')
+    assert os.listdir(str(tmp_path)) == []   # written at exit
+    flush_bundles()
+    assert sorted(os.listdir(str(tmp_path))) == ['LA_bundle.zip', 'RA_bundle.zip']   # one bundle per case
+    assert bundle_groups(str(tmp_path / 'LA_bundle.zip')) == {'LA_clipped_c_cont_mv.vtk', 'LA_clipped_c_div_lines.txt'}
+
+    m2 = readvtk(str(tmp_path / 'LA_clipped_c_cont_mv.vtk'))
+    assert np.array_equal(ExtractVTKPoints(m2), ExtractVTKPoints(m))
+    assert np.array_equal(vtk_to_numpy(m2.GetPointData().GetArray('autolabels')), np.arange(m.GetNumberOfPoints()))
+    with open_case_file(str(tmp_path / 'RA_clipped_c_div_lines.txt')) as f:
+        assert f.read() == 'RA\n'
+    assert len(find_case_files(str(tmp_path), '*_cont_mv.vtk')) == 2
+
+    remove_case_files(str(tmp_path / '*_cont_*.vtk'))
+    assert not case_file_exists(str(tmp_path / 'LA_clipped_c_cont_mv.vtk'))
+    assert case_file_exists(str(tmp_path / 'LA_clipped_c_div_lines.txt'))
+
+
+def test_bundle_newest_version_written_once(tmp_path, case_bundle):
+    filename = str(tmp_path / 'LA_clipped_c_div_lines.txt')
+    for run in range(3):
+        with open_case_file(filename, 'w') as f:
+            f.write('run {}\n'.format(run))
+    flush_bundles()
+    with zipfile.ZipFile(str(tmp_path / 'LA_bundle.zip')) as z:
+        assert z.namelist() == ['LA_clipped_c_div_lines.txt']
+        assert z.read('LA_clipped_c_div_lines.txt') == b'run 2\n'
+    remove_case_files(str(tmp_path / '*_div_lines.txt'))
+    flush_bundles()
+    assert os.listdir(str(tmp_path)) == []
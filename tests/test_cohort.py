@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from aux_functions import writevtk, writevtp
+from cohort_functions import (estimate_flat_cost, export_clip_planes, find_case_files, fit_flat_cost, log_flat_cost,
+                              read_clip_planes, save_clip_planes, scan_mesh)
+from conftest import bump_mesh
+
+
+@pytest.mark.parametrize('extension,fmt', [('.vtk', 'binary'), ('.vtk', 'ascii'), ('.vtp', 'binary'), ('.vtp', 'zlib')])
+def test_scan_mesh_matches_reader(tmp_path, extension, fmt):
+    m = bump_mesh(5)
+    filename = str(tmp_path / ('case' + extension))
+    (writevtk if extension == '.vtk' else writevtp)(m, filename, fmt)
+    info = scan_mesh(filename)
+    assert info['points'] == m.GetNumberOfPoints()
+    assert info['cells']['polys'] == m.GetNumberOfCells()
+    assert info['triangular'] and info['complete']
+    assert set(info['point_arrays']) == {m.GetPointData().GetArrayName(i) for i in range(m.GetPointData().GetNumberOfArrays())}
+
+
+def test_fit_flat_cost_recovers_model(tmp_path):
+    model = {'time': [1.0, 2e-6, 4e-7], 'memory': [100e6, 500.0]}
+    filename = str(tmp_path / 'costs.jsonl')
+    for n in [2000, 5000, 10000, 20000, 40000, 80000]:
+        seconds, memory = estimate_flat_cost(n, 7 * int(np.sqrt(n)), model)
+        log_flat_cost(filename, 'case.vtk', n, 7 * int(np.sqrt(n)), seconds, memory)
+    fitted = fit_flat_cost(filename)
+    for key in ['time', 'memory']:
+        assert np.allclose(fitted[key], model[key], rtol=1e-4)
+
+
+def test_fit_flat_cost_scales_defaults_with_few_records(tmp_path):
+    filename = str(tmp_path / 'costs.jsonl')
+    seconds, memory = estimate_flat_cost(13116, 761)
+    log_flat_cost(filename, 'case.vtk', 13116, 761, 2 * seconds, None)
+    fitted = fit_flat_cost(filename)
+    assert np.isclose(estimate_flat_cost(13116, 761, fitted)[0], 2 * seconds)
+    assert np.isclose(estimate_flat_cost(13116, 761, fitted)[1], memory)
+
+
+def test_clip_planes_round_trip_and_export(tmp_path):
+    planes = np.arange(30, dtype=float).reshape(10, 3) / 7
+    save_clip_planes(str(tmp_path / 'LA_clip_planes.csv'), planes)
+    save_clip_planes(str(tmp_path / 'RA_clip_planes.csv'), planes[0:8])   # LAA cut
+    read = read_clip_planes(str(tmp_path / 'LA_clip_planes.csv'))
+    assert np.allclose(read.reshape(10, 3), planes, rtol=1e-8)
+    assert np.all(np.isnan(read_clip_planes(str(tmp_path / 'RA_clip_planes.csv'))[4]))
+
+    files = find_case_files(str(tmp_path), '*_clip_planes.csv')
+    export_clip_planes(files, str(tmp_path / 'cohort.npz'))
+    cohort = np.load(str(tmp_path / 'cohort.npz'))
+    assert list(cohort['cases']) == files and cohort['planes'].shape == (2, 5, 2, 3)
+    export_clip_planes(files, str(tmp_path / 'cohort.csv'))
+    with open(str(tmp_path / 'cohort.csv')) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 3 and len(lines[1].split(',')) == 31
+    assert lines[2].endswith(',' * 6)   # no LAA plane
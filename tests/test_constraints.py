@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from aux_functions import check_flat_constraints
+
+
+def test_repeated_ids_keep_last_target():
+    ids = np.array([3, 5, 3, 7, 3])
+    x0 = np.array([0., 1, 2, 3, 4])
+    y0 = np.array([0., 1, 2, 3, 5])
+    keep_b, keep_c = check_flat_constraints(10, ids, np.array([], dtype=int), x0, y0, np.array([]), np.array([]))
+    assert list(keep_b) == [1, 3, 4]
+    # same result as the scatter r[ids] = t of the unchecked system
+    r = np.zeros(10)
+    r[ids] = x0
+    assert np.array_equal(r[ids[keep_b]], x0[keep_b])
+
+
+def test_out_of_range_and_boundary_constraints_are_dropped():
+    b = np.array([0, 1, 2, 12])
+    c = np.array([2, 4, -1])
+    keep_b, keep_c = check_flat_constraints(10, b, c, np.arange(4.), np.zeros(4), np.array([2., 9, 9]), np.zeros(3))
+    assert list(keep_b) == [0, 1, 2]
+    assert list(keep_c) == [1]   # 2 is a boundary point with the same target, -1 out of range
+
+
+def test_conflicts_raise_without_repair():
+    with pytest.raises(ValueError):
+        check_flat_constraints(10, np.array([1, 1]), np.array([], dtype=int), np.array([0., 1]), np.zeros(2),
+                               np.array([]), np.array([]), repair=False)
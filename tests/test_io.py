@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+from aux_functions import (ExtractVTKPoints, get_output_format, is_xml_file, load_remaining_arrays, readvtk, readvtp,
+                           readvtk_concurrent, set_output_format, writevtk, writevtp)
+from conftest import bump_mesh
+
+
+def carto_mesh():
+    """Mesh with a label array and two continuous maps"""
+    m = bump_mesh(4)
+    m.GetPointData().Initialize()   # no normals and texture coordinates
+    n = m.GetNumberOfPoints()
+    for name, values in [('autolabels', np.arange(n) % 5), ('voltage', np.linspace(0, 3, n)), ('LAT', np.arange(n) * 2.0)]:
+        array = numpy_to_vtk(values)
+        array.SetName(name)
+        m.GetPointData().AddArray(array)
+    return m
+
+
+def point_arrays(m):
+    data = m.GetPointData()
+    return {data.GetArrayName(i): vtk_to_numpy(data.GetArray(i)) for i in range(data.GetNumberOfArrays())}
+
+
+@pytest.fixture
+def compressed_output(monkeypatch):
+    previous = get_output_format()
+    monkeypatch.setenv('LA_OUTPUT_FORMAT', previous)   # set_output_format also sets it, restored after the test
+    set_output_format('zlib')
+    yield
+    set_output_format(previous)
+
+
+def test_legacy_output_with_compressed_format(tmp_path, compressed_output):
+    m = bump_mesh(4)
+    intermediate = str(tmp_path / 'case_to_be_flat.vtk')
+    final = str(tmp_path / 'case_flat.vtk')
+    writevtk(m, intermediate)
+    writevtk(m, final, legacy=True)
+    assert is_xml_file(intermediate)
+    assert not is_xml_file(final)
+    for filename in [intermediate, final]:
+        assert np.array_equal(ExtractVTKPoints(readvtk(filename)), ExtractVTKPoints(m))
+
+
+def test_compressed_vtp(tmp_path, compressed_output):
+    m = carto_mesh()
+    filename = str(tmp_path / 'case_autolabels.vtp')
+    writevtp(m, filename)
+    with open(filename, 'rb') as f:
+        assert b'vtkZLibDataCompressor' in f.read(1024)
+    raw = str(tmp_path / 'raw.vtp')
+    writevtp(m, raw, 'binary')
+    assert os.path.getsize(filename) < os.path.getsize(raw)
+
+
+@pytest.mark.parametrize('extension, type', [('.vtk', 'binary'), ('.vtk', 'zlib'), ('.vtp', 'zlib')])
+def test_selected_arrays_and_remaining_arrays(tmp_path, extension, type):
+    m = carto_mesh()
+    filename = str(tmp_path / ('case' + extension))
+    (writevtk if extension == '.vtk' else writevtp)(m, filename, type)
+    read = readvtk if extension == '.vtk' else readvtp
+    assert set(point_arrays(read(filename, arrays=['autolabels']))) == {'autolabels'}
+    assert set(point_arrays(read(filename, exclude=['LAT']))) == {'autolabels', 'voltage'}
+    partial = read(filename, arrays=['autolabels'])
+    load_remaining_arrays(partial, filename)
+    expected = point_arrays(m)
+    arrays = point_arrays(partial)
+    assert set(arrays) == set(expected)
+    for name in expected:
+        assert np.array_equal(arrays[name], expected[name])
+
+
+def test_concurrent_reader_matches_readvtk(tmp_path):
+    m = carto_mesh()
+    filenames = [str(tmp_path / 'legacy.vtk'), str(tmp_path / 'xml.vtp')]
+    writevtk(m, filenames[0], 'binary')
+    writevtp(m, filenames[1], 'zlib')
+    meshes = readvtk_concurrent(filenames + [filenames[0]])
+    assert len(meshes) == 3
+    for filename, mesh in zip(filenames + [filenames[0]], meshes):
+        expected = readvtk(filename)
+        assert np.array_equal(ExtractVTKPoints(mesh), ExtractVTKPoints(expected))
+        assert mesh.GetNumberOfCells() == expected.GetNumberOfCells()
+        assert np.array_equal(point_arrays(mesh)['voltage'], point_arrays(expected)['voltage'])
+    assert readvtk_concurrent([]) == []
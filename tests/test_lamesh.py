@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from vtk.util.numpy_support import numpy_to_vtk
+
+from aux_functions import (ExtractVTKPoints, ExtractVTKTriFaces, LAMesh, cellthreshold, extractlargestregion,
+                           pointthreshold)
+from conftest import bump_mesh
+
+
+def labelled_mesh():
+    m = bump_mesh(8)
+    xyz = ExtractVTKPoints(m)
+    labels = numpy_to_vtk((xyz[:, 0] > 0.3).astype(np.float64) + (xyz[:, 1] > 0.5))
+    labels.SetName('autolabels')
+    m.GetPointData().AddArray(labels)
+    return m
+
+
+def sorted_rows(points):
+    points = np.asarray(points, dtype=np.float64)
+    return points[np.lexsort(points.T[::-1])]
+
+
+@pytest.mark.parametrize('alloff', [0, 1])
+def test_threshold_points_matches_pointthreshold(alloff):
+    m = labelled_mesh()
+    sub, point_ids, cell_ids = LAMesh.from_polydata(m).threshold_points('autolabels', 1, 2, all_points=not alloff)
+    expected = pointthreshold(m, 'autolabels', 1, 2, alloff)
+    assert sub.n_cells == expected.GetNumberOfCells()
+    assert np.array_equal(sorted_rows(sub.points), sorted_rows(ExtractVTKPoints(expected)))
+    assert np.array_equal(sub.points, ExtractVTKPoints(m)[point_ids])
+    assert np.array_equal(point_ids[sub.triangles], ExtractVTKTriFaces(m)[cell_ids])
+
+
+def test_threshold_cells_and_largest_region():
+    m = labelled_mesh()
+    region = np.zeros(m.GetNumberOfCells())
+    region[0:10] = 1
+    region[-10:] = 1   # two separate regions, same size
+    region[-11] = 1
+    array = numpy_to_vtk(region)
+    array.SetName('region')
+    m.GetCellData().AddArray(array)
+    mesh = LAMesh.from_polydata(m)
+    sub = mesh.threshold_cells('region', 1, 1)[0]
+    assert sub.n_cells == cellthreshold(m, 'region', 1, 1).GetNumberOfCells() == 21
+    assert sub.cell_regions()[1] == 2
+    largest = sub.largest_region()[0]
+    assert largest.n_cells == extractlargestregion(sub.to_polydata()).GetNumberOfCells() == 11
+
+
+def test_polydata_round_trip():
+    m = labelled_mesh()
+    mesh = LAMesh.from_polydata(m, arrays=['autolabels'])
+    pd = mesh.to_polydata()
+    assert np.array_equal(ExtractVTKPoints(pd), ExtractVTKPoints(m))
+    assert np.array_equal(ExtractVTKTriFaces(pd), ExtractVTKTriFaces(m))
+    assert pd.GetPointData().GetNumberOfArrays() == 1
@@ -0,0 +1,31 @@
+import numpy as np
+from scipy import sparse
+
+from aux_functions import ComputeLaplacian, ExtractVTKPoints, ExtractVTKTriFaces
+from conftest import bump_mesh
+
+
+def laplacian_reference(vertex, faces):
+    """Cotangent Laplacian summed one corner at a time, as the original ComputeLaplacian"""
+    n = vertex.shape[1]
+    W = sparse.coo_matrix((n, n))
+    for i in range(3):
+        i1, i2, i3 = i, (i + 1) % 3, (i + 2) % 3
+        pp = vertex[:, faces[i2, :]] - vertex[:, faces[i1, :]]
+        qq = vertex[:, faces[i3, :]] - vertex[:, faces[i1, :]]
+        pp = pp / np.sqrt(np.sum(pp ** 2, axis=0))
+        qq = qq / np.sqrt(np.sum(qq ** 2, axis=0))
+        w = 1 / np.tan(np.arccos(np.clip(np.sum(pp * qq, axis=0), -1.0, 1.0)))
+        W = W + sparse.coo_matrix((w, (faces[i2, :], faces[i3, :])), shape=(n, n))
+        W = W + sparse.coo_matrix((w, (faces[i3, :], faces[i2, :])), shape=(n, n))
+    return sparse.dia_matrix((W.sum(axis=0), 0), shape=(n, n)) - W
+
+
+def test_laplacian_matches_reference():
+    m = bump_mesh(8)
+    vertex = ExtractVTKPoints(m).T
+    faces = ExtractVTKTriFaces(m).T
+    L = ComputeLaplacian(vertex, faces)
+    assert sparse.isspmatrix_csr(L)
+    assert abs(L - laplacian_reference(vertex.astype(float), faces)).max() < 1e-12
+
@@ -0,0 +1,25 @@
+import gc
+
+import aux_functions
+from aux_functions import LazyLocator, clear_locators, get_locator
+from conftest import bump_mesh
+
+
+def test_locator_shared_and_released_with_dataset():
+    clear_locators()
+    m = bump_mesh(4)
+    locator = get_locator(m)
+    assert get_locator(m) is locator
+    assert LazyLocator(m).FindClosestPoint(m.GetPoint(7)) == 7
+    del m
+    gc.collect()
+    assert len(aux_functions._locators) == 0
+
+
+def test_locator_follows_modified_dataset():
+    m = bump_mesh(4)
+    assert get_locator(m).FindClosestPoint((5, 5, 5)) != 3
+    m.GetPoints().SetPoint(3, 5, 5, 5)
+    m.GetPoints().Modified()
+    assert get_locator(m).FindClosestPoint((5, 5, 5)) == 3
+    clear_locators()
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+import vtk
+
+from aux_functions import DeleteNonTriangularFaces, ExtractVTKPoints, ExtractVTKTriFaces, IsTriangularMesh
+from conftest import bump_mesh
+
+
+def test_points_and_faces_match_cell_loop():
+    m = bump_mesh(6)
+    points = ExtractVTKPoints(m)
+    faces = ExtractVTKTriFaces(m)
+    assert points.dtype == np.float64
+    assert np.array_equal(points, np.array([m.GetPoint(i) for i in range(m.GetNumberOfPoints())]))
+    expected = np.zeros((m.GetNumberOfCells(), 3), dtype=int)
+    for i in range(m.GetNumberOfCells()):
+        ids = vtk.vtkIdList()
+        m.GetCellPoints(i, ids)
+        expected[i] = [ids.GetId(k) for k in range(3)]
+    assert np.array_equal(faces, expected)
+    assert not faces.flags.writeable   # view of the vtk buffer
+
+
+def test_non_triangular_cells():
+    plane = vtk.vtkPlaneSource()
+    plane.SetResolution(3, 3)
+    plane.Update()
+    quads = plane.GetOutput()
+    assert not IsTriangularMesh(quads)
+    with pytest.raises(Exception):
+        ExtractVTKTriFaces(quads)
+    assert IsTriangularMesh(bump_mesh(3))
+    assert DeleteNonTriangularFaces(quads).GetNumberOfCells() == 0
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+
+from aux_functions import ExtractVTKPoints, readvtk, writevtk
+from bundle_functions import MESH_CACHE_DIR, get_mesh_cache, load_mesh_cache, mesh_cache_dir, set_mesh_cache
+from conftest import bump_mesh
+
+
+@pytest.fixture
+def mesh_cache(monkeypatch):
+    previous = get_mesh_cache()
+    monkeypatch.setenv('LA_MESH_CACHE', '1' if previous else '0')
+    set_mesh_cache(True)
+    yield
+    set_mesh_cache(previous)
+
+
+def cache_files(filename):
+    return sorted(f for f in os.listdir(mesh_cache_dir(filename)) if f.endswith('.npy'))
+
+
+def test_mesh_cache_round_trip(tmp_path, mesh_cache):
+    m = bump_mesh(4)
+    filename = str(tmp_path / 'LA_clipped_c.vtk')
+    writevtk(m, filename)
+    assert os.path.isdir(str(tmp_path / MESH_CACHE_DIR))
+    cached = load_mesh_cache(filename)
+    assert isinstance(cached['points'], np.memmap)
+    m2 = readvtk(filename)
+    assert np.array_equal(ExtractVTKPoints(m2), ExtractVTKPoints(m))
+    assert m2.GetNumberOfCells() == m.GetNumberOfCells()
+
+
+def test_mesh_cache_never_overwrites_mapped_files(tmp_path, mesh_cache):
+    m = bump_mesh(4)
+    filename = str(tmp_path / 'LA_clipped_c.vtk')
+    writevtk(m, filename)
+    files = cache_files(filename)
+    old_points = load_mesh_cache(filename)['points']
+    expected = np.array(old_points)
+
+    writevtk(readvtk(filename), filename)   # same content (the mesh read from the cache): same files
+    assert cache_files(filename) == files
+
+    m.GetPoints().SetPoint(0, 5, 5, 5)
+    m.Modified()
+    writevtk(m, filename)
+    assert cache_files(filename) != files
+    assert np.array_equal(old_points, expected)   # the mapped old version is untouched
+    assert np.array_equal(load_mesh_cache(filename)['points'][0], [5, 5, 5])
@@ -0,0 +1,20 @@
+import numpy as np
+
+from aux_functions import ORIGINAL_IDS, ExtractVTKPoints, closest_point_ids, extractboundaryedge, original_point_ids
+from conftest import bump_mesh
+
+
+def test_boundary_edge_original_ids():
+    m = bump_mesh(8)
+    assert extractboundaryedge(m).GetPointData().GetArray(ORIGINAL_IDS) is None   # opt in only
+    edges = extractboundaryedge(m, original_ids=True)
+    ids = original_point_ids(edges, m)
+    assert np.array_equal(ids, closest_point_ids(m, edges))
+    assert np.array_equal(ExtractVTKPoints(m)[ids], ExtractVTKPoints(edges))
+
+
+def test_original_ids_of_another_mesh_fall_back_to_closest_point():
+    m = bump_mesh(8)
+    edges = extractboundaryedge(m, original_ids=True)
+    other = bump_mesh(4)   # the ids in the array do not refer to this mesh
+    assert np.array_equal(original_point_ids(edges, other), closest_point_ids(other, edges))
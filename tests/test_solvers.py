@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+from scipy import sparse
+import scipy.sparse.linalg as linalg_sp
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+from aux_functions import ExtractVTKPoints, flat, flat_polydata, flat_w_constraints, flat_w_constraints_sweep
+from solver_functions import ConvergenceError, SparseSolver, pyamg
+
+
+def laplacian_1d(n):
+    return sparse.diags([-np.ones(n - 1), 2.0 * np.ones(n), -np.ones(n - 1)], [-1, 0, 1], format='csc')
+
+
+def test_cg_matches_lu_on_spd_system():
+    A = laplacian_1d(200)
+    b = np.random.RandomState(0).rand(200, 2)
+    x_lu = SparseSolver(A).solve(b)
+    solver = SparseSolver(A, method='cg', tol=1e-12)
+    x_cg = solver.solve(b)
+    assert solver.method == 'cg'
+    assert np.allclose(x_cg, x_lu, atol=1e-8)
+
+
+def test_iterative_solver_raises_above_tolerance():
+    n = 100
+    A = laplacian_1d(n) + sparse.identity(n) * 1e-3
+    b = np.random.RandomState(1).rand(n)
+    solver = SparseSolver(A, method='cg', tol=1e-12, maxiter=5)
+    with pytest.raises(ConvergenceError):
+        solver.solve(b)
+
+
+def test_flat_iterative_matches_lu(disk_case):
+    m, b, _, xb, yb, _, _ = disk_case
+    xy_lu = ExtractVTKPoints(flat(m, b, xb, yb))
+    xy_cg = ExtractVTKPoints(flat(m, b, xb, yb, method='cg', tol=1e-12))
+    assert np.abs(xy_cg - xy_lu).max() < 1e-8
+
+
+@pytest.mark.parametrize('method', ['cg', 'amg'])
+def test_constrained_iterative_methods_match_lu(disk_case, method):
+    if method == 'amg' and pyamg is None:
+        pytest.skip('pyamg is not installed')
+    m, b, c, xb, yb, xc, yc = disk_case
+    xy_lu = ExtractVTKPoints(flat_w_constraints(m, b, c, xb, yb, xc, yc))
+    xy = ExtractVTKPoints(flat_w_constraints(m, b, c, xb, yb, xc, yc, method=method, tol=1e-10))
+    assert np.abs(xy - xy_lu).max() < 1e-6
+
+
+def test_constrained_lu_matches_kkt_system(disk_case):
+    # penalized KKT system of the original flat_w_constraints, solved directly
+    from aux_functions import ComputeLaplacian, ExtractVTKTriFaces
+    m, b, c, xb, yb, xc, yc = disk_case
+    n = m.GetNumberOfPoints()
+    L = ComputeLaplacian(ExtractVTKPoints(m).T, ExtractVTKTriFaces(m).T).tolil()
+    L[b, :] = 0
+    L[b, b] = 1
+    L = (L * 1000).tocsr()
+    M = sparse.csr_matrix((np.ones(c.size), (np.arange(c.size), c)), shape=(c.size, n))
+    C = sparse.bmat([[L.T.dot(L), M.T], [M, sparse.identity(c.size) * 1e-6]], format='csc')
+    expected = np.zeros((n, 2))
+    for k, (tb, tc) in enumerate([(xb, xc), (yb, yc)]):
+        r = np.zeros(n)
+        r[b] = tb * 1000
+        expected[:, k] = linalg_sp.spsolve(C, np.concatenate([L.T.dot(r), tc]))[0:n]
+    xy = ExtractVTKPoints(flat_w_constraints(m, b, c, xb, yb, xc, yc))
+    assert np.abs(xy[:, 0:2] - expected).max() < 1e-7   # float32 points
+
+
+def test_flat_polydata_points_as_vtk_points(disk_case):
+    m = disk_case[0]
+    xy = np.random.RandomState(1).rand(m.GetNumberOfPoints(), 2)
+    expected = vtk.vtkPoints()   # float32, as the points set one by one
+    for i in range(xy.shape[0]):
+        expected.InsertNextPoint(xy[i, 0], xy[i, 1], 0)
+    pd = flat_polydata(m, xy)
+    assert pd.GetPoints().GetDataType() == expected.GetDataType()
+    assert np.array_equal(ExtractVTKPoints(pd), vtk_to_numpy(expected.GetData()))
+
+
+def test_flat_solver_reused_for_new_targets(disk_case):
+    m, b, _, xb, yb, _, _ = disk_case
+    _, solver = flat(m, b, xb, yb, return_solver=True)
+    xy = ExtractVTKPoints(flat(m, b, 2 * xb, yb + 1, solver=solver))
+    assert np.array_equal(xy, ExtractVTKPoints(flat(m, b, 2 * xb, yb + 1)))
+
+
+def test_flat_boundary_elimination_matches_identity_rows(disk_case):
+    # system of the original flat(): boundary rows of the Laplacian replaced by identity rows
+    from aux_functions import ComputeLaplacian, ExtractVTKTriFaces
+    m, b, _, xb, yb, _, _ = disk_case
+    L = ComputeLaplacian(ExtractVTKPoints(m).T, ExtractVTKTriFaces(m).T).tolil()
+    L[b, :] = 0
+    L[b, b] = 1
+    expected = np.zeros((m.GetNumberOfPoints(), 2))
+    for k, t in enumerate([xb, yb]):
+        r = np.zeros(m.GetNumberOfPoints())
+        r[b] = t
+        expected[:, k] = linalg_sp.spsolve(L.tocsr(), r)
+    for boundary in ['eliminate', 'rows']:
+        xy = ExtractVTKPoints(flat(m, b, xb, yb, boundary=boundary))
+        assert np.abs(xy[:, 0:2] - expected).max() < 1e-7   # float32 points
+
+
+def test_sweep_matches_separate_solves(disk_case):
+    m, b, c, xb, yb, xc, yc = disk_case
+    positions = [(xb, yb, xc, yc), (1.2 * xb, yb, xc, 0.5 * yc), (xb + 1, yb - 1, xc + 1, yc - 1)]
+    flats = flat_w_constraints_sweep(m, b, c, positions)
+    for (x0_b, y0_b, x0_c, y0_c), m_flat in zip(positions, flats):
+        expected = ExtractVTKPoints(flat_w_constraints(m, b, c, x0_b, y0_b, x0_c, y0_c))
+        assert np.abs(ExtractVTKPoints(m_flat) - expected).max() < 1e-6
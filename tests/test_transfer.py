@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+from aux_functions import (ExtractVTKPoints, ExtractVTKTriFaces, far_points_mask, interpolation_matrix,
+                           transfer_all_scalar_arrays, transfer_array)
+from bundle_functions import MESH_CACHE_DIR, get_mesh_cache, set_mesh_cache
+from conftest import bump_mesh
+
+
+def polydata_from_points(points):
+    pd = vtk.vtkPolyData()
+    pd.SetPoints(vtk.vtkPoints())
+    pd.GetPoints().SetData(numpy_to_vtk(points, deep=1))
+    return pd
+
+
+def mesh_with_arrays(resolution):
+    m = bump_mesh(resolution)
+    m.GetPointData().Initialize()
+    xyz = ExtractVTKPoints(m) + np.random.RandomState(resolution).uniform(-0.01, 0.01, (m.GetNumberOfPoints(), 3))
+    m.GetPoints().SetData(numpy_to_vtk(xyz, deep=1))   # no ties between closest points of the two grids
+    for name, values in [('autolabels', (xyz[:, 0] > 0).astype(np.int32) + 2 * (xyz[:, 1] > 0)),
+                         ('voltage', 1 + 2 * xyz[:, 0] - xyz[:, 1] + 3 * xyz[:, 2])]:
+        array = numpy_to_vtk(values, deep=1)
+        array.SetName(name)
+        m.GetPointData().AddArray(array)
+    return m
+
+
+def transfer_array_reference(ref, target, arrayname):
+    """Closest point value, one FindClosestPoint per target point as the original transfer_array"""
+    locator = vtk.vtkPointLocator()
+    locator.SetDataSet(ref)
+    locator.BuildLocator()
+    refarray = ref.GetPointData().GetArray(arrayname)
+    return np.array([refarray.GetValue(locator.FindClosestPoint(target.GetPoint(i)))
+                     for i in range(target.GetNumberOfPoints())])
+
+
+def test_transfer_array_matches_locator_loop():
+    ref = mesh_with_arrays(9)
+    target = bump_mesh(13)
+    for name in ['autolabels', 'voltage']:
+        transfer_array(ref, target, name, name + '_t')
+        values = vtk_to_numpy(target.GetPointData().GetArray(name + '_t'))
+        assert values.dtype == np.float64
+        assert np.array_equal(values, transfer_array_reference(ref, target, name))
+
+
+def test_transfer_all_scalar_arrays_single_query():
+    ref = mesh_with_arrays(9)
+    target = bump_mesh(13)
+    target.GetPointData().Initialize()
+    transfer_all_scalar_arrays(ref, target)
+    for name in ['autolabels', 'voltage']:
+        assert np.array_equal(vtk_to_numpy(target.GetPointData().GetArray(name)),
+                              transfer_array_reference(ref, target, name))
+
+
+def test_interpolation_matrix_reproduces_linear_maps_and_is_cached(tmp_path, monkeypatch):
+    ref = mesh_with_arrays(9)
+    vertex = ExtractVTKPoints(ref)
+    faces = ExtractVTKTriFaces(ref)
+    w = np.random.RandomState(2).dirichlet([1, 1, 1], faces.shape[0])
+    target = polydata_from_points(np.einsum('ij,ijk->ik', w, vertex[faces]))   # points on the triangles of ref
+    monkeypatch.setenv('LA_MESH_CACHE', '1' if get_mesh_cache() else '0')
+    previous = get_mesh_cache()
+    set_mesh_cache(True)
+    try:
+        W = interpolation_matrix(ref, target, str(tmp_path))
+        assert len(os.listdir(str(tmp_path / MESH_CACHE_DIR))) == 1
+        assert abs(interpolation_matrix(ref, target, str(tmp_path)) - W).max() == 0   # loaded
+    finally:
+        set_mesh_cache(previous)
+    assert np.allclose(W.sum(axis=1), 1)
+    voltage = vtk_to_numpy(ref.GetPointData().GetArray('voltage'))
+    expected = np.einsum('ij,ij->i', w, voltage[faces])
+    assert np.allclose(W.dot(voltage), expected, atol=1e-9)
+
+    transfer_all_scalar_arrays(ref, target, method='barycentric')
+    assert np.allclose(vtk_to_numpy(target.GetPointData().GetArray('voltage')), expected, atol=1e-9)
+    labels = vtk_to_numpy(target.GetPointData().GetArray('autolabels'))
+    assert np.array_equal(labels, transfer_array_reference(ref, target, 'autolabels'))   # labels by closest point
+
+
+def far_points_reference(points, ref, tol):
+    """One FindClosestPoint and distance check per point, as the original hole / mv / pv marking loops"""
+    locator = vtk.vtkPointLocator()
+    locator.SetDataSet(ref)
+    locator.BuildLocator()
+    mask = np.zeros(points.GetNumberOfPoints(), dtype=bool)
+    for i in range(points.GetNumberOfPoints()):
+        point = points.GetPoint(i)
+        mask[i] = np.linalg.norm(np.subtract(point, ref.GetPoint(locator.FindClosestPoint(point)))) > tol
+    return mask
+
+
+def test_far_points_mask_matches_locator_loop():
+    closed = bump_mesh(12)
+    xyz = ExtractVTKPoints(closed)
+    keep = (xyz[:, 0] < 0.4) | (xyz[:, 1] < 0.4)   # open mesh: part of the points, same coordinates
+    opened = polydata_from_points(xyz[keep])
+    moved = polydata_from_points(xyz + np.random.RandomState(3).uniform(-0.08, 0.08, xyz.shape))
+    for points, ref in [(closed, opened), (moved, closed), (closed, closed)]:
+        mask = far_points_mask(points, ref, 0.05)
+        assert np.array_equal(mask, far_points_reference(points, ref, 0.05))
+    assert np.array_equal(far_points_mask(closed, opened, 0.05), ~keep)
+    assert np.array_equal(far_points_mask(xyz, ExtractVTKPoints(opened), 0.05), ~keep)   # arrays